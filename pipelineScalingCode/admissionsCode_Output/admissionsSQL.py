@@ -1,7 +1,13 @@
 import os
-import ollama
+import sys
 import pandas as pd
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from generation_backends import load_backend
+
+# Ollama model served locally (see OLLAMA_URL in generation_backends).
+backend = load_backend("ollama", "llama3")
+
 
 def safe_str(value):
     """Return string if not NaN/empty, else None."""
@@ -65,11 +71,7 @@ def generate_nl_summary(context):
         f"{context}"
     )
 
-    response = ollama.chat(
-        model='llama3',
-        messages=[{'role': 'user', 'content': prompt}]
-    )
-    return response['message']['content'].strip()
+    return backend.generate(prompt).text.strip()
 
 def generate_sql(subject_id):
     """Generate a SQL query to fetch all admissions for a given subject_id."""
@@ -106,6 +108,7 @@ with open(output_file, "w", encoding="utf-8") as f:
         print(f"  [{i+1}/{len(grouped)}] Patient {subject_id} done.")
 
 print(f"Saved NL summaries to {output_file}")
+print(f"Generation metrics: {backend.metrics.summary()}")
 
 # --- SQL OUTPUT (one query per patient) ---
 sql_output_file = r"C:\Users\prana\OneDrive - Georgia Institute of Technology\ResearchMIBLAB\ehr_summarization_BioMibLab\pipelineScalingCode\output\admissions_queries.sql"
@@ -1,79 +1,68 @@
+import os
+import sys
+
 import pandas as pd
 
-def safe_lower(value):
-    """Return lowercase string if possible, else None."""
-    if isinstance(value, str) and value.strip():
-        return value.lower()
-    return None
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from gt_prose import Prose, first_truthy, lower, text, write_prose
 
-def safe_str(value):
-    """Return string if not NaN, else None."""
-    if pd.isna(value) or str(value).strip() == '':
-        return None
-    return str(value)
 
-def row_to_prose(row):
-    """Convert a row from admissions CSV to descriptive prose."""
-    sentences = []
+def frame_to_prose(df):
+    """Convert admissions rows to descriptive prose, one line per row (rendered column-wise)."""
+    prose = Prose(df)
 
     # Admission/discharge times
-    subject_id = safe_str(row.get('subject_id'))
-    adm_time = safe_str(row.get('admittime'))
-    dis_time = safe_str(row.get('dischtime'))
-    hadm_id = safe_str(row.get('hadm_id'))
-    if subject_id and adm_time and dis_time:
-        sentences.append(f"Patient {subject_id} was admitted on {adm_time} and discharged on {dis_time}.")
-    if hadm_id:
-        sentences.append(f"Their hospital admission ID was {hadm_id}.")
+    subject_id = text(df, 'subject_id')
+    adm_time = text(df, 'admittime')
+    dis_time = text(df, 'dischtime')
+    hadm_id = text(df, 'hadm_id')
+    prose.add(subject_id.present & adm_time.present & dis_time.present,
+              "Patient ", subject_id, " was admitted on ", adm_time, " and discharged on ", dis_time, ".")
+    prose.add(hadm_id.present, "Their hospital admission ID was ", hadm_id, ".")
 
     # Death info
-    deathtime = safe_str(row.get('deathtime'))
-    if deathtime:
-        sentences.append(f"They died on {deathtime}.")
+    deathtime = text(df, 'deathtime')
+    prose.add(deathtime.present, "They died on ", deathtime, ".")
 
     # Admission type and provider
-    admission_type = safe_lower(row.get('admission_type'))
-    provider = safe_str(row.get('admitprovider_id') or row.get('admitting_provider_id'))
-    if admission_type:
-        if provider:
-            sentences.append(f"The admission type was {admission_type}, and they were admitted by provider {provider}.")
-        else:
-            sentences.append(f"The admission type was {admission_type}.")
+    admission_type = lower(df, 'admission_type')
+    provider = text(df.assign(_provider=first_truthy(df, 'admitprovider_id', 'admitting_provider_id')), '_provider')
+    prose.add(admission_type.present & provider.present,
+              "The admission type was ", admission_type, ", and they were admitted by provider ", provider, ".")
+    prose.add(admission_type.present & ~provider.present, "The admission type was ", admission_type, ".")
 
     # Admission/discharge location
-    admission_loc = safe_lower(row.get('admission_location'))
-    discharge_loc = safe_lower(row.get('discharge_location'))
-    if admission_loc or discharge_loc:
-        sentences.append(f"They arrived via {admission_loc or 'unknown'} and were discharged to {discharge_loc or 'unknown'}.")
+    admission_loc = lower(df, 'admission_location')
+    discharge_loc = lower(df, 'discharge_location')
+    prose.add(admission_loc.present | discharge_loc.present,
+              "They arrived via ", admission_loc.or_('unknown'),
+              " and were discharged to ", discharge_loc.or_('unknown'), ".")
 
     # Insurance, language, marital status
-    insurance = safe_str(row.get('insurance'))
-    language = safe_str(row.get('language'))
-    marital = safe_lower(row.get('marital_status'))
-    parts = []
-    if insurance: parts.append(f"Insurance: {insurance}")
-    if language: parts.append(f"Language: {language}")
-    if marital: parts.append(f"Marital status: {marital}")
-    if parts:
-        sentences.append(", ".join(parts) + ".")
+    insurance = text(df, 'insurance')
+    language = text(df, 'language')
+    marital = lower(df, 'marital_status')
+    parts = Prose(df, sep=", ")
+    parts.add(insurance.present, "Insurance: ", insurance)
+    parts.add(language.present, "Language: ", language)
+    parts.add(marital.present, "Marital status: ", marital)
+    prose.add(parts.present(), parts.field(), ".")
 
     # Race
-    race = safe_str(row.get('race'))
-    if race:
-        sentences.append(f"Race: {race}.")
+    race = text(df, 'race')
+    prose.add(race.present, "Race: ", race, ".")
 
     # ED times
-    edregtime = safe_str(row.get('edregtime'))
-    edouttime = safe_str(row.get('edouttime'))
-    if edregtime or edouttime:
-        sentences.append(f"ED registration: {edregtime or 'unknown'}, ED out: {edouttime or 'unknown'}.")
+    edregtime = text(df, 'edregtime')
+    edouttime = text(df, 'edouttime')
+    prose.add(edregtime.present | edouttime.present,
+              "ED registration: ", edregtime.or_('unknown'), ", ED out: ", edouttime.or_('unknown'), ".")
 
     # Hospital expire flag
-    hospital_flag = safe_str(row.get('hospital_expire_flag'))
-    if hospital_flag:
-        sentences.append(f"Hospital expire flag: {hospital_flag}.")
+    hospital_flag = text(df, 'hospital_expire_flag')
+    prose.add(hospital_flag.present, "Hospital expire flag: ", hospital_flag, ".")
 
-    return " ".join(sentences)
+    return prose.lines()
 
 # --- MAIN SCRIPT ---
 
@@ -84,13 +73,8 @@ file_path = r"C:\Users\prana\OneDrive - Georgia Institute of Technology\Research
 df = pd.read_csv(file_path)
 print(f"Loaded admissions: {df.shape}")
 
-# Convert to prose
-prose_descriptions = df.apply(row_to_prose, axis=1).tolist()
-
-# Save to a single text file
+# Convert to prose and save to a single text file, double newline between patients
 output_file = r"C:\Users\prana\OneDrive - Georgia Institute of Technology\ResearchMIBLAB\ehr_summarization_BioMibLab\pipelineScalingCode\output\admissions_prose.txt"
-with open(output_file, "w", encoding="utf-8") as f:
-    for line in prose_descriptions:
-        f.write(line + "\n\n")  # double newline between patients
+n_lines = write_prose(output_file, df, frame_to_prose)
 
-print(f"Saved {len(prose_descriptions)} patient descriptions to {output_file}")
+print(f"Saved {n_lines} patient descriptions to {output_file}")
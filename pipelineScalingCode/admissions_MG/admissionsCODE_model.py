@@ -1,11 +1,13 @@
 import os
 import re
-import sqlite3
+import sys
 
 import pandas as pd
-import torch
-from transformers import AutoTokenizer, AutoModelForCausalLM, pipeline
-import json
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from context_budget import prompt_budget, scale_max_new_tokens, fit_payload
+from generation_backends import backend_from_env
+from table_pipeline import TablePipeline, run_options, run_table
 
 
 # ======================
@@ -14,7 +16,7 @@ import json
 
 # Pick the Hugging Face model to use for both SQL generation and clinical summary generation.
 MODEL_NAME = "meta-llama/Llama-3.1-8B-Instruct"
- 
+
 # Other good options:
 # "google/gemma-2b-it"
 # "google/gemma-7b-it"
@@ -23,27 +25,12 @@ MODEL_NAME = "meta-llama/Llama-3.1-8B-Instruct"
 # "microsoft/Phi-3-mini-4k-instruct"
 # "meta-llama/Llama-3.3-70B-Instruct"
 
-print(f"Loading model: {MODEL_NAME}")
+# Optional small draft model for speculative decoding (same outputs with do_sample=False, faster decode).
+# e.g. "meta-llama/Llama-3.2-1B-Instruct" for the Llama-3.1-8B target. Leave unset to disable.
+DRAFT_MODEL_NAME = os.getenv("DRAFT_MODEL_NAME")
 
-tokenizer = AutoTokenizer.from_pretrained(MODEL_NAME)
-
-model = AutoModelForCausalLM.from_pretrained(
-    MODEL_NAME,
-    dtype=torch.float16,   
-    device_map="auto"
-)
-
-if tokenizer.pad_token is None:
-    tokenizer.pad_token = tokenizer.eos_token
-
-generator = pipeline(
-    "text-generation",
-    model=model,
-    tokenizer=tokenizer,
-    max_new_tokens=500,
-    do_sample=False,
-    pad_token_id=tokenizer.eos_token_id
-)
+# Serialization of the summary context: json | compact | table | delta (see context_encodings.py).
+CONTEXT_ENCODING = os.getenv("CONTEXT_ENCODING", "json")
 
 # ======================
 # HELPERS
@@ -99,8 +86,8 @@ ORDER BY admittime ASC;
 # STEP 1: SQL GENERATION
 # ======================
 
-def generate_sql(subject_id):
-    prompt = f"""
+def build_sql_prompt(subject_id):
+    return f"""
 You are a clinical SQL assistant.
 
 Write ONE SQLite query for table admissions with columns:
@@ -122,14 +109,14 @@ Rules:
 - do not explain anything
 """.strip()
 
-    result = generator(prompt, max_new_tokens=500, do_sample=False)
-    raw_sql = result[0]["generated_text"][len(prompt):].strip()
+
+def parse_sql(raw_sql, subject_id):
     sql = extract_sql(raw_sql)
 
     if "select" not in sql.lower():
         sql = fallback_sql(subject_id)
 
-    return prompt, raw_sql, sql
+    return sql
 
 
 # ======================
@@ -192,7 +179,11 @@ def build_patient_context(subject_id, group):
     return "\n".join(lines)
 """
 
-def build_patient_context(subject_id, group):
+# Per-record list in the payload; fit_payload trims this list when the prompt is too long.
+CONTEXT_LIST_KEY = "admissions"
+
+
+def build_patient_payload(subject_id, group):
     admissions = []
     for _, row in group.iterrows():
         admissions.append(
@@ -215,14 +206,29 @@ def build_patient_context(subject_id, group):
             }
         )
 
-    payload = {"patient_id": int(subject_id), "admissions": admissions}
-    return json.dumps(payload, ensure_ascii=True)
+    return {"patient_id": int(subject_id), CONTEXT_LIST_KEY: admissions}
+
+
+def build_patient_context(subject_id, group, max_new_tokens, backend):
+    payload = build_patient_payload(subject_id, group)
+    # If the patient does not fit, keep the most recent admissions.
+    return fit_payload(
+        payload,
+        CONTEXT_LIST_KEY,
+        build_summary_prompt,
+        backend.tokenizer,
+        prompt_budget(backend.context_window, max_new_tokens),
+        order=list(reversed(range(len(payload["admissions"])))),
+        encoding=CONTEXT_ENCODING,
+    )
+
+
 # ======================
 # STEP 3: SUMMARY GENERATION
 # ======================
 
-def generate_summary(context):
-    prompt = f"""
+def build_summary_prompt(context):
+    return f"""
 You are a clinical documentation assistant.
 
 Write ONE short paragraph per admission in chronological order, separated by a blank line.
@@ -240,9 +246,10 @@ ADMISSIONS_JSON:
 {context}
 """.strip()
 
-    result = generator(prompt, max_new_tokens=500, do_sample=False)
-    summary = result[0]["generated_text"][len(prompt):].strip()
-    return prompt, summary
+
+# One paragraph per admission, so the decode budget follows the admission count.
+def summary_max_new_tokens(result_df):
+    return scale_max_new_tokens(len(result_df))
 
 
 # ======================
@@ -257,41 +264,27 @@ file_path = "/storage/ice1/0/2/sfatima7/admissions.csv"
 output_file = "/storage/ice1/0/2/sfatima7/admissions_prose.txt"
 sql_file = "/storage/ice1/0/2/sfatima7/admissions_queries.sql"
 
-df = pd.read_csv(file_path)
-
-print(f"Loaded {len(df)} rows")
-
-conn = sqlite3.connect(":memory:")
-df.to_sql("admissions", conn, index=False, if_exists="replace")
-
-subject_ids = df["subject_id"].dropna().astype(int).unique()
-print(f"Processing {len(subject_ids)} patients")
-
-with open(output_file, "w", encoding="utf-8") as prose_handle, \
-     open(sql_file, "w", encoding="utf-8") as sql_handle:
-
-    for i, subject_id in enumerate(subject_ids):
-        try:
-            sql_prompt, raw_sql, sql = generate_sql(subject_id)
-
-            sql_handle.write(f"-- Patient {subject_id}\n{sql}\n\n")
-
-            result_df = pd.read_sql_query(sql, conn)
-            context = build_patient_context(subject_id, result_df)
-            summary_prompt, summary = generate_summary(context)
-
-            prose_handle.write(f"=== Patient {subject_id} ===\n")
-            prose_handle.write("SQL PROMPT:\n" + sql_prompt + "\n\n")
-            prose_handle.write("RAW SQL OUTPUT:\n" + raw_sql + "\n\n")
-            prose_handle.write("EXECUTED SQL:\n" + sql + "\n\n")
-            prose_handle.write("SUMMARY PROMPT:\n" + summary_prompt + "\n\n")
-            prose_handle.write("SUMMARY OUTPUT:\n" + summary + "\n\n")
+PIPELINE = TablePipeline(
+    table="admissions",
+    input_files={"admissions": file_path},
+    output_file=output_file,
+    sql_file=sql_file,
+    build_sql_prompt=build_sql_prompt,
+    parse_sql=parse_sql,
+    build_patient_context=build_patient_context,
+    build_summary_prompt=build_summary_prompt,
+    summary_max_new_tokens=summary_max_new_tokens,
+    sql_max_new_tokens=500,
+    context_unit="admissions",
+)
 
-            print(f"Done {i+1}/{len(subject_ids)}")
 
-        except Exception as e:
-            print(f"Failed for patient {subject_id}: {e}")
+def main():
+    # Set GEN_BACKEND=ollama|openai|stub to run the same prompts on another backend.
+    backend = backend_from_env(MODEL_NAME, max_new_tokens=500, draft_model_name=DRAFT_MODEL_NAME)
+    # --resume / --retry-failed continue an interrupted run from its ledger.
+    run_table(PIPELINE, backend, **run_options())
 
-conn.close()
 
-print("Finished everything.")
+if __name__ == "__main__":
+    main()
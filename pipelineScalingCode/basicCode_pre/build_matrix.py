@@ -1,74 +1,190 @@
 import pandas as pd
+import numpy as np
+import hashlib
 import os
+from scipy import sparse
 
 # 1. Setup Path
 base_path = os.path.join('.', 'mimic-iv-clinical-database-demo-2.2', 'hosp')
 
-print("Loading data...")
-# Load Diagnoses and Prescriptions
-df_diag = pd.read_csv(os.path.join(base_path, 'diagnoses_icd.csv.gz'), compression='gzip')
-df_rx = pd.read_csv(os.path.join(base_path, 'prescriptions.csv.gz'), compression='gzip')
+# Where the matrix is saved; finalize_dataset.py (and anything else downstream) loads it from here
+MATRIX_FILE = 'admission_features.npz'
+
+# Bump when the layout of the .npz or of the column dictionary changes
+ARTIFACT_VERSION = 3
+
+# For the matrix, we only care about: hadm_id (Row), icd_code (Column), and drug (Column)
+# Every ICD code and every drug gets a column. The matrix is a scipy.sparse CSR matrix of
+# 0/1 markers, so memory grows with the number of (admission, feature) pairs, not with
+# admissions x features like the dense pivot_table did.
+
 
 # ---------------------------------------------------------
-# 2. PRE-PROCESSING
+# SAVE / LOAD
 # ---------------------------------------------------------
-# For the matrix, we only care about: hadm_id (Row), icd_code (Column), and drug (Column)
+def columns_file(path):
+    return os.path.splitext(path)[0] + '_columns.csv'
+
+
+# The CSR arrays and the row ids go in one compressed .npz; the column dictionary
+# (one row per column: kind, code, icd_version, name, title, admissions, rows) in a CSV next
+# to it. The .npz records the artifact version and a hash of the dictionary, so a
+# dictionary that does not belong to the matrix is caught on load.
+def save_feature_matrix(path, matrix, hadm_ids, columns):
+    dictionary = columns.to_csv(index=False).encode('utf-8')
+    with open(columns_file(path), 'wb') as f:
+        f.write(dictionary)
+    np.savez_compressed(
+        path,
+        data=matrix.data, indices=matrix.indices, indptr=matrix.indptr,
+        shape=np.array(matrix.shape), hadm_id=hadm_ids,
+        version=np.array(ARTIFACT_VERSION), columns_sha256=np.array(hashlib.sha256(dictionary).hexdigest()),
+    )
 
-# A. Clean Diagnoses
-# Let's keep only the top 20 most common codes to keep the terminal output readable
-# (In real research, you might keep hundreds or group them)
-top_codes = df_diag['icd_code'].value_counts().head(20).index
-df_diag_filtered = df_diag[df_diag['icd_code'].isin(top_codes)].copy()
-df_diag_filtered['value'] = 1 # Marker for pivot
 
-# B. Clean Prescriptions
-# Keep top 20 drugs
-top_drugs = df_rx['drug'].value_counts().head(20).index
-df_rx_filtered = df_rx[df_rx['drug'].isin(top_drugs)].copy()
-df_rx_filtered['value'] = 1
+# Returns (CSR matrix, hadm_id per row, column dictionary DataFrame)
+def load_feature_matrix(path=MATRIX_FILE):
+    with np.load(path) as saved:
+        version = int(saved['version']) if 'version' in saved else 1
+        if version != ARTIFACT_VERSION:
+            raise ValueError(f"{path} is version {version}, expected {ARTIFACT_VERSION}: rerun build_matrix.py")
+        matrix = sparse.csr_matrix(
+            (saved['data'], saved['indices'], saved['indptr']), shape=tuple(saved['shape'])
+        )
+        hadm_ids = saved['hadm_id']
+        digest = str(saved['columns_sha256'])
+
+    with open(columns_file(path), 'rb') as f:
+        dictionary = f.read()
+    if hashlib.sha256(dictionary).hexdigest() != digest:
+        raise ValueError(f"{columns_file(path)} does not match {path}: rerun build_matrix.py")
+    columns = pd.read_csv(columns_file(path), dtype={'code': str, 'icd_version': 'Int64', 'title': str},
+                          keep_default_na=False, na_values=[''])
+    return matrix, hadm_ids, columns
+
 
 # ---------------------------------------------------------
-# 3. PIVOTING (Creating the 0/1 Matrix)
+# COLUMN OPERATIONS (metadata only, no reload of the source tables)
 # ---------------------------------------------------------
-print("Building Matrix...")
-
-# Pivot Diagnoses: Rows=Admission, Cols=ICD Code
-diag_matrix = df_diag_filtered.pivot_table(
-    index='hadm_id', 
-    columns='icd_code', 
-    values='value', 
-    fill_value=0,
-    aggfunc='max' # Ensure we don't get 2s if recorded twice
-)
-# Add prefix so we know these are diagnoses
-diag_matrix.columns = ['Dx_' + str(col) for col in diag_matrix.columns]
-
-# Pivot Meds: Rows=Admission, Cols=Drug Name
-rx_matrix = df_rx_filtered.pivot_table(
-    index='hadm_id', 
-    columns='drug', 
-    values='value', 
-    fill_value=0,
-    aggfunc='max'
-)
-# Add prefix
-rx_matrix.columns = ['Rx_' + str(col) for col in rx_matrix.columns]
+# Column labels: 'Dx_4019' style names, or 'Dx_<title>' with the title cut to `width` chars
+def column_labels(columns, readable=False, width=None):
+    if not readable:
+        return columns['name'].tolist()
+    titles = columns['title'].fillna('Unknown').str.slice(0, width)
+    return (columns['kind'] + '_' + titles).tolist()
+
+
+# The `top` most common columns of one kind ('Dx' / 'Rx'), or all of them. `by` counts
+# admissions, or 'rows' (source records, repeats within an admission included);
+# `order_by` sorts the selection by a dictionary column (e.g. 'code') instead of count.
+def select_columns(matrix, columns, kind=None, top=None, by='admissions', order_by=None):
+    selected = columns if kind is None else columns[columns['kind'] == kind]
+    if top is not None:
+        selected = selected.sort_values(by, ascending=False, kind='stable').head(top)
+    if order_by is not None:
+        selected = selected.sort_values(order_by, kind='stable')
+    return matrix[:, selected.index.to_numpy()], selected.reset_index(drop=True)
+
+
+# Dense DataFrame of a (small) selection for CSV export; by default only admissions
+# that have at least one of the selected features, as the old pivot tables had
+def to_frame(matrix, hadm_ids, columns, readable=False, width=None, nonempty_rows=True):
+    keep = np.diff(matrix.indptr) > 0 if nonempty_rows else np.ones(matrix.shape[0], dtype=bool)
+    return pd.DataFrame(matrix[keep].toarray(), index=pd.Index(hadm_ids[keep], name='hadm_id'),
+                        columns=column_labels(columns, readable, width))
+
 
 # ---------------------------------------------------------
-# 4. MERGE EVERYTHING
+# BUILD
 # ---------------------------------------------------------
-# Join them on Admission ID (hadm_id)
-final_matrix = pd.merge(diag_matrix, rx_matrix, on='hadm_id', how='outer').fillna(0).astype(int)
+# One block of columns: integer codes for the feature keys, (row, column) per record,
+# and the number of records per column
+def encode_features(df, hadm_ids, keys, kind):
+    df = df.dropna(subset=['hadm_id'] + keys)
+    rows = np.searchsorted(hadm_ids, df['hadm_id'].astype(np.int64).to_numpy())
+    codes, uniques = pd.MultiIndex.from_frame(df[keys].astype(str)).factorize()
+
+    columns = pd.DataFrame(list(uniques), columns=keys)
+    columns.insert(0, 'kind', kind)
+    columns = columns.rename(columns={keys[0]: 'code'})
+    columns['name'] = kind + '_' + columns['code']
+    columns['rows'] = np.bincount(codes, minlength=len(columns))
+    return rows, codes, columns
+
+
+# Human-readable titles: the ICD long title for codes in the matrix, the drug name for drugs
+def add_titles(columns, df_dict):
+    titles = df_dict[['icd_code', 'icd_version', 'long_title']].rename(
+        columns={'icd_code': 'code', 'long_title': 'title'})
+    titles['icd_version'] = titles['icd_version'].astype(str)
+    titles = titles.drop_duplicates(['code', 'icd_version'])
+    columns = columns.merge(titles, on=['code', 'icd_version'], how='left')
+    is_rx = columns['kind'] == 'Rx'
+    columns.loc[is_rx, 'title'] = columns.loc[is_rx, 'code']
+    return columns
+
+
+def build_feature_matrix(df_diag, df_rx, df_dict=None):
+    hadm_ids = np.unique(np.concatenate([
+        df_diag['hadm_id'].dropna().astype(np.int64).to_numpy(),
+        df_rx['hadm_id'].dropna().astype(np.int64).to_numpy(),
+    ]))
+
+    # A. Diagnoses: a column per (icd_code, icd_version), since ICD-9 and ICD-10 codes can collide
+    diag_keys = ['icd_code', 'icd_version'] if 'icd_version' in df_diag.columns else ['icd_code']
+    dx_rows, dx_cols, dx_columns = encode_features(df_diag, hadm_ids, diag_keys, 'Dx')
+
+    # B. Prescriptions: a column per drug name
+    rx_rows, rx_cols, rx_columns = encode_features(df_rx, hadm_ids, ['drug'], 'Rx')
+
+    rows = np.concatenate([dx_rows, rx_rows])
+    cols = np.concatenate([dx_cols, rx_cols + len(dx_columns)])
+    matrix = sparse.csr_matrix(
+        (np.ones(len(rows), dtype=np.int8), (rows, cols)),
+        shape=(len(hadm_ids), len(dx_columns) + len(rx_columns)),
+    )
+    # Duplicates were summed; a code recorded twice is still 1
+    matrix.data[:] = 1
+
+    columns = pd.concat([dx_columns, rx_columns], ignore_index=True)
+    columns['admissions'] = np.diff(matrix.tocsc().indptr)
+    if df_dict is not None and 'icd_version' in columns:
+        columns = add_titles(columns, df_dict)
+    order = [col for col in ['kind', 'code', 'icd_version', 'name', 'title', 'admissions', 'rows'] if col in columns]
+    return matrix, hadm_ids, columns[order]
+
+
+def main():
+    print("Loading data...")
+    # Load Diagnoses and Prescriptions
+    df_diag = pd.read_csv(os.path.join(base_path, 'diagnoses_icd.csv.gz'), compression='gzip',
+                          usecols=['hadm_id', 'icd_code', 'icd_version'], dtype={'icd_code': str})
+    df_rx = pd.read_csv(os.path.join(base_path, 'prescriptions.csv.gz'), compression='gzip',
+                        usecols=['hadm_id', 'drug'])
+    # ICD titles are looked up once here and stored with the matrix
+    df_dict = pd.read_csv(os.path.join(base_path, 'd_icd_diagnoses.csv.gz'), compression='gzip',
+                          dtype={'icd_code': str})
+
+    print("Building Matrix...")
+    matrix, hadm_ids, columns = build_feature_matrix(df_diag, df_rx, df_dict)
+
+    nbytes = matrix.data.nbytes + matrix.indices.nbytes + matrix.indptr.nbytes
+    print(f"\nMatrix Shape: {matrix.shape}")
+    print(f"(Rows = Hospital Admissions, Columns = Features: "
+          f"{(columns['kind'] == 'Dx').sum()} ICD codes, {(columns['kind'] == 'Rx').sum()} drugs)")
+    print(f"Nonzeros: {matrix.nnz} ({matrix.nnz / max(np.prod(matrix.shape), 1):.4%} dense), "
+          f"{nbytes / 1e6:.1f} MB in memory")
+    print("-" * 30)
+    print("First 5 rows of your Machine Learning Matrix (5 most common features):")
+    print("-" * 30)
+
+    # Print a subset of columns to make it fit on screen
+    sub, top = select_columns(matrix, columns, top=5)
+    print(to_frame(sub[:5], hadm_ids[:5], top, nonempty_rows=False))
 
-print(f"\nMatrix Shape: {final_matrix.shape}")
-print(f"(Rows = Hospital Admissions, Columns = Features)")
-print("-" * 30)
-print("First 5 rows of your Machine Learning Matrix:")
-print("-" * 30)
+    save_feature_matrix(MATRIX_FILE, matrix, hadm_ids, columns)
+    print(f"\nSaved to {MATRIX_FILE} (columns in {columns_file(MATRIX_FILE)})")
 
-# Print a subset of columns to make it fit on screen
-print(final_matrix.iloc[:5, :5]) 
 
-# Optional: Save to CSV for your actual research
-# final_matrix.to_csv("processed_features.csv")
-# print("\nSaved to processed_features.csv")
\ No newline at end of file
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,180 @@
+import pandas as pd
+import numpy as np
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+# Non-interactive backend: images only, no window (and safe in worker processes)
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+import matplotlib.dates as mdates
+from matplotlib.collections import LineCollection
+
+# Batch version of visualize_complex_lifeline.py: the same lifeline chart for every
+# patient (or the ones given), e.g.
+#
+#   python render_lifelines.py                                 # all patients -> lifelines/
+#   python render_lifelines.py --patients 10015860 10000032
+#   python render_lifelines.py --patients-file cohort.txt --processes 8 --out-dir gallery
+#
+# The tables are loaded once, every admission's label (its first listed diagnosis)
+# is looked up once, and the patients are drawn in a process pool. Each worker keeps
+# one figure and redraws it per patient: all visit bars go in one LineCollection and
+# the gaps are computed with numpy, so only the text labels are drawn one by one.
+
+# 1. Setup Data Path
+base_path = os.path.join('.', 'mimic-iv-clinical-database-demo-2.2', 'hosp')
+
+OUT_DIR = 'lifelines'
+
+# Gaps at home shorter than this are not labelled
+MIN_GAP_DAYS = 30
+LABEL_CHARS = 20
+
+
+# ---------------------------------------------------------
+# 2. DATA (parent process, once)
+# ---------------------------------------------------------
+def load_admissions():
+    print("Loading data...")
+    df_adm = pd.read_csv(os.path.join(base_path, 'admissions.csv.gz'), compression='gzip',
+                         usecols=['subject_id', 'hadm_id', 'admittime', 'dischtime'])
+    df_diag = pd.read_csv(os.path.join(base_path, 'diagnoses_icd.csv.gz'), compression='gzip',
+                          usecols=['hadm_id', 'icd_code', 'icd_version'], dtype={'icd_code': str})
+    df_dict = pd.read_csv(os.path.join(base_path, 'd_icd_diagnoses.csv.gz'), compression='gzip',
+                          usecols=['icd_code', 'icd_version', 'long_title'], dtype={'icd_code': str})
+
+    # admission -> first listed diagnosis (that has a name), truncated for the chart
+    df_diag = pd.merge(df_diag, df_dict, on=['icd_code', 'icd_version'], how='inner')
+    first = df_diag.drop_duplicates('hadm_id').set_index('hadm_id')['long_title']
+    labels = first.where(first.str.len() <= LABEL_CHARS, first.str.slice(0, LABEL_CHARS) + "...")
+
+    df_adm['label'] = df_adm['hadm_id'].map(labels).fillna("Unknown")
+    df_adm['start'] = mdates.date2num(pd.to_datetime(df_adm['admittime']))
+    df_adm['end'] = mdates.date2num(pd.to_datetime(df_adm['dischtime']))
+    return df_adm.dropna(subset=['start', 'end']).sort_values(['subject_id', 'start'])
+
+
+# One (subject_id, starts, ends, labels) tuple per patient: plain arrays for the workers
+def patient_jobs(df_adm, subject_ids=None):
+    if subject_ids is not None:
+        df_adm = df_adm[df_adm['subject_id'].isin(subject_ids)]
+    return [
+        (int(subject_id), group['start'].to_numpy(), group['end'].to_numpy(), group['label'].tolist())
+        for subject_id, group in df_adm.groupby('subject_id', sort=True)
+    ]
+
+
+# ---------------------------------------------------------
+# 3. PLOTTING (worker processes)
+# ---------------------------------------------------------
+_FIGURE = None
+
+
+def _figure():
+    global _FIGURE
+    if _FIGURE is None:
+        # Make the chart wide (15 inches) to fit many visits
+        _FIGURE = plt.subplots(figsize=(15, 6))
+        _FIGURE[0].subplots_adjust(left=0.03, right=0.97, top=0.88, bottom=0.1)
+    return _FIGURE
+
+
+def draw_lifeline(ax, subject_id, starts, ends, labels, y_level=1):
+    # Draw the background "Lifeline" (Gray line from first admit to last discharge)
+    ax.hlines(y_level, starts.min(), ends.max(), color='gray', alpha=0.3, linewidth=2, zorder=1)
+
+    # Draw every Hospital Stay (Blue Bar) in one collection
+    segments = np.stack([np.column_stack([starts, np.full(len(starts), y_level)]),
+                         np.column_stack([ends, np.full(len(ends), y_level)])], axis=1)
+    ax.add_collection(LineCollection(segments, colors='#007acc', linewidths=12, capstyle='round', zorder=2))
+
+    # Add Text Labels (Stagger them up and down so they don't overlap)
+    for i, (start, label) in enumerate(zip(starts, labels)):
+        up = i % 2 == 0
+        ax.text(start, y_level + 0.03 if up else y_level - 0.05, f"Visit {i+1}\n{label}",
+                fontsize=8, rotation=45, ha='left', va='bottom' if up else 'top', color='#333333')
+
+    # Red "Gap" info (Time at home), only where it is big enough to see
+    gaps = np.floor(starts[1:] - ends[:-1]).astype(int)
+    for i in np.flatnonzero(gaps > MIN_GAP_DAYS):
+        mid_point = (ends[i] + starts[i + 1]) / 2
+        ax.text(mid_point, y_level, f"{gaps[i]} days",
+                ha='center', va='center', fontsize=7, color='red', backgroundcolor='white', zorder=3)
+
+    # FORMATTING
+    ax.set_yticks([])  # Hide Y axis
+    for side in ['top', 'right', 'left', 'bottom']:
+        ax.spines[side].set_visible(False)
+    ax.xaxis.set_major_formatter(mdates.DateFormatter('%Y'))
+    ax.xaxis.set_major_locator(mdates.YearLocator())
+
+    span = ends.max() - starts.min()
+    # More room on the right for the last (rotated) visit label
+    pad = max(span * 0.03, 15)
+    ax.set_xlim(starts.min() - pad, ends.max() + 3 * pad)
+    ax.set_ylim(0.8, 1.3)  # Zoom in vertically
+
+    title = f"Patient {subject_id} Lifeline: {len(starts)} Visits"
+    if span >= 365.25:
+        title += f" over {span / 365.25:.0f} Years"
+    ax.set_title(title, fontsize=14, fontweight='bold')
+
+
+def render_patients(jobs, out_dir, dpi=150):
+    fig, ax = _figure()
+    paths = []
+    for subject_id, starts, ends, labels in jobs:
+        ax.cla()
+        draw_lifeline(ax, subject_id, starts, ends, labels)
+        path = os.path.join(out_dir, f"lifeline_{subject_id}.png")
+        fig.savefig(path, dpi=dpi)
+        paths.append(path)
+    return paths
+
+
+# ---------------------------------------------------------
+# 4. MAIN
+# ---------------------------------------------------------
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--patients", nargs="+", type=int, default=None, help="subject_ids (default: everyone)")
+    parser.add_argument("--patients-file", default=None, help="file with one subject_id per line")
+    parser.add_argument("--limit", type=int, default=None, help="only the first N patients")
+    parser.add_argument("--out-dir", default=OUT_DIR)
+    parser.add_argument("--processes", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--chunk-size", type=int, default=25, help="patients per worker task")
+    parser.add_argument("--dpi", type=int, default=150)
+    args = parser.parse_args()
+
+    subject_ids = args.patients
+    if args.patients_file:
+        with open(args.patients_file) as f:
+            subject_ids = (subject_ids or []) + [int(line) for line in f if line.strip()]
+
+    jobs = patient_jobs(load_admissions(), subject_ids)[:args.limit]
+    if not jobs:
+        print("Error: no matching patients found!")
+        return
+    os.makedirs(args.out_dir, exist_ok=True)
+
+    chunks = [jobs[i:i + args.chunk_size] for i in range(0, len(jobs), args.chunk_size)]
+    print(f"Rendering {len(jobs)} lifelines in {len(chunks)} chunks with {args.processes} processes...")
+
+    done = 0
+    if args.processes > 1 and len(chunks) > 1:
+        with ProcessPoolExecutor(args.processes) as pool:
+            for paths in pool.map(render_patients, chunks, [args.out_dir] * len(chunks), [args.dpi] * len(chunks)):
+                done += len(paths)
+                print(f"  {done}/{len(jobs)}")
+    else:
+        for chunk in chunks:
+            done += len(render_patients(chunk, args.out_dir, args.dpi))
+            print(f"  {done}/{len(jobs)}")
+
+    print(f"\n[SUCCESS] {done} images saved in: {args.out_dir}")
+
+
+if __name__ == '__main__':
+    main()
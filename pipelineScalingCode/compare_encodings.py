@@ -0,0 +1,201 @@
+"""
+Measure what each context encoding costs in prompt tokens, and optionally what it does to summary quality.
+
+    python compare_encodings.py --table ingredientevents \\
+        --input ingredientevents=ingredientevents.csv --input d_items=d_items.csv \\
+        --tokenizer meta-llama/Llama-3.1-8B-Instruct --limit 200
+
+    # also generate summaries with every encoding and score them against a reference prose file
+    python compare_encodings.py --table admissions --generate --reference admissions_proseM.txt
+
+Writes <out-dir>/<table>_encoding_tokens.csv (summary prompt tokens per patient and
+encoding) and prints mean/median/p95 tokens and the savings against plain JSON.
+Contexts are measured untrimmed, so the numbers show the full cost of each encoding.
+"""
+
+import argparse
+import importlib
+import os
+import sqlite3
+import sys
+
+import pandas as pd
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from context_budget import count_tokens
+from context_encodings import ENCODING_NAMES, encode
+from run_all_tables import TABLE_MODULES, MODEL_NAME
+from table_pipeline import load_tables, reference_sql
+
+
+# ======================
+# CONTEXTS
+# ======================
+
+def encodings_for(module):
+    names = list(ENCODING_NAMES)
+    if hasattr(module, "build_patient_text"):
+        names.insert(0, "text")
+    return names
+
+
+def full_context(module, subject_id, group, encoding):
+    if encoding == "text":
+        return module.build_patient_text(subject_id, group)
+    return encode(module.build_patient_payload(subject_id, group), module.CONTEXT_LIST_KEY, encoding)
+
+
+def load_tokenizer(name):
+    if not name:
+        print("No --tokenizer given: using the ~4 chars/token estimate")
+        return None
+    from transformers import AutoTokenizer
+    return AutoTokenizer.from_pretrained(name, token=os.getenv("HF_TOKEN"))
+
+
+# ======================
+# TOKENS
+# ======================
+
+def token_table(module, conn, subject_ids, encodings, tokenizer):
+    rows = []
+    groups = {}
+    for subject_id in subject_ids:
+        group = pd.read_sql_query(reference_sql(module.PIPELINE, subject_id), conn)
+        groups[subject_id] = group
+
+        row = {"subject_id": int(subject_id), "rows": len(group)}
+        for encoding in encodings:
+            prompt = module.build_summary_prompt(full_context(module, subject_id, group, encoding))
+            row[encoding] = count_tokens(tokenizer, prompt)
+        rows.append(row)
+    return pd.DataFrame(rows), groups
+
+
+def token_report(df, encodings):
+    baseline = df["json"].sum()
+    report = []
+    for encoding in encodings:
+        col = df[encoding]
+        report.append({
+            "encoding": encoding,
+            "mean": round(col.mean(), 1),
+            "median": col.median(),
+            "p95": col.quantile(0.95),
+            "total": int(col.sum()),
+            "vs_json": f"{100 * (col.sum() / baseline - 1):+.1f}%" if baseline else "",
+        })
+    return pd.DataFrame(report)
+
+
+# ======================
+# SUMMARIES
+# ======================
+
+# Same prompts the pipeline would send (budgeted contexts), one batch per encoding.
+def generate_summaries(module, backend, groups, encoding):
+    from generation_backends import BackendMetrics
+    from table_pipeline import prepare_summary
+
+    module.CONTEXT_ENCODING = encoding
+    backend.metrics = BackendMetrics()
+
+    subject_ids = list(groups)
+    prepared = [prepare_summary(module.PIPELINE, backend, sid, groups[sid]) for sid in subject_ids]
+    results = backend.generate_batch([p for p, _ in prepared], [m for _, m in prepared])
+    summaries = {str(sid): r.text.strip() for sid, r in zip(subject_ids, results)}
+    return summaries, backend.metrics.summary()
+
+
+def write_prose(path, summaries):
+    with open(path, "w", encoding="utf-8") as f:
+        for pid, summary in summaries.items():
+            f.write(f"Patient {pid}\n{summary}\n\n")
+
+
+# ======================
+# MAIN
+# ======================
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--table", required=True, choices=list(TABLE_MODULES))
+    parser.add_argument("--input", action="append", default=[], metavar="NAME=CSV",
+                        help="override one of the table's input CSVs")
+    parser.add_argument("--tokenizer", default=None)
+    parser.add_argument("--limit", type=int, default=100)
+    parser.add_argument("--encodings", nargs="+", default=None)
+    parser.add_argument("--out-dir", default=".")
+    parser.add_argument("--generate", action="store_true", help="also generate summaries with every encoding")
+    parser.add_argument("--model", default=MODEL_NAME)
+    parser.add_argument("--reference", default=None, help="reference prose file to score summaries against")
+    args = parser.parse_args()
+
+    module = importlib.import_module(TABLE_MODULES[args.table])
+    pipeline = module.PIPELINE
+    for item in args.input:
+        name, path = item.split("=", 1)
+        pipeline.input_files[name] = path
+
+    encodings = args.encodings or encodings_for(module)
+    if "json" not in encodings:
+        encodings.insert(0, "json")
+
+    conn = sqlite3.connect(":memory:")
+    subject_ids = load_tables(pipeline, conn)[:args.limit]
+    tokenizer = load_tokenizer(args.tokenizer)
+
+    df, groups = token_table(module, conn, subject_ids, encodings, tokenizer)
+    conn.close()
+
+    os.makedirs(args.out_dir, exist_ok=True)
+    tokens_path = os.path.join(args.out_dir, f"{args.table}_encoding_tokens.csv")
+    df.to_csv(tokens_path, index=False)
+
+    print(f"\n==== SUMMARY PROMPT TOKENS ({len(df)} patients) ====")
+    print(token_report(df, encodings).to_string(index=False))
+    print(f"\nPer-patient tokens saved to {tokens_path}")
+
+    if not args.generate:
+        return
+
+    from generation_backends import backend_from_env
+    backend = backend_from_env(args.model, max_new_tokens=500, token=os.getenv("HF_TOKEN"))
+
+    reference = bert = rouge = None
+    if args.reference:
+        from eval_scores import BertScoreEngine, RougeStage
+        from evaluation import load_patients, normalize_text
+        reference = load_patients(args.reference)
+        # Shared by every encoding: one scoring model, references tokenized once.
+        bert = BertScoreEngine()
+        rouge = RougeStage({pid: normalize_text(text) for pid, text in reference.items()})
+
+    quality = []
+    for encoding in encodings:
+        summaries, metrics = generate_summaries(module, backend, groups, encoding)
+        write_prose(os.path.join(args.out_dir, f"{args.table}_{encoding}_prose.txt"), summaries)
+
+        row = {"encoding": encoding, "prompt_tokens": metrics["prompt_tokens"],
+               "latency_total_s": metrics["latency_total_s"]}
+        if reference is not None:
+            from evaluation import evaluate_patients
+            scores = evaluate_patients(summaries, reference, bert=bert, rouge=rouge)
+            for metric in ["rouge1", "rouge2", "rougeL", "bertscore_f1"]:
+                row[metric] = round(scores[metric].mean(), 4) if len(scores) else None
+        quality.append(row)
+
+    if rouge is not None:
+        rouge.close()
+
+    quality = pd.DataFrame(quality)
+    quality_path = os.path.join(args.out_dir, f"{args.table}_encoding_quality.csv")
+    quality.to_csv(quality_path, index=False)
+
+    print("\n==== SUMMARIES BY ENCODING ====")
+    print(quality.to_string(index=False))
+    print(f"\nSaved to {quality_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,198 @@
+"""
+Score several models' result files against the ground truth in one run: a (model x table x metric) matrix.
+
+    python compare_models.py \\
+        --reference admissions=admissions_prose.txt --reference icustays=icustays_prose.txt \\
+        icustays_MG/icustays_prose_gemma1b.txt icustays_MG/icustays_prose_llama8b.txt \\
+        admissions_MG/admissions_prose_llama8b.txt --baseline llama8b
+
+    # a file whose name does not follow <table>_prose_<model>: give model and table
+    python compare_models.py --reference admissions=admissions_prose.txt --run qwen7b:admissions=out/adm.jsonl
+
+Candidate files are prose or run-record files (anything evaluation.load_patients
+reads). Each table's reference is loaded, normalized and prepared for ROUGE once
+and scored against every model of that table in the same process pool. BERTScore
+runs once over all (candidate, reference) pairs of all models and tables, in one
+length-sorted batched pass with one scoring model, with the reference
+embeddings cached as usual (eval_scores.py).
+
+Writes to --out-dir:
+
+    model_matrix.csv      one row per model and table: patients and mean of every metric
+    model_patients.csv    every metric per model, table and patient
+    model_deltas.csv      per patient, each model minus --baseline (patients both have)
+
+--common-patients scores every model of a table on the patients all of them have.
+"""
+
+import argparse
+import os
+import re
+import sys
+
+import pandas as pd
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from eval_scores import BERT_BATCH_SIZE, BERT_CACHE_DIR, BertScoreEngine, RougeStage
+from evaluation import load_patients, normalize_text
+
+
+METRICS = ["rouge1", "rouge2", "rougeL", "bertscore_f1"]
+
+# <table>_prose_<model>.txt / .jsonl (optionally .gz / .zst), as the MG scripts name their outputs.
+RUN_NAME = re.compile(r"^(?P<table>[A-Za-z]+)_prose_(?P<model>.+?)(?:\.txt|\.jsonl)(?:\.gz|\.zst)?$")
+
+
+# ======================
+# RUNS
+# ======================
+
+# (model, table, path) for a "MODEL:TABLE=PATH" option or a conventionally named file.
+def parse_run(item):
+    if "=" in item:
+        label, path = item.split("=", 1)
+        model, sep, table = label.partition(":")
+        if not sep or not model or not table:
+            raise ValueError(f"--run expects MODEL:TABLE=PATH, got {item!r}")
+        return model, table, path
+
+    match = RUN_NAME.match(os.path.basename(item))
+    if not match:
+        raise ValueError(f"Cannot tell model and table from {item!r}; use --run MODEL:TABLE=PATH")
+    return match["model"], match["table"], item
+
+
+def parse_references(items):
+    references = {}
+    for item in items:
+        table, sep, path = item.partition("=")
+        if not sep or not table or not path:
+            raise ValueError(f"--reference expects TABLE=PATH, got {item!r}")
+        references[table] = path
+    return references
+
+
+# ======================
+# SCORING
+# ======================
+
+# runs: [(model, table, path)]; references: {table: path}.
+# Returns the per-patient scores (model, table, patient_id, metrics...).
+def compare_runs(runs, references, bert=None, limit=None, common_patients=False):
+    missing = sorted({table for _, table, _ in runs} - set(references))
+    if missing:
+        raise ValueError(f"No --reference for table(s): {', '.join(missing)}")
+
+    rows = []
+    pairs = []   # (row index, prediction, reference) for the single BERTScore pass
+    for table in dict.fromkeys(table for _, table, _ in runs):
+        table_runs = [(model, path) for model, t, path in runs if t == table]
+        reference = load_patients(references[table])
+        candidates = {model: load_patients(path) for model, path in table_runs}
+        print(f"{table}: {len(reference)} reference patients, models {', '.join(candidates)}")
+
+        patients = {model: set(summaries.keys()) & set(reference.keys()) for model, summaries in candidates.items()}
+        if common_patients:
+            shared = set.intersection(*patients.values())
+            patients = {model: shared for model in patients}
+        patients = {model: sorted(pids)[:limit] for model, pids in patients.items()}
+
+        # Only the reference patients some model needs are normalized and prepared.
+        needed = sorted(set().union(*patients.values()))
+        refs = {pid: normalize_text(reference[pid]) for pid in needed}
+        rouge = RougeStage(refs)
+        try:
+            for model, summaries in candidates.items():
+                preds = {pid: normalize_text(summaries[pid]) for pid in patients[model]}
+                rouge_scores = rouge.score(preds)
+                print(f"  {model}: ROUGE done for {len(preds)} patients")
+                for pid in patients[model]:
+                    pairs.append((len(rows), preds[pid], refs[pid]))
+                    rows.append({"model": model, "table": table, "patient_id": pid, **rouge_scores[pid]})
+        finally:
+            rouge.close()
+
+    if pairs:
+        if bert is None:
+            bert = BertScoreEngine()
+        _, _, f1 = bert.score([pred for _, pred, _ in pairs], [ref for _, _, ref in pairs])
+        for (i, _, _), value in zip(pairs, f1):
+            rows[i]["bertscore_f1"] = value
+        print(f"BERTScore done for {len(pairs)} pairs")
+
+    return pd.DataFrame(rows, columns=["model", "table", "patient_id"] + METRICS)
+
+
+# ======================
+# REPORTS
+# ======================
+
+def model_matrix(scores):
+    matrix = scores.groupby(["model", "table"], sort=False)[METRICS].mean()
+    matrix.insert(0, "patients", scores.groupby(["model", "table"], sort=False).size())
+    return matrix.reset_index()
+
+
+# Each model minus the baseline, per table and patient both scored.
+def patient_deltas(scores, baseline):
+    base = scores[scores["model"] == baseline].drop(columns="model")
+    others = scores[scores["model"] != baseline]
+    merged = others.merge(base, on=["table", "patient_id"], suffixes=("", "_baseline"))
+    deltas = merged[["model", "table", "patient_id"]].copy()
+    deltas.insert(1, "baseline", baseline)
+    for metric in METRICS:
+        deltas[f"delta_{metric}"] = merged[metric] - merged[f"{metric}_baseline"]
+    return deltas
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("files", nargs="*", help="result files named <table>_prose_<model>.txt / .jsonl")
+    parser.add_argument("--run", action="append", default=[], metavar="MODEL:TABLE=PATH",
+                        help="a result file with its model and table (repeatable)")
+    parser.add_argument("--reference", action="append", default=[], metavar="TABLE=PATH", required=True,
+                        help="ground-truth prose file of a table (repeatable)")
+    parser.add_argument("--baseline", default=None, help="model the deltas are taken against (default: the first)")
+    parser.add_argument("--common-patients", action="store_true",
+                        help="score every model of a table on the patients all of them have")
+    parser.add_argument("--limit", type=int, default=None, help="score only the first N patients per model and table")
+    parser.add_argument("--out-dir", default=".")
+    parser.add_argument("--bert-model", default=None, help="BERTScore model (default: bert_score's choice for English)")
+    parser.add_argument("--bert-batch-size", type=int, default=BERT_BATCH_SIZE)
+    parser.add_argument("--bert-cache", default=BERT_CACHE_DIR, help="reference embedding cache directory ('' to disable)")
+    parser.add_argument("--device", default=None, help="cuda / cpu (default: cuda when available)")
+    args = parser.parse_args()
+
+    try:
+        runs = [parse_run(item) for item in args.files + args.run]
+        references = parse_references(args.reference)
+    except ValueError as e:
+        parser.error(str(e))
+    if not runs:
+        parser.error("give at least one result file or --run")
+
+    bert = BertScoreEngine(
+        model_type=args.bert_model, batch_size=args.bert_batch_size, device=args.device, cache_dir=args.bert_cache
+    )
+    scores = compare_runs(runs, references, bert=bert, limit=args.limit, common_patients=args.common_patients)
+
+    baseline = args.baseline or runs[0][0]
+    matrix = model_matrix(scores)
+    deltas = patient_deltas(scores, baseline)
+
+    os.makedirs(args.out_dir, exist_ok=True)
+    for name, df in [("model_matrix", matrix), ("model_patients", scores), ("model_deltas", deltas)]:
+        df.to_csv(os.path.join(args.out_dir, f"{name}.csv"), index=False)
+
+    print("\n==== MODEL x TABLE ====")
+    print(matrix.pivot(index="model", columns="table", values=METRICS).round(4).to_string())
+
+    if len(deltas):
+        print(f"\n==== MEAN DELTA VS {baseline} ====")
+        print(deltas.groupby(["model", "table"])[[f"delta_{m}" for m in METRICS]].mean().round(4).to_string())
+
+    print(f"\nSaved model_matrix.csv, model_patients.csv and model_deltas.csv to {args.out_dir}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+from context_encodings import compact_record, encode
+
+
+# ======================
+# CONFIG
+# ======================
+
+# Used when neither the model config nor the tokenizer reports a usable window.
+DEFAULT_CONTEXT_WINDOW = 4096
+
+# Hard ceiling on prompt length regardless of what the model advertises.
+# Llama-3.1 reports a 128k window, but prompts that long OOM the GPU well before that.
+MAX_PROMPT_TOKENS = 8192
+
+# HF tokenizers report this kind of sentinel when model_max_length is not set.
+_UNSET_MAX_LENGTH = 10 ** 7
+
+
+# ======================
+# TOKEN COUNTING
+# ======================
+
+# Count prompt tokens with the model's own tokenizer.
+# Without a tokenizer (e.g. remote backends) fall back to the usual ~4 chars per token estimate.
+def count_tokens(tokenizer, text):
+    if tokenizer is None:
+        return len(text) // 4 + 1
+    return len(tokenizer(text, add_special_tokens=True)["input_ids"])
+
+
+def context_window(model=None, tokenizer=None, default=DEFAULT_CONTEXT_WINDOW):
+    candidates = []
+
+    config = getattr(model, "config", None)
+    for attr in ("max_position_embeddings", "n_positions", "max_sequence_length"):
+        value = getattr(config, attr, None)
+        if isinstance(value, int) and value > 0:
+            candidates.append(value)
+            break
+
+    tok_max = getattr(tokenizer, "model_max_length", None)
+    if isinstance(tok_max, int) and 0 < tok_max < _UNSET_MAX_LENGTH:
+        candidates.append(tok_max)
+
+    return min(candidates) if candidates else default
+
+
+# Tokens left for the prompt once the decode budget is reserved.
+def prompt_budget(window, max_new_tokens, cap=MAX_PROMPT_TOKENS):
+    return max(0, min(window - max_new_tokens, cap))
+
+
+# The fixed decode budget the multi-label event summaries had before it was scaled;
+# their paragraphs cover every label, so they never get less than this.
+EVENT_SUMMARY_MIN_NEW_TOKENS = 500
+
+
+# Scale the decode budget with the amount of content the model has to describe
+# (e.g. one paragraph per admission) instead of using one fixed max_new_tokens.
+def scale_max_new_tokens(n_units, base=128, per_unit=96, ceiling=1024, floor=0):
+    return max(base, floor, min(ceiling, base + per_unit * max(0, int(n_units))))
+
+
+# ======================
+# CONTEXT FITTING
+# ======================
+
+def fit_payload(payload, list_key, render_prompt, tokenizer, budget, order=None, encoding="json"):
+    """Serialize payload so render_prompt(context) fits in budget tokens.
+
+    Tries, in order: the payload as-is, a compressed form (null fields dropped,
+    tight separators), then keeps only the most important records of
+    payload[list_key]. order lists record indices from most to least important
+    (default: list order). Kept records stay in their original order and the
+    number of dropped records is recorded in the payload, so truncation is never silent.
+    encoding picks the serialization (see context_encodings.py).
+
+    Returns (context, info) where info has prompt_tokens, kept, dropped,
+    compressed and over_budget.
+    """
+    records = list(payload.get(list_key) or [])
+    info = {"prompt_tokens": 0, "kept": len(records), "dropped": 0, "compressed": False, "over_budget": False}
+
+    context = encode(payload, list_key, encoding)
+    info["prompt_tokens"] = count_tokens(tokenizer, render_prompt(context))
+    if info["prompt_tokens"] <= budget:
+        return context, info
+
+    info["compressed"] = True
+    compact = [compact_record(r) for r in records]
+    ranked = list(order) if order is not None else list(range(len(records)))
+
+    def render(k):
+        keep = sorted(ranked[:k])
+        body = {key: value for key, value in payload.items() if key != list_key}
+        body[list_key] = [compact[i] for i in keep]
+        if k < len(records):
+            body[f"omitted_{list_key}"] = len(records) - k
+        text = encode(body, list_key, encoding, compact=True)
+        return text, count_tokens(tokenizer, render_prompt(text))
+
+    context, n_tokens = render(len(records))
+    if n_tokens <= budget:
+        info["prompt_tokens"] = n_tokens
+        return context, info
+
+    # Largest prefix of the priority order that still fits (token count grows with k).
+    lo, hi = 0, len(records) - 1
+    best = None
+    while lo <= hi:
+        mid = (lo + hi) // 2
+        text, n = render(mid)
+        if n <= budget:
+            best = (mid, text, n)
+            lo = mid + 1
+        else:
+            hi = mid - 1
+
+    if best is None:
+        best = (0,) + render(0)
+        info["over_budget"] = True
+
+    k, context, n_tokens = best
+    info.update(prompt_tokens=n_tokens, kept=k, dropped=len(records) - k)
+    return context, info
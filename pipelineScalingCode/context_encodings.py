@@ -0,0 +1,191 @@
+"""
+Serializations of a patient payload ({"patient_id": ..., <list_key>: [records]}) for the summary prompt.
+
+    json     the payload as-is (what the MG scripts always sent)
+    compact  null fields dropped, record keys shortened, with a legend mapping short -> full key
+    table    one header line with the column names, then one "|"-separated line per record
+    delta    table, with timestamps written as offsets from the patient's first timestamp
+
+compact, table and delta write fields that are identical in every record only once.
+
+Pick one with CONTEXT_ENCODING=<name>; compare_encodings.py reports tokens per
+patient for each encoding and how the summaries score against the reference.
+"""
+
+import json
+
+import pandas as pd
+
+
+ENCODING_NAMES = ["json", "compact", "table", "delta"]
+
+# Columns treated as timestamps by the delta encoding.
+TIME_HINTS = ("time", "date", "start", "stop", "end")
+
+
+# ======================
+# HELPERS
+# ======================
+
+def compact_record(record):
+    if not isinstance(record, dict):
+        return record
+    return {k: v for k, v in record.items() if v is not None and v != "" and v != []}
+
+
+def _header(payload, list_key):
+    return {k: v for k, v in payload.items() if k != list_key}
+
+
+def _columns(records):
+    columns = []
+    for record in records:
+        for key, value in record.items():
+            if key not in columns and value is not None and value != "" and value != []:
+                columns.append(key)
+    return columns
+
+
+def _cell(value):
+    if value is None:
+        return ""
+    if isinstance(value, list):
+        return ";".join(_cell(v) for v in value)
+    if isinstance(value, dict):
+        return json.dumps(value, separators=(",", ":"))
+    return str(value).replace("|", "/").replace("\n", " ")
+
+
+# Fields with the same value in every record (insurance, race, units, ...) are
+# written once instead of on every row.
+def _split_shared(records, columns):
+    if len(records) < 2:
+        return {}, columns
+    shared = {}
+    for column in columns:
+        values = [r.get(column) for r in records]
+        if values[0] is not None and not isinstance(values[0], (list, dict)) and all(v == values[0] for v in values):
+            shared[column] = values[0]
+    return shared, [c for c in columns if c not in shared]
+
+
+# first_starttime -> fs, admittime -> adm; clashes get a numeric suffix.
+def _abbreviations(fields):
+    short = {}
+    used = set()
+    for field in fields:
+        parts = [part for part in field.split("_") if part]
+        base = "".join(part[0] for part in parts) if len(parts) > 1 else field[:3]
+        name, n = base, 2
+        while name in used:
+            name = f"{base}{n}"
+            n += 1
+        used.add(name)
+        short[field] = name
+    return short
+
+
+# ======================
+# ENCODINGS
+# ======================
+
+def encode_json(payload, list_key, compact=False):
+    if compact:
+        return json.dumps(payload, ensure_ascii=True, separators=(",", ":"))
+    return json.dumps(payload, ensure_ascii=True)
+
+
+def encode_compact(payload, list_key):
+    records = [compact_record(r) for r in payload.get(list_key) or []]
+    shared, columns = _split_shared(records, _columns(records))
+    short = _abbreviations(columns)
+
+    body = _header(payload, list_key)
+    if shared:
+        body["all_rows"] = shared
+    body["keys"] = {s: field for field, s in short.items()}
+    body[list_key] = [{short[k]: v for k, v in r.items() if k in short} for r in records]
+    return json.dumps(body, ensure_ascii=True, separators=(",", ":"))
+
+
+def _table_lines(records, columns):
+    lines = ["|".join(columns)]
+    for record in records:
+        lines.append("|".join(_cell(record.get(c)) for c in columns))
+    return lines
+
+
+def _shared_line(shared):
+    return ["all rows: " + ", ".join(f"{k}={_cell(v)}" for k, v in shared.items())] if shared else []
+
+
+def encode_table(payload, list_key):
+    records = payload.get(list_key) or []
+    shared, columns = _split_shared(records, _columns(records))
+
+    lines = [f"{k}: {_cell(v)}" for k, v in _header(payload, list_key).items()]
+    lines.extend(_shared_line(shared))
+    lines.append(f"{list_key} ({len(records)} rows, columns separated by |):")
+    lines.extend(_table_lines(records, columns))
+    return "\n".join(lines)
+
+
+def _offset(delta):
+    minutes = int(delta.total_seconds() // 60)
+    sign = "-" if minutes < 0 else "+"
+    minutes = abs(minutes)
+    days, rest = divmod(minutes, 24 * 60)
+    hours, mins = divmod(rest, 60)
+    text = "".join(f"{v}{u}" for v, u in ((days, "d"), (hours, "h"), (mins, "m")) if v)
+    return sign + (text or "0m")
+
+
+def encode_delta(payload, list_key):
+    records = payload.get(list_key) or []
+    shared, columns = _split_shared(records, _columns(records))
+
+    parsed = {}
+    for column in columns:
+        if not any(hint in column for hint in TIME_HINTS):
+            continue
+        values = pd.to_datetime(pd.Series([r.get(column) for r in records], dtype=object), errors="coerce")
+        if values.notna().any():
+            parsed[column] = values
+
+    if not parsed:
+        return encode_table(payload, list_key)
+
+    base = min(values.min() for values in parsed.values())
+    rows = []
+    for i, record in enumerate(records):
+        row = dict(record)
+        for column, values in parsed.items():
+            if pd.notna(values.iloc[i]):
+                row[column] = _offset(values.iloc[i] - base)
+        rows.append(row)
+
+    lines = [f"{k}: {_cell(v)}" for k, v in _header(payload, list_key).items()]
+    lines.extend(_shared_line(shared))
+    lines.append(f"time_base: {base}")
+    lines.append(f"{', '.join(parsed)} are offsets from time_base (d=days, h=hours, m=minutes)")
+    lines.append(f"{list_key} ({len(records)} rows, columns separated by |):")
+    lines.extend(_table_lines(rows, columns))
+    return "\n".join(lines)
+
+
+ENCODERS = {
+    "json": encode_json,
+    "compact": encode_compact,
+    "table": encode_table,
+    "delta": encode_delta,
+}
+
+
+# compact=True is the second step of fit_payload: only changes plain JSON,
+# the other encodings already drop nulls and repeated keys.
+def encode(payload, list_key, encoding="json", compact=False):
+    if encoding not in ENCODERS:
+        raise ValueError(f"Unknown context encoding {encoding!r}; choose from {ENCODING_NAMES}")
+    if encoding == "json":
+        return encode_json(payload, list_key, compact=compact)
+    return ENCODERS[encoding](payload, list_key)
@@ -0,0 +1,308 @@
+"""
+Persistent per-patient context store, so model comparisons only pay for generation.
+
+    # once: run the reference SQL, build every patient's context and save it
+    python context_store.py materialize --tables icustays admissions --store contexts.sqlite \\
+        --version v1 --tokenizer meta-llama/Llama-3.1-8B-Instruct
+
+    # per model: read the stored prompts and only generate summaries
+    GEN_BACKEND=hf python context_store.py run --table icustays --store contexts.sqlite \\
+        --version v1 --model google/gemma-3-1b-it --output icustays_prose_gemma1b.txt
+
+Rows are keyed on (subject_id, table, version). Each row holds the executed SQL
+and the fitted summary prompt, so every model run sees exactly the same input.
+Bump --version whenever context code, encoding or budget changes. Patients that
+need a hierarchical (map-reduce) summary are stored with their rows and are
+chunked at run time, because the chunk summaries depend on the model.
+"""
+
+import argparse
+import importlib
+import os
+import pickle
+import sqlite3
+import sys
+import time
+
+import pandas as pd
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from context_budget import DEFAULT_CONTEXT_WINDOW, count_tokens
+
+
+# Patients written (and committed) per put_many while materializing, so a crash
+# midway keeps what was built and pickled DataFrames are not all held in memory.
+STORE_BATCH_SIZE = 500
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS contexts (
+    subject_id INTEGER NOT NULL,
+    table_name TEXT NOT NULL,
+    version TEXT NOT NULL,
+    sql TEXT,
+    rows BLOB,
+    summary_prompt TEXT,
+    max_new_tokens INTEGER,
+    hierarchical INTEGER DEFAULT 0,
+    error TEXT,
+    PRIMARY KEY (subject_id, table_name, version)
+);
+CREATE TABLE IF NOT EXISTS versions (
+    table_name TEXT NOT NULL,
+    version TEXT NOT NULL,
+    encoding TEXT,
+    tokenizer TEXT,
+    context_window INTEGER,
+    created REAL,
+    PRIMARY KEY (table_name, version)
+);
+"""
+
+
+# Stands in for a backend while contexts are built: build_patient_context only
+# needs the tokenizer and the context window to fit the payload.
+class TokenBudget:
+    def __init__(self, tokenizer=None, context_window=DEFAULT_CONTEXT_WINDOW, model_name="context-store"):
+        self.tokenizer = tokenizer
+        self.context_window = context_window
+        self.model_name = model_name
+        self.max_new_tokens = 0
+
+    def count_tokens(self, text):
+        return count_tokens(self.tokenizer, text)
+
+
+# ======================
+# STORE
+# ======================
+
+class ContextStore:
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.executescript(SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def save_version(self, table, version, encoding, tokenizer_name, context_window):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO versions VALUES (?, ?, ?, ?, ?, ?)",
+            (table, version, encoding, tokenizer_name, context_window, time.time()),
+        )
+        self.conn.commit()
+
+    def version_info(self, table, version):
+        row = self.conn.execute(
+            "SELECT encoding, tokenizer, context_window FROM versions WHERE table_name = ? AND version = ?",
+            (table, version),
+        ).fetchone()
+        if row is None:
+            return None
+        return {"encoding": row[0], "tokenizer": row[1], "context_window": row[2]}
+
+    def put_many(self, table, version, entries):
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO contexts VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            [
+                (
+                    int(e["subject_id"]), table, version, e.get("sql"),
+                    pickle.dumps(e["rows"]) if e.get("rows") is not None else None,
+                    e.get("summary_prompt"), e.get("max_new_tokens"),
+                    int(bool(e.get("hierarchical"))), e.get("error"),
+                )
+                for e in entries
+            ],
+        )
+        self.conn.commit()
+
+    # Entries in subject order; rows are only unpickled for hierarchical patients.
+    def entries(self, table, version):
+        cursor = self.conn.execute(
+            "SELECT subject_id, sql, rows, summary_prompt, max_new_tokens, hierarchical, error "
+            "FROM contexts WHERE table_name = ? AND version = ? ORDER BY rowid",
+            (table, version),
+        )
+        for subject_id, sql, rows, summary_prompt, max_new_tokens, hierarchical, error in cursor:
+            yield {
+                "subject_id": subject_id,
+                "sql": sql,
+                "rows": pickle.loads(rows) if hierarchical and rows is not None else None,
+                "summary_prompt": summary_prompt,
+                "max_new_tokens": max_new_tokens,
+                "hierarchical": bool(hierarchical),
+                "error": error,
+            }
+
+
+# ======================
+# MATERIALIZE
+# ======================
+
+def materialize_table(pipeline, module, store, version, budget):
+    from hierarchical_summary import use_hierarchical
+    from table_pipeline import load_tables, prepare_summary, reference_sql
+
+    conn = sqlite3.connect(":memory:")
+    subject_ids = load_tables(pipeline, conn)
+
+    entries = []
+    stored = 0
+    start = time.perf_counter()
+    for subject_id in subject_ids:
+        entry = {"subject_id": subject_id}
+        try:
+            entry["sql"] = reference_sql(pipeline, subject_id)
+            result_df = pd.read_sql_query(entry["sql"], conn)
+
+            if use_hierarchical(pipeline, result_df):
+                entry.update(hierarchical=True, rows=result_df)
+            else:
+                summary_prompt, max_new_tokens = prepare_summary(pipeline, budget, subject_id, result_df)
+                entry.update(summary_prompt=summary_prompt, max_new_tokens=max_new_tokens)
+        except Exception as e:
+            entry["error"] = str(e)
+            print(f"Failed for patient {subject_id}: {e}")
+        entries.append(entry)
+        if len(entries) >= STORE_BATCH_SIZE:
+            store.put_many(pipeline.table, version, entries)
+            stored += len(entries)
+            entries = []
+    conn.close()
+
+    store.put_many(pipeline.table, version, entries)
+    stored += len(entries)
+    store.save_version(
+        pipeline.table, version,
+        getattr(module, "CONTEXT_ENCODING", None),
+        getattr(budget.tokenizer, "name_or_path", None),
+        budget.context_window,
+    )
+    print(f"[{pipeline.table}] Stored {stored} contexts as {version!r} in {time.perf_counter() - start:.1f}s")
+
+
+# ======================
+# RUN FROM STORE
+# ======================
+
+# Generation only: every stored summary prompt goes through the batching scheduler.
+# Output uses the usual prose format; SQL PROMPT/RAW SQL OUTPUT note the store instead.
+def run_from_store(pipeline, backend, store, version, output_file, batch_size=8):
+    from hierarchical_summary import HierarchicalSummary, chunk_cache
+    from job_scheduler import GenerationJob, ContinuousBatchScheduler
+    from run_all_tables import OrderedTableWriter
+    from table_pipeline import note_generation
+
+    info = store.version_info(pipeline.table, version)
+    if info is None:
+        raise ValueError(f"No stored contexts for {pipeline.table!r} version {version!r} in {store.path}")
+    if info["context_window"] and backend.context_window < info["context_window"]:
+        print(f"Warning: contexts were fitted to {info['context_window']} tokens, "
+              f"{backend.model_name} has {backend.context_window}")
+
+    entries = list(store.entries(pipeline.table, version))
+    pipeline.output_file = output_file
+    pipeline.sql_file = os.path.splitext(output_file)[0] + ".sql"
+
+    scheduler = ContinuousBatchScheduler(backend, max_batch_size=batch_size)
+    writer = OrderedTableWriter(pipeline, [e["subject_id"] for e in entries], backend.model_name)
+    cache = chunk_cache(pipeline, backend)
+
+    for position, entry in enumerate(entries):
+        record = {
+            "subject_id": entry["subject_id"],
+            "sql_prompt": f"(context store {os.path.basename(store.path)}, version {version})",
+            "raw_sql": "",
+            "sql": entry["sql"] or "",
+        }
+
+        def fail(error, record=record, position=position):
+            # Several chunk jobs of one patient can fail; report the patient once.
+            if record.get("failed"):
+                return
+            record["failed"] = True
+            writer.patient_ready(position, ("error", error))
+
+        def on_summary(result, record=record, position=position):
+            if record.get("failed"):
+                return
+            note_generation(record, "summary", result)
+            record["summary"] = result.text.strip()
+            writer.patient_ready(position, ("ok", record))
+
+        def submit_summary(summary_prompt, max_new_tokens, record=record, on_summary=on_summary, fail=fail):
+            record["summary_prompt"] = summary_prompt
+            scheduler.submit(GenerationJob(summary_prompt, max_new_tokens, on_summary, fail))
+
+        def submit_text(prompt, max_new_tokens, on_done, on_error):
+            scheduler.submit(GenerationJob(prompt, max_new_tokens, lambda result: on_done(result.text), on_error))
+
+        writer.sql_ready(position, entry["sql"])
+        if entry["error"]:
+            fail(RuntimeError(entry["error"]))
+        elif entry["hierarchical"]:
+            HierarchicalSummary(pipeline, backend, cache, entry["subject_id"], entry["rows"],
+                                submit_text, submit_summary, fail).start()
+        else:
+            submit_summary(entry["summary_prompt"], entry["max_new_tokens"])
+
+    try:
+        scheduler.run()
+    finally:
+        writer.close()
+
+    print(f"Generation metrics: {backend.metrics.summary()}")
+    print("Finished everything.")
+
+
+# ======================
+# MAIN
+# ======================
+
+def main():
+    from run_all_tables import TABLE_MODULES, MODEL_NAME
+
+    parser = argparse.ArgumentParser()
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    mat = sub.add_parser("materialize")
+    mat.add_argument("--tables", nargs="+", default=list(TABLE_MODULES), choices=list(TABLE_MODULES))
+    mat.add_argument("--store", default="contexts.sqlite")
+    mat.add_argument("--version", default="v1")
+    mat.add_argument("--tokenizer", default=None, help="tokenizer used to fit contexts (default: ~4 chars/token)")
+    mat.add_argument("--context-window", type=int, default=DEFAULT_CONTEXT_WINDOW,
+                     help="fit contexts for the smallest window among the models to compare")
+
+    run = sub.add_parser("run")
+    run.add_argument("--table", required=True, choices=list(TABLE_MODULES))
+    run.add_argument("--store", default="contexts.sqlite")
+    run.add_argument("--version", default="v1")
+    run.add_argument("--model", default=MODEL_NAME)
+    run.add_argument("--output", required=True)
+    run.add_argument("--batch-size", type=int, default=8)
+
+    args = parser.parse_args()
+    store = ContextStore(args.store)
+
+    if args.command == "materialize":
+        tokenizer = None
+        if args.tokenizer:
+            from transformers import AutoTokenizer
+            tokenizer = AutoTokenizer.from_pretrained(args.tokenizer, token=os.getenv("HF_TOKEN"))
+        budget = TokenBudget(tokenizer, args.context_window)
+
+        for table in args.tables:
+            module = importlib.import_module(TABLE_MODULES[table])
+            materialize_table(module.PIPELINE, module, store, args.version, budget)
+    else:
+        from generation_backends import backend_from_env
+        module = importlib.import_module(TABLE_MODULES[args.table])
+        backend = backend_from_env(args.model, max_new_tokens=500, token=os.getenv("HF_TOKEN"))
+        run_from_store(module.PIPELINE, backend, store, args.version, args.output, batch_size=args.batch_size)
+
+    store.close()
+
+
+if __name__ == "__main__":
+    main()
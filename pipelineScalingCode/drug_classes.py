@@ -0,0 +1,301 @@
+"""
+Drug name normalization and therapeutic-class matching for prescriptions.
+
+    matcher = DrugClassMatcher.from_file("drug_classes.csv")   # columns: drug, drug_class
+    matched = matcher.classify(df["drug"])                     # normalized name + class per row
+    class_rollup(df.join(matched))                             # one record per class
+
+Names are tokenized before matching: lowercase, strengths ("40 mg", "0.9%") and
+dosage-form tokens ("tablet", "er") dropped, separators ("-", "/", parentheses)
+turned into spaces. Every name in the mapping is inserted into a word-level
+Aho-Corasick automaton both as is and without its counter-ion, so one scan over a
+prescription finds every known name in it ("Lasix (furosemide) 40 mg tab" ->
+furosemide; "albuterol-ipratropium" -> the combination, not the parts). The scan
+runs on the drug's tokens as written, and on the normalized name only when that
+finds nothing.
+
+The normalized name drops a salt or cation token only as the counter-ion of a drug
+("metoprolol tartrate" -> metoprolol, "docusate sodium" -> docusate); where the ion
+is the drug it stays ("potassium chloride", "magnesium sulfate", "calcium gluconate").
+
+classify() scans each distinct drug string once (results are cached on the matcher),
+then maps the results back onto the rows, so a cohort with millions of orders but
+a few thousand distinct drug strings costs a few thousand scans.
+
+Without a mapping file the matcher uses DEFAULT_DRUG_CLASSES (the map from the old
+ollama pipeline); set DRUG_CLASS_FILE to a larger local CSV.
+"""
+
+import os
+import re
+from collections import deque
+
+import pandas as pd
+
+
+DEFAULT_DRUG_CLASSES = {
+    # antibiotics
+    "cefepime": "antibiotic",
+    "vancomycin": "antibiotic",
+    "meropenem": "antibiotic",
+    "ceftriaxone": "antibiotic",
+    "levofloxacin": "antibiotic",
+    # cardiovascular
+    "metoprolol tartrate": "beta-blocker",
+    "amiodarone": "antiarrhythmic",
+    "heparin": "anticoagulant",
+    "simvastatin": "statin",
+    "lisinopril": "ace inhibitor",
+    "potassium chloride": "electrolyte",
+    "sodium chloride": "electrolyte",
+    "magnesium sulfate": "electrolyte",
+    "calcium gluconate": "electrolyte",
+    "sodium bicarbonate": "electrolyte",
+    "furosemide": "loop diuretic",
+    # psychiatric / neuro
+    "doxepin hcl": "antidepressant (TCA)",
+    "paroxetine": "antidepressant (SSRI)",
+    "lorazepam": "benzodiazepine",
+    "propofol": "sedative/anesthetic",
+    # gi
+    "famotidine": "h2 blocker",
+    "docusate sodium": "stool softener",
+    "bisacodyl": "laxative",
+    "calcium carbonate": "antacid/supplement",
+    # respiratory
+    "tiotropium bromide": "bronchodilator (anticholinergic)",
+    "albuterol-ipratropium": "bronchodilator combination",
+    # supplements
+    "cyanocobalamin": "vitamin (B12)",
+    # misc
+    "ibuprofen": "nsaid",
+    "alendronate sodium": "bisphosphonate",
+    "senna": "laxative",
+    "maalox/diphenhydramine/lidocaine": "gi cocktail",
+}
+
+UNKNOWN_CLASS = "unclassified"
+
+
+# ======================
+# NORMALIZATION
+# ======================
+
+STRENGTH_RE = re.compile(
+    r"\b\d+(?:[.,]\d+)?\s*(?:%|(?:mg|mcg|g|gm|kg|ml|l|meq|mmol|units?|iu)\b)?"
+    r"(?:\s*/\s*\d*\s*(?:ml|l|hr|h|dose|actuation)\b)?"
+)
+SEPARATOR_RE = re.compile(r"[^a-z0-9]+")
+
+# Counter-ions, dropped only right after a drug token ("metoprolol tartrate", "docusate
+# sodium"); after another ion they are part of the drug ("potassium chloride").
+SALT_TOKENS = {
+    "hcl", "hydrochloride", "hydrobromide",
+    "sulfate", "sulphate", "tartrate", "succinate", "maleate", "mesylate", "besylate",
+    "citrate", "acetate", "phosphate", "chloride", "bromide", "fumarate", "dihydrate",
+    "monohydrate", "anhydrous",
+}
+CATION_TOKENS = {"sodium", "potassium", "calcium", "magnesium"}
+ION_TOKENS = SALT_TOKENS | CATION_TOKENS
+FORM_TOKENS = {
+    "tab", "tabs", "tablet", "tablets", "cap", "caps", "capsule", "capsules", "er", "sr", "xl",
+    "xr", "cr", "dr", "ec", "odt", "oral", "soln", "solution", "susp", "suspension", "inj",
+    "injection", "iv", "po", "vial", "bag", "syringe", "premix", "liquid", "cream", "ointment",
+    "patch", "neb", "inh", "inhaler", "drops", "chewable", "extended", "release", "delayed",
+    "in", "ns", "d5w", "sw", "iso", "osmotic", "pf", "ud",
+    "mg", "mcg", "ml", "meq", "unit", "units",
+}
+
+
+def _tokens(name):
+    text = STRENGTH_RE.sub(" ", str(name).lower())
+    return [token for token in SEPARATOR_RE.split(text) if token and not token.isdigit()]
+
+
+def form_tokens(name):
+    return tuple(token for token in _tokens(name) if token not in FORM_TOKENS)
+
+
+def _strip_salts(tokens):
+    kept = []
+    for token in tokens:
+        if token in ION_TOKENS and kept and kept[-1] not in ION_TOKENS:
+            continue
+        kept.append(token)
+    return tuple(kept)
+
+
+def normalize_tokens(name):
+    return _strip_salts(form_tokens(name))
+
+
+def normalize_drug_name(name):
+    if name is None or pd.isna(name):
+        return None
+    return " ".join(normalize_tokens(name)) or None
+
+
+# ======================
+# AHO-CORASICK INDEX
+# ======================
+
+class _Automaton:
+    """Word-level Aho-Corasick automaton: patterns are token tuples."""
+
+    def __init__(self):
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [[]]  # (pattern length, value) ending at this state
+
+    def add(self, tokens, value):
+        state = 0
+        for token in tokens:
+            if token not in self.goto[state]:
+                self.goto.append({})
+                self.fail.append(0)
+                self.output.append([])
+                self.goto[state][token] = len(self.goto) - 1
+            state = self.goto[state][token]
+        self.output[state].append((len(tokens), value))
+
+    # Breadth-first failure links; children of the root keep fail = 0.
+    def build(self):
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for token, child in self.goto[state].items():
+                queue.append(child)
+                fallback = self.fail[state]
+                while fallback and token not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[child] = self.goto[fallback].get(token, 0)
+                self.output[child] = self.output[child] + self.output[self.fail[child]]
+
+    # Every match as (start token, end token, value).
+    def scan(self, tokens):
+        state = 0
+        matches = []
+        for end, token in enumerate(tokens, 1):
+            while state and token not in self.goto[state]:
+                state = self.fail[state]
+            state = self.goto[state].get(token, 0)
+            for length, value in self.output[state]:
+                matches.append((end - length, end, value))
+        return matches
+
+
+# Leftmost-longest, non-overlapping matches in token order.
+def _select(matches):
+    matches.sort(key=lambda m: (m[0], -(m[1] - m[0])))
+    chosen, covered = [], 0
+    for start, end, value in matches:
+        if start >= covered:
+            chosen.append(value)
+            covered = end
+    return chosen
+
+
+# ======================
+# MATCHER
+# ======================
+
+class DrugClassMatcher:
+    def __init__(self, mapping):
+        # mapping: {drug name: class}; each name is indexed as written and normalized.
+        self.automaton = _Automaton()
+        for name, drug_class in mapping.items():
+            raw = form_tokens(name)
+            tokens = _strip_salts(raw)
+            if tokens and drug_class:
+                value = (" ".join(tokens), str(drug_class).strip())
+                for variant in {raw, tokens}:
+                    self.automaton.add(variant, value)
+        self.automaton.build()
+        self.cache = {}
+
+    @classmethod
+    def from_file(cls, path=None, drug_col="drug", class_col="drug_class"):
+        path = path or os.getenv("DRUG_CLASS_FILE")
+        mapping = dict(DEFAULT_DRUG_CLASSES)
+        if path:
+            df = pd.read_csv(path, usecols=[drug_col, class_col]).dropna()
+            mapping.update(zip(df[drug_col].astype(str), df[class_col].astype(str)))
+            print(f"Loaded {len(df)} drug classes from {path}")
+        return cls(mapping)
+
+    # (normalized name, [class, ...], [matched name, ...]) for one raw drug string.
+    def match(self, drug):
+        if drug in self.cache:
+            return self.cache[drug]
+        raw = form_tokens(drug) if drug is not None and not pd.isna(drug) else ()
+        tokens = _strip_salts(raw)
+        found = _select(self.automaton.scan(raw)) if raw else []
+        if not found and tokens != raw:
+            found = _select(self.automaton.scan(tokens))
+        classes = list(dict.fromkeys(drug_class for _, drug_class in found))
+        names = list(dict.fromkeys(name for name, _ in found))
+        result = (" ".join(tokens) or None, classes, names)
+        self.cache[drug] = result
+        return result
+
+    # One row per input row: drug_norm, drug_match (the known names found) and
+    # drug_class ("a; b" for several matches, UNKNOWN_CLASS if none).
+    def classify(self, drugs):
+        drugs = pd.Series(drugs)
+        codes, uniques = pd.factorize(drugs, use_na_sentinel=True)
+        results = [self.match(drug) for drug in uniques]
+
+        # codes are -1 for missing drugs: take() picks the trailing entry.
+        columns = {
+            "drug_norm": [r[0] for r in results] + [None],
+            "drug_match": ["; ".join(r[2]) or None for r in results] + [None],
+            "drug_class": ["; ".join(r[1]) or UNKNOWN_CLASS for r in results] + [UNKNOWN_CLASS],
+        }
+        return pd.DataFrame(
+            {name: pd.Series(values, dtype=object).take(codes).to_numpy() for name, values in columns.items()},
+            index=drugs.index,
+        )
+
+
+_DEFAULT = None
+
+
+def default_matcher():
+    global _DEFAULT
+    if _DEFAULT is None:
+        _DEFAULT = DrugClassMatcher.from_file()
+    return _DEFAULT
+
+
+# ======================
+# ROLLUP
+# ======================
+
+# One record per therapeutic class, most ordered first: drugs, routes, order count, time range.
+# df needs the classify() columns plus the prescriptions columns.
+def class_rollup(df, time_col="starttime", stop_col="stoptime"):
+    if df.empty:
+        return []
+    df = df.assign(drug_norm=df["drug_match"].fillna(df["drug_norm"]))
+    if time_col in df.columns:
+        df = df.sort_values(time_col, kind="mergesort")
+
+    aggs = {
+        "orders": ("drug_class", "size"),
+        "drugs": ("drug_norm", lambda s: list(dict.fromkeys(s.dropna()))),
+    }
+    if "route" in df.columns:
+        aggs["routes"] = ("route", lambda s: list(dict.fromkeys(s.dropna().astype(str))))
+    if time_col in df.columns:
+        aggs["first_start"] = (time_col, "min")
+    if stop_col in df.columns:
+        aggs["last_stop"] = (stop_col, "max")
+
+    rollup = df.groupby("drug_class", sort=False).agg(**aggs).reset_index()
+    rollup = rollup.sort_values("orders", ascending=False, kind="mergesort")
+    records = rollup.to_dict("records")
+    for record in records:
+        for key in ("first_start", "last_stop"):
+            if key in record and pd.isna(record[key]):
+                record[key] = None
+    return records
@@ -0,0 +1,251 @@
+"""
+Batch scoring engines used by evaluation.py.
+
+    engine = BertScoreEngine()                  # loads the scoring model once
+    p, r, f1 = engine.score(predictions, references)
+
+    rouge = RougeStage(references)              # {patient id: text}; tokenized + stemmed once
+    rouge.score(predictions)                    # {patient id: {"rouge1": f, "rouge2": f, "rougeL": f}}
+    rouge.close()
+
+evaluation.py used to call bert_score.score([pred], [ref]) per patient, which loaded
+the model again for every patient and ran batches of one. The engine keeps one
+BERTScorer for the whole run (and across tables/encodings when passed around) and
+scores every pair in a single call, sorted longest first so each batch holds texts of
+similar length and padding stays small. On CPU torch uses every core.
+
+The reference summaries are the same for every model that is evaluated, so their
+token embeddings are cached on disk (BERT_CACHE_DIR, one file per reference under a
+directory for the scoring model and layer, keyed by a hash of the text as scored) and
+only candidates go through the model; precision/recall/F1 are then the greedy cosine
+matching bert_score does itself. BERT_CACHE_DIR= (empty) turns the cache off and
+scores with BERTScorer.score.
+
+RougeScorer.score re-tokenizes and re-stems the reference for every candidate. The
+stage does that once per reference (keeping its tokens and 1-/2-gram counters) and
+then only tokenizes candidates; pairs are scored in a process pool (ROUGE_PROCESSES,
+default all cores), since the LCS for rougeL is pure Python. Scores are the same as
+RougeScorer(["rouge1", "rouge2", "rougeL"], use_stemmer=True) F-measures.
+"""
+
+import hashlib
+import os
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+
+
+BERT_BATCH_SIZE = int(os.getenv("BERT_BATCH_SIZE", "16"))
+BERT_CACHE_DIR = os.getenv("BERT_CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "bert_cache"))
+ROUGE_PROCESSES = int(os.getenv("ROUGE_PROCESSES", str(os.cpu_count() or 1)))
+
+ROUGE_TYPES = ["rouge1", "rouge2", "rougeL"]
+
+
+# ======================
+# BERTSCORE
+# ======================
+
+class ReferenceCache:
+    # {text hash: (token embeddings, idf weights)} of one scoring model, one .pt file each.
+    def __init__(self, cache_dir, model_key):
+        self.dir = os.path.join(cache_dir, model_key)
+        os.makedirs(self.dir, exist_ok=True)
+
+    @staticmethod
+    def key(text):
+        # bert_score strips each sentence before tokenizing it.
+        return hashlib.sha256(text.strip().encode("utf-8")).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.dir, key + ".pt")
+
+    def get(self, key):
+        import torch
+        path = self._path(key)
+        if not os.path.exists(path):
+            return None
+        try:
+            stats = torch.load(path, map_location="cpu")
+        except Exception:
+            # A damaged entry is embedded again and overwritten.
+            return None
+        return stats["embedding"], stats["idf"]
+
+    def put(self, key, embedding, idf):
+        import torch
+        tmp = self._path(key) + f".{os.getpid()}.tmp"
+        torch.save({"embedding": embedding, "idf": idf}, tmp)
+        os.replace(tmp, self._path(key))
+
+
+class BertScoreEngine:
+    def __init__(self, model_type=None, lang="en", batch_size=BERT_BATCH_SIZE, device=None, cache_dir=BERT_CACHE_DIR):
+        import torch
+        from bert_score import BERTScorer
+
+        if device is None:
+            device = "cuda" if torch.cuda.is_available() else "cpu"
+        if device == "cpu":
+            torch.set_num_threads(os.cpu_count() or 1)
+
+        self.batch_size = batch_size
+        self.device = device
+        self.scorer = BERTScorer(model_type=model_type, lang=lang, batch_size=batch_size, device=device)
+        print(f"BERTScore model: {self.scorer.model_type} on {device}")
+
+        self.cache = None
+        if cache_dir:
+            model_key = f"{self.scorer.model_type.replace('/', '--')}-L{self.scorer.num_layers}"
+            self.cache = ReferenceCache(cache_dir, model_key)
+
+    # (precision, recall, f1) lists in input order.
+    def score(self, candidates, references):
+        if not candidates:
+            return [], [], []
+        order = sorted(range(len(candidates)), key=lambda i: len(candidates[i]) + len(references[i]), reverse=True)
+        if self.cache is None:
+            P, R, F1 = self.scorer.score(
+                [candidates[i] for i in order],
+                [references[i] for i in order],
+                batch_size=self.batch_size,
+            )
+        else:
+            P, R, F1 = self._score_cached([candidates[i] for i in order], [references[i] for i in order])
+        out = [[0.0] * len(order) for _ in range(3)]
+        for values, column in zip((P.tolist(), R.tolist(), F1.tolist()), out):
+            for position, i in enumerate(order):
+                column[i] = values[position]
+        return tuple(out)
+
+    # ======================
+    # CACHED REFERENCES
+    # ======================
+
+    # {text: (embedding, idf)} for each distinct text, trimmed to its tokens, on the CPU.
+    def _embed(self, texts):
+        import torch
+        from bert_score.utils import get_bert_embedding
+
+        # Unit idf weights with [CLS]/[SEP] at zero, as BERTScorer.score(idf=False).
+        tokenizer = self.scorer._tokenizer
+        idf_dict = defaultdict(lambda: 1.0)
+        idf_dict[tokenizer.sep_token_id] = 0
+        idf_dict[tokenizer.cls_token_id] = 0
+
+        texts = sorted(set(texts), key=lambda text: len(text.split(" ")), reverse=True)
+        stats = {}
+        with torch.no_grad():
+            for start in range(0, len(texts), self.batch_size):
+                batch = texts[start:start + self.batch_size]
+                embedding, mask, idf = get_bert_embedding(
+                    batch, self.scorer._model, tokenizer, idf_dict, device=self.device
+                )
+                for i, text in enumerate(batch):
+                    length = int(mask[i].sum())
+                    stats[text] = (embedding[i, :length].cpu(), idf[i, :length].cpu())
+        return stats
+
+    def _reference_stats(self, references):
+        stats, missing = {}, []
+        for text in set(references):
+            cached = self.cache.get(ReferenceCache.key(text))
+            if cached is None:
+                missing.append(text)
+            else:
+                stats[text] = cached
+        cached = len(stats)
+        for text, (embedding, idf) in self._embed(missing).items():
+            self.cache.put(ReferenceCache.key(text), embedding, idf)
+            stats[text] = (embedding, idf)
+        print(f"BERTScore reference cache: {cached} cached, {len(missing)} embedded")
+        return stats
+
+    def _score_cached(self, candidates, references):
+        import torch
+        from bert_score.utils import greedy_cos_idf
+        from torch.nn.utils.rnn import pad_sequence
+
+        ref_stats = self._reference_stats(references)
+        cand_stats = self._embed(candidates)
+
+        def padded(items):
+            embeddings, idfs = zip(*items)
+            lengths = torch.tensor([len(e) for e in embeddings])
+            mask = torch.arange(int(lengths.max())).expand(len(lengths), -1) < lengths.unsqueeze(1)
+            return (
+                pad_sequence(embeddings, batch_first=True, padding_value=2.0).to(self.device),
+                mask.to(self.device),
+                pad_sequence(idfs, batch_first=True).float().to(self.device),
+            )
+
+        P, R, F1 = [], [], []
+        with torch.no_grad():
+            for start in range(0, len(candidates), self.batch_size):
+                end = start + self.batch_size
+                ref = padded([ref_stats[text] for text in references[start:end]])
+                hyp = padded([cand_stats[text] for text in candidates[start:end]])
+                p, r, f = greedy_cos_idf(*ref, *hyp)
+                P.append(p.cpu())
+                R.append(r.cpu())
+                F1.append(f.cpu())
+        return torch.cat(P), torch.cat(R), torch.cat(F1)
+
+
+# ======================
+# ROUGE
+# ======================
+
+_TOKENIZER = None
+
+
+# The tokenizer RougeScorer uses with use_stemmer=True, once per process.
+def _tokenize(text):
+    global _TOKENIZER
+    if _TOKENIZER is None:
+        from rouge_score import rouge_scorer
+        _TOKENIZER = rouge_scorer.RougeScorer(ROUGE_TYPES, use_stemmer=True)._tokenizer
+    return _TOKENIZER.tokenize(text)
+
+
+# (tokens, unigram counter, bigram counter) of a reference.
+def _prepare_reference(text):
+    from rouge_score.rouge_scorer import _create_ngrams
+    tokens = _tokenize(text)
+    return tokens, _create_ngrams(tokens, 1), _create_ngrams(tokens, 2)
+
+
+def _score_pair(job):
+    from rouge_score.rouge_scorer import _create_ngrams, _score_lcs, _score_ngrams
+    (ref_tokens, ref_unigrams, ref_bigrams), prediction = job
+    tokens = _tokenize(prediction)
+    return {
+        "rouge1": _score_ngrams(ref_unigrams, _create_ngrams(tokens, 1)).fmeasure,
+        "rouge2": _score_ngrams(ref_bigrams, _create_ngrams(tokens, 2)).fmeasure,
+        "rougeL": _score_lcs(ref_tokens, tokens).fmeasure,
+    }
+
+
+class RougeStage:
+    # references: {patient id: normalized reference text}; keep one stage for every
+    # candidate file scored against the same references.
+    def __init__(self, references, processes=None):
+        self.processes = processes or ROUGE_PROCESSES
+        self.pool = ProcessPoolExecutor(self.processes) if self.processes > 1 else None
+        keys = list(references)
+        self.references = dict(zip(keys, self._map(_prepare_reference, [references[k] for k in keys])))
+
+    def _map(self, fn, items):
+        if self.pool is None or len(items) < 2:
+            return [fn(item) for item in items]
+        chunksize = max(1, len(items) // (self.processes * 4))
+        return list(self.pool.map(fn, items, chunksize=chunksize))
+
+    # {patient id: {rouge type: F-measure}} for the predictions that have a reference.
+    def score(self, predictions):
+        keys = [key for key in predictions if key in self.references]
+        scores = self._map(_score_pair, [(self.references[key], predictions[key]) for key in keys])
+        return dict(zip(keys, scores))
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
@@ -1,8 +1,14 @@
+import argparse
 import re
 import numpy as np
 import pandas as pd
-from rouge_score import rouge_scorer
-from bert_score import score
+
+from eval_scores import BERT_BATCH_SIZE, BERT_CACHE_DIR, BertScoreEngine, RougeStage
+from prose_index import ProseIndex
+from run_records import run_summaries
+
+LLM_FILE = "/Users/sanafatima/Desktop/ehr_summarization_BioMibLab-main/pipelineScalingCode/admissions_proseLLM.txt"
+MANUAL_FILE = "/Users/sanafatima/Desktop/ehr_summarization_BioMibLab-main/pipelineScalingCode/admissions_proseM.txt"
 
 def normalize_text(text):
 
@@ -14,19 +20,6 @@ def normalize_text(text):
 
     return text
 
-print("Starting per-patient evaluation...")
-
-# -----------------------------
-# Load files
-# -----------------------------
-with open("/Users/sanafatima/Desktop/ehr_summarization_BioMibLab-main/pipelineScalingCode/admissions_proseLLM.txt") as f:
-    llm_text = f.read()
-
-with open("/Users/sanafatima/Desktop/ehr_summarization_BioMibLab-main/pipelineScalingCode/admissions_proseM.txt") as f:
-    manual_text = f.read()
-
-print("Files loaded")
-
 # -----------------------------
 # Split summaries by patient
 # -----------------------------
@@ -42,83 +35,116 @@ def split_patients(text):
 
     return patients
 
-
-llm_patients = split_patients(llm_text)
-manual_patients = split_patients(manual_text)
-
-print("LLM patients:", len(llm_patients))
-print("Manual patients:", len(manual_patients))
-
 # -----------------------------
-# Match patient IDs
+# Load a result file by patient
 # -----------------------------
-common_patients = set(llm_patients.keys()).intersection(manual_patients.keys())
-common_patients = sorted(common_patients)[:5]
-
-print("Matched patients:", len(common_patients))
+# Run records (.jsonl) and MG prose files give the model's summaries; any other prose
+# file (ground truth) gives each patient's lines. Prose files are read through an
+# offset index (prose_index.py) instead of split_patients.
+def load_patients(path):
+    if path.endswith((".jsonl", ".jsonl.gz", ".jsonl.zst")):
+        return run_summaries(path)
+    index = ProseIndex(path)
+    if index.kind == "prose":
+        return index.summaries()
+    return index
 
 # -----------------------------
-# Initialize metrics
+# Evaluate each patient
 # -----------------------------
-scorer = rouge_scorer.RougeScorer(
-    ['rouge1','rouge2','rougeL'],
-    use_stemmer=True
-)
-
-results = []
+# llm_patients / manual_patients map patient id -> summary text (see split_patients).
+# bert / rouge: a BertScoreEngine and a RougeStage (over manual_patients, normalized)
+# to reuse across calls; built for this call otherwise.
+def evaluate_patients(llm_patients, manual_patients, limit=None, bert=None, rouge=None):
+
+    common_patients = set(llm_patients.keys()).intersection(manual_patients.keys())
+    common_patients = sorted(common_patients)[:limit]
+
+    print("Matched patients:", len(common_patients))
+
+    refs = [normalize_text(manual_patients[pid]) for pid in common_patients]
+    preds = [normalize_text(llm_patients[pid]) for pid in common_patients]
+
+    # References are tokenized and stemmed once; pairs are scored in a process pool.
+    own_rouge = rouge is None
+    if own_rouge:
+        rouge = RougeStage(dict(zip(common_patients, refs)))
+    try:
+        rouge_scores = rouge.score(dict(zip(common_patients, preds)))
+    finally:
+        if own_rouge:
+            rouge.close()
+    rouge_scores = [rouge_scores[pid] for pid in common_patients]
+    print(f"ROUGE done for {len(rouge_scores)} patients")
+
+    # One model load and one length-sorted batched pass for all patients.
+    if bert is None:
+        bert = BertScoreEngine()
+    _, _, bert_f1 = bert.score(preds, refs)
+    print(f"BERTScore done for {len(bert_f1)} patients")
+
+    return pd.DataFrame({
+        "patient_id": common_patients,
+        "rouge1": [r['rouge1'] for r in rouge_scores],
+        "rouge2": [r['rouge2'] for r in rouge_scores],
+        "rougeL": [r['rougeL'] for r in rouge_scores],
+        "bertscore_f1": bert_f1,
+    }, columns=["patient_id", "rouge1", "rouge2", "rougeL", "bertscore_f1"])
 
 # -----------------------------
-# Evaluate each patient
+# Compute averages
 # -----------------------------
-for pid in common_patients:
-
-    print("Evaluating patient:", pid)
-    ref = normalize_text(manual_patients[pid])
-    pred = normalize_text(llm_patients[pid])
+def print_averages(df):
+    print("\n==== AVERAGE RESULTS ====")
 
-    rouge = scorer.score(ref, pred)
+    print("Average ROUGE-1:", df["rouge1"].mean())
+    print("Average ROUGE-2:", df["rouge2"].mean())
+    print("Average ROUGE-L:", df["rougeL"].mean())
+    print("Average BERTScore F1:", df["bertscore_f1"].mean())
 
-    rouge1 = rouge['rouge1'].fmeasure
-    rouge2 = rouge['rouge2'].fmeasure
-    rougeL = rouge['rougeL'].fmeasure
 
-    P, R, F1 = score([pred], [ref], lang="en")
-    bert_f1 = F1.mean().item()
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--llm", default=LLM_FILE)
+    parser.add_argument("--manual", default=MANUAL_FILE)
+    parser.add_argument("--output", default="evaluation_results.csv")
+    parser.add_argument("--limit", type=int, default=None, help="evaluate only the first N matched patients")
+    parser.add_argument("--bert-model", default=None, help="BERTScore model (default: bert_score's choice for English)")
+    parser.add_argument("--bert-batch-size", type=int, default=BERT_BATCH_SIZE)
+    parser.add_argument("--device", default=None, help="cuda / cpu (default: cuda when available)")
+    parser.add_argument("--bert-cache", default=BERT_CACHE_DIR, help="reference embedding cache directory ('' to disable)")
+    args = parser.parse_args()
 
-    results.append({
-        "patient_id": pid,
-        "rouge1": rouge1,
-        "rouge2": rouge2,
-        "rougeL": rougeL,
-        "bertscore_f1": bert_f1
-    })
+    print("Starting per-patient evaluation...")
 
-    print(f"Evaluated patient {pid}")
+    # -----------------------------
+    # Load files
+    # -----------------------------
+    llm_patients = load_patients(args.llm)
+    manual_patients = load_patients(args.manual)
 
-# -----------------------------
-# Convert to dataframe
-# -----------------------------
-df = pd.DataFrame(results)
+    print("Files loaded")
 
-# -----------------------------
-# Save CSV
-# -----------------------------
-df.to_csv("evaluation_results.csv", index=False)
+    print("LLM patients:", len(llm_patients))
+    print("Manual patients:", len(manual_patients))
 
-print("\nSaved results to evaluation_results.csv")
+    bert = BertScoreEngine(
+        model_type=args.bert_model, batch_size=args.bert_batch_size, device=args.device, cache_dir=args.bert_cache
+    )
+    df = evaluate_patients(llm_patients, manual_patients, limit=args.limit, bert=bert)
 
-# -----------------------------
-# Compute averages
-# -----------------------------
-print("\n==== AVERAGE RESULTS ====")
+    # -----------------------------
+    # Save CSV
+    # -----------------------------
+    df.to_csv(args.output, index=False)
 
-print("Average ROUGE-1:", df["rouge1"].mean())
-print("Average ROUGE-2:", df["rouge2"].mean())
-print("Average ROUGE-L:", df["rougeL"].mean())
-print("Average BERTScore F1:", df["bertscore_f1"].mean())
+    print(f"\nSaved results to {args.output}")
 
+    print_averages(df)
 
 
+if __name__ == "__main__":
+    main()
 
 
 '''
@@ -0,0 +1,329 @@
+"""
+Rule-based factual consistency of generated summaries against each patient's source rows.
+
+    python fact_check.py --table admissions --llm admissions_MG/admissions_prose_llama8b.txt
+    python fact_check.py --table ingredientevents --llm ingredientevents_prose.jsonl \\
+        --input ingredientevents=ingredientevents.csv --input d_items=d_items.csv --output facts.csv
+
+Every summary is scanned with compiled patterns for
+
+    id        8-digit MIMIC identifiers (subject_id, hadm_id, stay_id, ...)
+    time      timestamps ("2180-05-06 22:23:00", "2180-05-06 at 22:23") and bare dates
+    careunit  careunit names seen anywhere in the table (and their "(MICU)" abbreviations)
+    drug      drug / item labels seen anywhere in the table
+    number    any other number
+
+and each fact is looked up in the patient's own rows (the table's input_files, with
+the lookup tables joined on their shared columns). Precision is supported facts over
+extracted facts; recall is, per category, the patient's distinct hadm_id / stay_id
+values, timestamps, careunits and drugs that the summary mentions (numbers only count
+towards precision). An 8-digit number that is not one of the patient's identifiers
+is reported as a hallucinated ID.
+
+There is no model in the loop, so a patient takes milliseconds and the whole cohort
+can be checked where BERTScore (evaluation.py) is too slow.
+"""
+
+import argparse
+import importlib
+import math
+import os
+import re
+import sys
+
+import pandas as pd
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+
+ID_RE = re.compile(r"\b\d{8}\b")
+TIME_RE = re.compile(r"\b(\d{4}-\d{2}-\d{2})(?:(?:T| |,? at )(\d{1,2}):(\d{2})(?::\d{2}(?:\.\d+)?)?)?\b")
+NUMBER_RE = re.compile(r"(?<![\w.])-?\d+(?:\.\d+)?")
+ABBREVIATION_RE = re.compile(r"^(.*?)\s*\(([^()]+)\)\s*$")
+
+# Identifiers the summary is expected to state (recall); every *id column counts for precision.
+KEY_ID_COLUMNS = ("hadm_id", "stay_id")
+
+# Named-entity columns per category: prescriptions drug, d_items label (ingredients, output items).
+TERM_COLUMNS = {
+    "careunit": ("careunit", "first_careunit", "last_careunit"),
+    "drug": ("drug", "label"),
+}
+
+CATEGORIES = ["id", "time", "careunit", "drug", "number"]
+
+
+# ======================
+# SOURCE
+# ======================
+
+def is_id_column(col):
+    return col.endswith("id")
+
+
+def is_time_column(col):
+    return col.endswith(("time", "date"))
+
+
+def _id_strings(values):
+    if pd.api.types.is_numeric_dtype(values):
+        return {str(int(v)) for v in values.unique()}
+    return {v for v in values.astype(str).str.strip().unique() if v.isdigit()}
+
+
+def _number_key(value):
+    return round(float(value), 2)
+
+
+def _timestamp(match):
+    date, hour, minute = match.groups()
+    if hour is None:
+        return date, None
+    return date, f"{int(hour):02d}:{minute}"
+
+
+# Main table with the other input tables (e.g. d_items) joined on the columns they share.
+def load_source(input_files):
+    frames = [(name, pd.read_csv(path)) for name, path in input_files.items()]
+    (_, main), others = frames[0], frames[1:]
+    print(f"Loaded {frames[0][0]}: {main.shape}")
+    for name, df in others:
+        shared = [col for col in df.columns if col in main.columns]
+        if shared:
+            main = main.merge(df.drop_duplicates(shared), on=shared, how="left", suffixes=("", f"_{name}"))
+            print(f"Joined {name} on {', '.join(shared)}")
+    return main
+
+
+class TermPattern:
+    # One alternation over every distinct value of the category in the table.
+    def __init__(self, values):
+        self.aliases = {}
+        for value in values:
+            value = str(value).strip()
+            if not value:
+                continue
+            names = [value]
+            match = ABBREVIATION_RE.match(value)
+            if match:
+                names.extend(match.groups())
+            for name in names:
+                self.aliases.setdefault(name.lower(), set()).add(value)
+
+        alternation = "|".join(re.escape(name) for name in sorted(self.aliases, key=len, reverse=True))
+        self.pattern = re.compile(rf"(?<![\w])(?:{alternation})(?![\w])", re.I) if self.aliases else None
+
+    # The table values a mention can stand for.
+    def values(self, mention):
+        return self.aliases[mention.lower()]
+
+
+class PatientSource:
+    # The facts in one patient's rows.
+    def __init__(self, rows, term_columns):
+        columns = list(rows.columns)
+        self.rows = len(rows)
+        self.ids, self.key_ids = set(), set()
+        self.stamps, self.dates = set(), set()
+        self.numbers = set()
+        self.terms = {}
+
+        for col in columns:
+            values = rows[col].dropna()
+            if values.empty:
+                continue
+            if is_id_column(col):
+                ids = _id_strings(values)
+                self.ids |= ids
+                if col in KEY_ID_COLUMNS:
+                    self.key_ids |= ids
+                continue
+            if is_time_column(col):
+                for value in values.astype(str).unique():
+                    for match in TIME_RE.finditer(value):
+                        date, clock = _timestamp(match)
+                        self.dates.add(date)
+                        if clock is not None:
+                            self.stamps.add((date, clock))
+                continue
+            if pd.api.types.is_numeric_dtype(values):
+                self.numbers |= {_number_key(v) for v in values.unique() if math.isfinite(v)}
+                continue
+            for value in values.astype(str).unique():
+                self.numbers |= {_number_key(m.group(0)) for m in NUMBER_RE.finditer(value)}
+
+        for category, cols in term_columns.items():
+            self.terms[category] = {
+                str(v).strip() for col in cols for v in rows[col].dropna().unique() if str(v).strip()
+            }
+
+    # Small counts ("Admission 3", "4 admissions") are supported up to the number of rows.
+    def has_number(self, text):
+        value = _number_key(text)
+        return value in self.numbers or value.is_integer() and 0 <= value <= self.rows
+
+
+# ======================
+# CHECK
+# ======================
+
+# Facts of one summary checked against one patient's source; masked spans are not
+# matched again by the later (more generic) patterns.
+def check_summary(summary, source, term_patterns):
+    found = {category: [0, 0] for category in CATEGORIES}   # [supported, extracted]
+    mentioned = {category: set() for category in CATEGORIES}
+    hallucinated = []
+
+    def note(category, supported):
+        found[category][0] += bool(supported)
+        found[category][1] += 1
+
+    def masked(pattern, on_match, text):
+        return pattern.sub(lambda m: on_match(m) or " " * len(m.group(0)), text)
+
+    text = summary
+    for category, terms in term_patterns.items():
+        if terms.pattern is None:
+            continue
+
+        def on_term(match, category=category, terms=terms):
+            values = terms.values(match.group(0)) & source.terms[category]
+            note(category, values)
+            mentioned[category] |= values
+        text = masked(terms.pattern, on_term, text)
+
+    def on_time(match):
+        date, clock = _timestamp(match)
+        if clock is None:
+            note("time", date in source.dates)
+        else:
+            note("time", (date, clock) in source.stamps)
+            mentioned["time"].add((date, clock))
+    text = masked(TIME_RE, on_time, text)
+
+    def on_id(match):
+        value = match.group(0)
+        note("id", value in source.ids)
+        if value in source.ids:
+            mentioned["id"].add(value)
+        else:
+            hallucinated.append(value)
+    text = masked(ID_RE, on_id, text)
+
+    for match in NUMBER_RE.finditer(text):
+        note("number", source.has_number(match.group(0)))
+
+    expected = {
+        "id": source.key_ids,
+        "time": source.stamps,
+        "careunit": source.terms.get("careunit", set()),
+        "drug": source.terms.get("drug", set()),
+    }
+
+    result = {}
+    for category in CATEGORIES:
+        supported, extracted = found[category]
+        result[f"{category}_precision"] = supported / extracted if extracted else float("nan")
+        if category in expected:
+            total = len(expected[category])
+            result[f"{category}_recall"] = len(mentioned[category] & expected[category]) / total if total else float("nan")
+
+    supported = sum(found[c][0] for c in CATEGORIES)
+    extracted = sum(found[c][1] for c in CATEGORIES)
+    source_facts = sum(len(values) for values in expected.values())
+    recalled = sum(len(mentioned[c] & expected[c]) for c in expected)
+    return {
+        "facts": extracted,
+        "supported": supported,
+        "fact_precision": supported / extracted if extracted else float("nan"),
+        "source_facts": source_facts,
+        "recalled": recalled,
+        "fact_recall": recalled / source_facts if source_facts else float("nan"),
+        "hallucinated_ids": len(hallucinated),
+        "hallucinated_id_values": ";".join(dict.fromkeys(hallucinated)),
+        **result,
+    }
+
+
+# summaries: {patient id: summary text}; source: the table's rows (all patients).
+def check_patients(summaries, source, limit=None):
+    term_columns = {
+        category: [col for col in cols if col in source.columns] for category, cols in TERM_COLUMNS.items()
+    }
+    term_columns = {category: cols for category, cols in term_columns.items() if cols}
+    term_patterns = {
+        category: TermPattern(pd.unique(source[cols].stack().astype(str)))
+        for category, cols in term_columns.items()
+    }
+
+    subject_ids = source["subject_id"].dropna().astype(int).astype(str).unique()
+    wanted = sorted(set(summaries.keys()).intersection(subject_ids))[:limit]
+    print("Matched patients:", len(wanted))
+
+    source = source[source["subject_id"].isin([int(pid) for pid in wanted])]
+    groups = source.groupby(source["subject_id"].astype(int))
+
+    rows = []
+    for subject_id, group in groups:
+        pid = str(subject_id)
+        patient = PatientSource(group, term_columns)
+        rows.append({"patient_id": pid, **check_summary(summaries[pid], patient, term_patterns)})
+
+    columns = ["patient_id", "facts", "supported", "fact_precision", "source_facts", "recalled", "fact_recall",
+               "hallucinated_ids", "hallucinated_id_values"]
+    columns += [c for c in (rows[0] if rows else {}) if c not in columns]
+    return pd.DataFrame(rows, columns=columns)
+
+
+def print_averages(df):
+    print("\n==== FACT CHECK ====")
+
+    print("Facts extracted:", int(df["facts"].sum()))
+    print("Fact precision (all facts):", df["supported"].sum() / max(df["facts"].sum(), 1))
+    print("Fact recall (all facts):", df["recalled"].sum() / max(df["source_facts"].sum(), 1))
+    print("Average fact precision:", df["fact_precision"].mean())
+    print("Average fact recall:", df["fact_recall"].mean())
+    print("Hallucinated IDs:", int(df["hallucinated_ids"].sum()),
+          f"in {int((df['hallucinated_ids'] > 0).sum())} patients")
+    for category in CATEGORIES:
+        precision = df[f"{category}_precision"].mean()
+        recall = df[f"{category}_recall"].mean() if f"{category}_recall" in df else float("nan")
+        print(f"  {category:<9} precision {precision:.3f}  recall {recall:.3f}")
+
+
+def main():
+    from evaluation import load_patients
+    from run_all_tables import TABLE_MODULES
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--table", required=True, choices=list(TABLE_MODULES))
+    parser.add_argument("--llm", default=None, help="prose / run record file (default: the table's MG output)")
+    parser.add_argument("--input", action="append", default=[], metavar="TABLE=CSV",
+                        help="override one of the table's input CSVs (repeatable)")
+    parser.add_argument("--output", default=None, help="per-patient CSV (default: fact_check_<table>.csv)")
+    parser.add_argument("--limit", type=int, default=None, help="check only the first N matched patients")
+    args = parser.parse_args()
+
+    pipeline = importlib.import_module(TABLE_MODULES[args.table]).PIPELINE
+    input_files = dict(pipeline.input_files)
+    for item in args.input:
+        name, _, path = item.partition("=")
+        if name not in input_files or not path:
+            parser.error(f"--input expects one of {', '.join(input_files)} as TABLE=CSV, got {item!r}")
+        input_files[name] = path
+
+    summaries = load_patients(args.llm or pipeline.output_file)
+    print("LLM patients:", len(summaries))
+    source = load_source(input_files)
+
+    df = check_patients(summaries, source, limit=args.limit)
+
+    output = args.output or f"fact_check_{args.table}.csv"
+    df.to_csv(output, index=False)
+    print(f"\nSaved results to {output}")
+
+    print_averages(df)
+
+
+if __name__ == "__main__":
+    main()
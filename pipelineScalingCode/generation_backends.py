@@ -0,0 +1,424 @@
+"""
+One generation interface for every model we run.
+
+    backend = load_backend("hf", "meta-llama/Llama-3.1-8B-Instruct")
+    result = backend.generate(prompt, max_new_tokens=500)
+    result.text, result.prompt_tokens, result.completion_tokens, result.latency_s
+
+Backends:
+  - "hf":     local transformers model (batched, optional speculative draft model)
+  - "ollama": local Ollama server (/api/generate)
+  - "openai": any OpenAI-compatible server (vLLM, llama.cpp, LM Studio) via /v1/completions
+  - "stub":   deterministic fake model for offline benchmarks, no GPU or network
+
+Every backend keeps running token/latency totals in backend.metrics.
+"""
+
+import hashlib
+import json
+import os
+import re
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+
+from context_budget import DEFAULT_CONTEXT_WINDOW, count_tokens
+
+
+@dataclass
+class GenerationResult:
+    text: str
+    prompt_tokens: int
+    completion_tokens: int
+    latency_s: float
+
+
+class BackendMetrics:
+    def __init__(self):
+        self.calls = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.latencies = []
+
+    def record(self, result):
+        self.calls += 1
+        self.prompt_tokens += result.prompt_tokens
+        self.completion_tokens += result.completion_tokens
+        self.latencies.append(result.latency_s)
+
+    def summary(self):
+        total = sum(self.latencies)
+        ordered = sorted(self.latencies)
+        return {
+            "calls": self.calls,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "latency_total_s": round(total, 3),
+            "latency_p50_s": round(statistics.median(ordered), 3) if ordered else 0.0,
+            "latency_p95_s": round(ordered[int(0.95 * (len(ordered) - 1))], 3) if ordered else 0.0,
+            "completion_tokens_per_s": round(self.completion_tokens / total, 2) if total else 0.0,
+        }
+
+
+# ======================
+# BASE CLASS
+# ======================
+
+class GenerationBackend:
+    name = "base"
+
+    def __init__(self, model_name, max_new_tokens=400):
+        self.model_name = model_name
+        self.max_new_tokens = max_new_tokens
+        self.tokenizer = None
+        self.context_window = DEFAULT_CONTEXT_WINDOW
+        self.metrics = BackendMetrics()
+
+    def count_tokens(self, text):
+        return count_tokens(self.tokenizer, text)
+
+    def generate(self, prompt, max_new_tokens=None):
+        return self.generate_batch([prompt], max_new_tokens)[0]
+
+    # max_new_tokens may be one value for the whole batch or one value per prompt.
+    def generate_batch(self, prompts, max_new_tokens=None):
+        prompts = list(prompts)
+        if isinstance(max_new_tokens, (list, tuple)):
+            limits = [m or self.max_new_tokens for m in max_new_tokens]
+        else:
+            limits = [max_new_tokens or self.max_new_tokens] * len(prompts)
+        results = self._generate_batch(prompts, limits)
+        for result in results:
+            self.metrics.record(result)
+        return results
+
+    # Yield text chunks as they are produced. Backends without native streaming yield one chunk.
+    def stream(self, prompt, max_new_tokens=None):
+        yield self.generate(prompt, max_new_tokens).text
+
+    # Subclasses get one max_new_tokens limit per prompt.
+    def _generate_batch(self, prompts, limits):
+        raise NotImplementedError
+
+
+# ======================
+# HUGGING FACE
+# ======================
+
+class HFBackend(GenerationBackend):
+    name = "hf"
+
+    def __init__(self, model_name, max_new_tokens=400, batch_size=8, draft_model_name=None, token=None):
+        super().__init__(model_name, max_new_tokens)
+
+        import torch
+        from transformers import AutoTokenizer, AutoModelForCausalLM
+        from context_budget import context_window
+        from speculative import assisted_generate_kwargs
+
+        print(f"Loading model: {model_name}")
+
+        self.torch = torch
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name, token=token)
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+        # Decoder-only models must be left-padded for batched generation.
+        self.tokenizer.padding_side = "left"
+
+        self.model = AutoModelForCausalLM.from_pretrained(
+            model_name,
+            token=token,
+            dtype=torch.float16,
+            device_map="auto"
+        )
+        self.context_window = context_window(self.model, self.tokenizer)
+
+        self.assistant_kwargs = assisted_generate_kwargs(draft_model_name, self.tokenizer, token=token)
+        # Assisted generation only supports one sequence at a time.
+        self.batch_size = 1 if self.assistant_kwargs else batch_size
+
+    def _generate_kwargs(self, max_new_tokens):
+        return dict(
+            max_new_tokens=max_new_tokens,
+            do_sample=False,
+            pad_token_id=self.tokenizer.pad_token_id,
+            **self.assistant_kwargs
+        )
+
+    def _generate_batch(self, prompts, limits):
+        results = []
+        for i in range(0, len(prompts), self.batch_size):
+            chunk = prompts[i:i + self.batch_size]
+            chunk_limits = limits[i:i + self.batch_size]
+
+            start = time.perf_counter()
+            inputs = self.tokenizer(chunk, return_tensors="pt", padding=True).to(self.model.device)
+            with self.torch.inference_mode():
+                output = self.model.generate(**inputs, **self._generate_kwargs(max(chunk_limits)))
+            new_tokens = output[:, inputs["input_ids"].shape[1]:]
+            # Greedy rows decode independently, so cutting a row at its own limit
+            # gives the same text as generating it alone with that limit.
+            rows = [new_tokens[j, :limit] for j, limit in enumerate(chunk_limits)]
+            texts = self.tokenizer.batch_decode(rows, skip_special_tokens=True)
+            elapsed = time.perf_counter() - start
+
+            # Latency is amortized over the batch so metric totals still add up to wall time.
+            prompt_counts = inputs["attention_mask"].sum(dim=1).tolist()
+            for text, row, n_prompt in zip(texts, rows, prompt_counts):
+                n_completion = int((row != self.tokenizer.pad_token_id).sum())
+                results.append(GenerationResult(text, int(n_prompt), n_completion, elapsed / len(chunk)))
+        return results
+
+    def stream(self, prompt, max_new_tokens=None):
+        from threading import Thread
+        from transformers import TextIteratorStreamer
+
+        max_new_tokens = max_new_tokens or self.max_new_tokens
+        inputs = self.tokenizer(prompt, return_tensors="pt").to(self.model.device)
+        streamer = TextIteratorStreamer(self.tokenizer, skip_prompt=True, skip_special_tokens=True)
+
+        start = time.perf_counter()
+        worker = Thread(
+            target=self.model.generate,
+            kwargs=dict(**inputs, streamer=streamer, **self._generate_kwargs(max_new_tokens))
+        )
+        worker.start()
+
+        chunks = []
+        for chunk in streamer:
+            chunks.append(chunk)
+            yield chunk
+        worker.join()
+
+        text = "".join(chunks)
+        self.metrics.record(GenerationResult(
+            text,
+            int(inputs["input_ids"].shape[1]),
+            self.count_tokens(text),
+            time.perf_counter() - start
+        ))
+
+
+# ======================
+# HTTP SERVERS
+# ======================
+
+class _HTTPBackend(GenerationBackend):
+    def __init__(self, model_name, base_url, max_new_tokens=400, workers=4, timeout=120.0, temperature=0.0):
+        super().__init__(model_name, max_new_tokens)
+
+        import requests
+
+        self.requests = requests
+        self.session = requests.Session()
+        self.base_url = base_url.rstrip("/")
+        self.workers = workers
+        self.timeout = timeout
+        self.temperature = temperature
+
+    # Servers batch concurrent requests themselves, so a batch is sent as parallel requests.
+    def _generate_batch(self, prompts, limits):
+        if len(prompts) == 1 or self.workers <= 1:
+            return [self._generate_one(p, m) for p, m in zip(prompts, limits)]
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            return list(executor.map(self._generate_one, prompts, limits))
+
+    def _post(self, path, payload, stream=False):
+        try:
+            r = self.session.post(f"{self.base_url}{path}", json=payload, timeout=self.timeout, stream=stream)
+            r.raise_for_status()
+            return r
+        except self.requests.exceptions.RequestException as e:
+            raise RuntimeError(f"{self.name} request failed: {e}")
+
+
+class OllamaBackend(_HTTPBackend):
+    name = "ollama"
+
+    def __init__(self, model_name, base_url=None, num_ctx=None, **kwargs):
+        super().__init__(model_name, base_url or os.environ.get("OLLAMA_URL", "http://127.0.0.1:11434"), **kwargs)
+        self.num_ctx = num_ctx
+        if num_ctx:
+            self.context_window = num_ctx
+
+    def _payload(self, prompt, max_new_tokens, stream):
+        options = {"temperature": self.temperature, "num_predict": max_new_tokens}
+        if self.num_ctx:
+            options["num_ctx"] = self.num_ctx
+        return {"model": self.model_name, "prompt": prompt, "stream": stream, "options": options}
+
+    def _generate_one(self, prompt, max_new_tokens):
+        start = time.perf_counter()
+        data = self._post("/api/generate", self._payload(prompt, max_new_tokens, False)).json()
+        text = data.get("response", "")
+        return GenerationResult(
+            text,
+            data.get("prompt_eval_count") or self.count_tokens(prompt),
+            data.get("eval_count") or self.count_tokens(text),
+            time.perf_counter() - start
+        )
+
+    def stream(self, prompt, max_new_tokens=None):
+        start = time.perf_counter()
+        r = self._post("/api/generate", self._payload(prompt, max_new_tokens or self.max_new_tokens, True), stream=True)
+
+        chunks, last = [], {}
+        for line in r.iter_lines():
+            if not line:
+                continue
+            last = json.loads(line)
+            chunk = last.get("response", "")
+            if chunk:
+                chunks.append(chunk)
+                yield chunk
+
+        text = "".join(chunks)
+        self.metrics.record(GenerationResult(
+            text,
+            last.get("prompt_eval_count") or self.count_tokens(prompt),
+            last.get("eval_count") or self.count_tokens(text),
+            time.perf_counter() - start
+        ))
+
+
+class OpenAICompatibleBackend(_HTTPBackend):
+    name = "openai"
+
+    def __init__(self, model_name, base_url=None, api_key=None, context_window=None, **kwargs):
+        super().__init__(model_name, base_url or os.environ.get("OPENAI_BASE_URL", "http://127.0.0.1:8000/v1"), **kwargs)
+        api_key = api_key or os.environ.get("OPENAI_API_KEY")
+        if api_key:
+            self.session.headers["Authorization"] = f"Bearer {api_key}"
+        if context_window:
+            self.context_window = context_window
+
+    def _payload(self, prompt, max_new_tokens, stream):
+        return {
+            "model": self.model_name,
+            "prompt": prompt,
+            "max_tokens": max_new_tokens,
+            "temperature": self.temperature,
+            "stream": stream,
+        }
+
+    def _generate_one(self, prompt, max_new_tokens):
+        start = time.perf_counter()
+        data = self._post("/completions", self._payload(prompt, max_new_tokens, False)).json()
+        text = data["choices"][0].get("text", "")
+        usage = data.get("usage") or {}
+        return GenerationResult(
+            text,
+            usage.get("prompt_tokens") or self.count_tokens(prompt),
+            usage.get("completion_tokens") or self.count_tokens(text),
+            time.perf_counter() - start
+        )
+
+    def stream(self, prompt, max_new_tokens=None):
+        start = time.perf_counter()
+        r = self._post("/completions", self._payload(prompt, max_new_tokens or self.max_new_tokens, True), stream=True)
+
+        chunks = []
+        for line in r.iter_lines(decode_unicode=True):
+            if not line or not line.startswith("data:"):
+                continue
+            data = line[len("data:"):].strip()
+            if data == "[DONE]":
+                break
+            chunk = json.loads(data)["choices"][0].get("text", "")
+            if chunk:
+                chunks.append(chunk)
+                yield chunk
+
+        text = "".join(chunks)
+        self.metrics.record(GenerationResult(
+            text, self.count_tokens(prompt), self.count_tokens(text), time.perf_counter() - start
+        ))
+
+
+# ======================
+# OFFLINE STUB
+# ======================
+
+_STUB_WORDS = (
+    "patient admission stable course monitored treated discharged unit care "
+    "overnight recorded continued noted reviewed timeline events summary"
+).split()
+
+
+class StubBackend(GenerationBackend):
+    """Deterministic fake model: the same prompt always gives the same output.
+
+    SQL prompts get a valid query for the table and subject_id named in the prompt,
+    so the full pipeline runs end to end. seconds_per_token simulates decode cost.
+    """
+    name = "stub"
+
+    def __init__(self, model_name="stub", max_new_tokens=400, seconds_per_token=0.0, context_window=None):
+        super().__init__(model_name, max_new_tokens)
+        self.seconds_per_token = seconds_per_token
+        if context_window:
+            self.context_window = context_window
+
+    def _sql_response(self, prompt):
+        subject = re.search(r"subject_id\s*=\s*(\d+)", prompt)
+        table = (
+            re.search(r"Use (\w+) as the main table", prompt)
+            or re.search(r"FROM (\w+)", prompt)
+            or re.search(r"from (\w+)", prompt)
+        )
+        if not subject or not table:
+            return None
+        return f"```sql\nSELECT * FROM {table.group(1)} WHERE subject_id = {subject.group(1)};\n```"
+
+    def _text_response(self, prompt, max_new_tokens):
+        seed = prompt.encode("utf-8")
+        digest = hashlib.sha256(seed).digest()
+        n_words = max(1, min(max_new_tokens // 2, 40 + digest[0] % 80))
+        while len(digest) < n_words:
+            digest += hashlib.sha256(seed + digest).digest()
+        return " ".join(_STUB_WORDS[b % len(_STUB_WORDS)] for b in digest[:n_words]) + "."
+
+    def _generate_batch(self, prompts, limits):
+        results = []
+        for prompt, max_new_tokens in zip(prompts, limits):
+            start = time.perf_counter()
+            text = None
+            if "sqlite" in prompt.lower():
+                text = self._sql_response(prompt)
+            if text is None:
+                text = self._text_response(prompt, max_new_tokens)
+
+            n_completion = self.count_tokens(text)
+            if self.seconds_per_token:
+                time.sleep(self.seconds_per_token * n_completion)
+            results.append(GenerationResult(text, self.count_tokens(prompt), n_completion, time.perf_counter() - start))
+        return results
+
+
+# ======================
+# FACTORY
+# ======================
+
+BACKENDS = {
+    "hf": HFBackend,
+    "ollama": OllamaBackend,
+    "openai": OpenAICompatibleBackend,
+    "stub": StubBackend,
+}
+
+
+def load_backend(kind, model_name, **options):
+    if kind not in BACKENDS:
+        raise ValueError(f"Unknown backend {kind!r}, expected one of {sorted(BACKENDS)}")
+    return BACKENDS[kind](model_name, **options)
+
+
+# Backend selection for the MG scripts:
+#   GEN_BACKEND=hf|ollama|openai|stub   (default hf)
+#   GEN_MODEL=<name>                    model name for non-HF backends, e.g. "llama3.1:8b" for Ollama
+def backend_from_env(model_name, max_new_tokens=400, draft_model_name=None, token=None):
+    kind = os.environ.get("GEN_BACKEND", "hf")
+    if kind == "hf":
+        return load_backend(kind, model_name, max_new_tokens=max_new_tokens, draft_model_name=draft_model_name, token=token)
+    return load_backend(kind, os.environ.get("GEN_MODEL", model_name), max_new_tokens=max_new_tokens)
@@ -0,0 +1,192 @@
+"""
+Column-wise rendering of the ground-truth prose written by the *_GT scripts.
+
+The GT scripts used to build one sentence list per row with df.apply(row_to_prose, axis=1).
+Here every field is formatted once per column (a string array plus a "present" mask,
+with the same rules as safe_str / safe_lower / fmt_num / clean_status), sentences are
+concatenated as whole columns, and the text file is written chunk by chunk.
+
+    prose = Prose(df)
+    subject_id, intime = text(df, "subject_id"), text(df, "intime")
+    prose.add(subject_id.present & intime.present, "Patient ", subject_id, " was admitted on ", intime, ".")
+    prose.lines()        # same strings as " ".join(sentences) per row
+
+write_prose(path, df, render) renders and writes df in chunks of chunk_size rows.
+"""
+
+import numpy as np
+import pandas as pd
+
+try:
+    # numpy >= 2: native variable-width strings, concatenated without Python objects
+    from numpy.dtypes import StringDType
+    STRING = StringDType()
+    _concat = np.strings.add
+except ImportError:
+    STRING = object
+    _concat = np.add
+
+
+# ======================
+# FIELDS
+# ======================
+
+class Field:
+    # values: string array ("" where missing); present: bool array.
+    def __init__(self, values, present):
+        self.values = values
+        self.present = present
+
+    # {field or 'unknown'}; or_("None") for an f-string that prints a missing value.
+    def or_(self, default):
+        return Field(np.where(self.present, self.values, default).astype(STRING), np.ones(len(self.values), bool))
+
+
+def _as_strings(values):
+    if STRING is object:
+        return values.astype(str).astype(object)
+    return values.astype(STRING)
+
+
+def _missing(n):
+    return Field(np.full(n, "", dtype=STRING), np.zeros(n, bool))
+
+
+def _field(values, present):
+    return Field(np.where(present, values, "").astype(STRING), present)
+
+
+# str(value) for every non-null value of a numeric column.
+# Integral floats below 1e16 print as "<int>.0" (ids in columns with NaN); the rest go through repr.
+def _number_strings(values, present):
+    out = np.full(len(values), "", dtype=STRING)
+    if values.dtype.kind in "iub":
+        out[present] = _as_strings(values[present])
+        return out
+    values = values.astype(float)
+    integral = present & (np.abs(values) < 1e16) & (values != 0)
+    integral[integral] = np.floor(values[integral]) == values[integral]
+    out[integral] = _concat(_as_strings(values[integral].astype(np.int64)), ".0")
+    rest = present & ~integral
+    out[rest] = _as_strings(values[rest])
+    return out
+
+
+def _nonblank(values):
+    if STRING is object:
+        return pd.Series(values).str.strip().ne("").to_numpy()
+    return np.strings.strip(values) != ""
+
+
+def _object_strings(series):
+    return np.array([str(v) for v in series.fillna("").tolist()], dtype=STRING)
+
+
+# safe_str: str(value) unless NaN or blank.
+def text(df, col):
+    if col not in df.columns:
+        return _missing(len(df))
+    series = df[col]
+    present = series.notna().to_numpy()
+    if pd.api.types.is_bool_dtype(series) or not pd.api.types.is_numeric_dtype(series):
+        values = _object_strings(series)
+        return _field(values, present & _nonblank(values))
+    return _field(_number_strings(series.to_numpy(), present), present)
+
+
+# safe_lower: lowercased strings only, anything else is missing.
+def lower(df, col):
+    if col not in df.columns or pd.api.types.is_numeric_dtype(df[col]):
+        return _missing(len(df))
+    series = df[col]
+    is_str = series.map(lambda v: isinstance(v, str)).to_numpy(dtype=bool)
+    values = pd.Series(np.where(is_str, series.fillna("").astype(str).to_numpy(dtype=object), ""), dtype=object)
+    present = is_str & values.str.strip().ne("").to_numpy()
+    return _field(values.str.lower().to_numpy(dtype=object), present)
+
+
+# fmt_num: f"{float(x):.{digits}f}", or str(x) for values float() can't parse
+# (an empty str(x) is falsy there, so it counts as missing).
+def number(df, col, digits=2):
+    if col not in df.columns:
+        return _missing(len(df))
+    series = df[col]
+    present = series.notna().to_numpy()
+    numeric = pd.to_numeric(series, errors="coerce").to_numpy(dtype=float)
+    parsed = present & ~np.isnan(numeric)
+    values = np.full(len(series), "", dtype=object)
+    values[parsed] = [f"{v:.{digits}f}" for v in numeric[parsed].tolist()]
+    unparsed = present & ~parsed
+    if unparsed.any():
+        values[unparsed] = [str(v) for v in series[unparsed].tolist()]
+        present = present & (values != "")
+    return _field(values, present)
+
+
+# Per-value mapping (clean_status and friends), applied once per distinct value.
+def mapped(df, col, fn):
+    if col not in df.columns:
+        return _missing(len(df))
+    series = df[col]
+    mapping = {value: fn(value) for value in series.dropna().unique()}
+    out = series.map(mapping)
+    values = out.fillna("").astype(str).to_numpy(dtype=object)
+    return _field(values, out.notna().to_numpy() & (values != ""))
+
+
+# `row.get(a) or row.get(b)`: b where a is absent, 0 or an empty string.
+def first_truthy(df, *cols):
+    cols = [col for col in cols if col in df.columns]
+    if not cols:
+        return pd.Series([None] * len(df), index=df.index, dtype=object)
+    out = df[cols[-1]].astype(object)
+    for col in reversed(cols[:-1]):
+        series = df[col].astype(object)
+        falsy = series.map(lambda v: v is not None and not pd.isna(v) and not v).to_numpy(dtype=bool)
+        out = series.where(~falsy, out)
+    return out
+
+
+# ======================
+# SENTENCES
+# ======================
+
+class Prose:
+    # sep=", " builds a list inside one sentence ("Insurance: ..., Language: ...").
+    def __init__(self, df, sep=" "):
+        self.n = len(df)
+        self.sep = sep
+        self.out = np.full(self.n, "", dtype=STRING)
+
+    # One sentence per row where mask is set; parts are literal strings or Fields.
+    def add(self, mask, *parts):
+        mask = np.asarray(mask, dtype=bool)
+        sentence = np.full(int(mask.sum()), "", dtype=STRING)
+        for part in parts:
+            sentence = _concat(sentence, part.values[mask] if isinstance(part, Field) else part)
+        current = self.out[mask]
+        self.out[mask] = np.where(current != "", _concat(_concat(current, self.sep), sentence), sentence)
+
+    def present(self):
+        return self.out != ""
+
+    def field(self):
+        return Field(self.out, self.present())
+
+    def lines(self):
+        return self.out.tolist()
+
+
+# ======================
+# OUTPUT
+# ======================
+
+# render(chunk_df) -> list of lines; each line is followed by a blank line, as before.
+def write_prose(path, df, render, chunk_size=50000):
+    count = 0
+    with open(path, "w", encoding="utf-8") as f:
+        for start in range(0, len(df), chunk_size):
+            lines = render(df.iloc[start:start + chunk_size])
+            f.write("".join(line + "\n\n" for line in lines))
+            count += len(lines)
+    return count
@@ -0,0 +1,297 @@
+"""
+Map-reduce summaries for patients with too many events for one prompt.
+
+    map:    split the patient's rows by hadm_id / stay_id (then by time window and
+            row count) and summarize every chunk; chunks from all heavy patients
+            are batched together by the scheduler
+    reduce: merge chunk summaries, fan_in at a time, until one prompt is left;
+            that last prompt is the patient's SUMMARY PROMPT
+
+Chunk and intermediate outputs are cached on disk, keyed on model + prompt +
+max_new_tokens, so a re-run (or a run that crashed halfway) only generates
+what is missing.
+"""
+
+import hashlib
+import json
+import os
+
+import pandas as pd
+
+from context_budget import prompt_budget
+from job_scheduler import GenerationJob, ContinuousBatchScheduler
+
+
+# ======================
+# CONFIG
+# ======================
+
+class HierarchicalConfig:
+    def __init__(
+        self,
+        event_name,
+        min_rows=500,
+        chunk_keys=("hadm_id", "stay_id"),
+        time_col=None,
+        window_hours=24,
+        max_chunk_rows=200,
+        chunk_max_new_tokens=256,
+        fan_in=8,
+        cache_dir=None,
+    ):
+        # Patients with fewer than min_rows result rows use the normal single-prompt path.
+        self.event_name = event_name
+        self.min_rows = min_rows
+        self.chunk_keys = chunk_keys
+        self.time_col = time_col
+        self.window_hours = window_hours
+        self.max_chunk_rows = max_chunk_rows
+        self.chunk_max_new_tokens = chunk_max_new_tokens
+        self.fan_in = fan_in
+        self.cache_dir = cache_dir or os.getenv("HIERARCHICAL_CACHE_DIR", ".summary_cache")
+
+
+def use_hierarchical(pipeline, result_df):
+    config = pipeline.hierarchical
+    return config is not None and len(result_df) >= config.min_rows
+
+
+# ======================
+# CHUNKING
+# ======================
+
+# Window of the rows whose time is missing or unparseable; they go last.
+UNKNOWN_WINDOW = "unknown time"
+
+
+def _chunk_label(key_name, key_value, window, part):
+    label = f"{key_name} {key_value}" if key_name else "all events"
+    if window == UNKNOWN_WINDOW:
+        label += f", {UNKNOWN_WINDOW}"
+    elif window is not None:
+        label += f", from {window}"
+    if part:
+        label += f", part {part + 1}"
+    return label
+
+
+# Split one patient's rows into chunks small enough for one prompt each.
+# Returns [(label, frame)] in time order.
+def chunk_events(config, df):
+    key_name = next((k for k in config.chunk_keys if k in df.columns and df[k].notna().any()), None)
+    groups = df.groupby(df[key_name].fillna(-1), sort=True) if key_name else [(None, df)]
+
+    chunks = []
+    for key_value, group in groups:
+        if key_value == -1:
+            key_value = "unknown"
+        elif key_value is not None:
+            key_value = int(key_value)
+
+        windows = [(None, group)]
+        if config.time_col in group.columns and len(group) > config.max_chunk_rows:
+            times = pd.to_datetime(group[config.time_col], errors="coerce")
+            bucket = times.dt.floor(f"{config.window_hours}h")
+            group = group.assign(_time=times, _window=bucket).sort_values("_time", kind="stable")
+            windows = [
+                (str(w) if pd.notna(w) else UNKNOWN_WINDOW, g.drop(columns=["_time", "_window"]))
+                for w, g in group.groupby("_window", sort=True, dropna=False)
+            ]
+
+        for window, frame in windows:
+            for part, start in enumerate(range(0, len(frame), config.max_chunk_rows)):
+                piece = frame.iloc[start:start + config.max_chunk_rows]
+                chunks.append((_chunk_label(key_name, key_value, window, part), piece))
+    return chunks
+
+
+# ======================
+# PROMPTS
+# ======================
+
+def build_chunk_prompt(config, label, context):
+    return f"""
+You are a clinical documentation assistant.
+
+Summarize this part of a patient's {config.event_name} ({label}) in one short paragraph.
+Keep every medication/item name, time range, and notable amount or rate.
+Use ONLY facts in EVENTS_JSON. Do not invent times, labels, or IDs.
+Do not mention SQL.
+
+EVENTS_JSON:
+{context}
+""".strip()
+
+
+def build_reduce_prompt(config, subject_id, parts, final):
+    partial = "\n\n".join(f"[{label}]\n{text}" for label, text in parts)
+    task = (
+        "Write one natural language paragraph summarizing the patient's "
+        f"{config.event_name} across all of the partial summaries below."
+        if final else
+        f"Merge these partial summaries of the patient's {config.event_name} into one shorter paragraph."
+    )
+    return f"""
+You are a clinical documentation assistant.
+
+Patient ID: {subject_id}
+{task}
+No bullets, no numbering, no headings.
+Synthesize patterns; keep the order of events.
+Use ONLY facts in the partial summaries. Do not invent times, labels, or IDs.
+Do not mention SQL.
+
+PARTIAL SUMMARIES:
+{partial}
+""".strip()
+
+
+# Pack consecutive partial summaries into groups of at most fan_in that fit the prompt budget.
+def group_parts(config, backend, subject_id, parts, max_new_tokens):
+    budget = prompt_budget(backend.context_window, max_new_tokens)
+    groups, current = [], []
+    for part in parts:
+        candidate = current + [part]
+        too_long = backend.count_tokens(build_reduce_prompt(config, subject_id, candidate, False)) > budget
+        if current and (len(candidate) > config.fan_in or too_long):
+            groups.append(current)
+            current = [part]
+        else:
+            current = candidate
+    if current:
+        groups.append(current)
+
+    # Every summary too long to pair under the budget: merge fan_in at a time anyway so the reduce terminates.
+    if len(groups) > 1 and all(len(g) == 1 for g in groups):
+        groups = [parts[i:i + config.fan_in] for i in range(0, len(parts), config.fan_in)]
+    return groups
+
+
+# ======================
+# CACHE
+# ======================
+
+class ChunkCache:
+    def __init__(self, cache_dir, model_name):
+        self.cache_dir = cache_dir
+        self.model_name = model_name
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _path(self, prompt, max_new_tokens):
+        key = json.dumps([self.model_name, prompt, max_new_tokens])
+        return os.path.join(self.cache_dir, hashlib.sha256(key.encode("utf-8")).hexdigest() + ".txt")
+
+    def get(self, prompt, max_new_tokens):
+        path = self._path(prompt, max_new_tokens)
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                return f.read()
+        return None
+
+    def put(self, prompt, max_new_tokens, text):
+        path = self._path(prompt, max_new_tokens)
+        tmp = path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(text)
+        os.replace(tmp, path)
+
+
+# ======================
+# DRIVER
+# ======================
+
+class HierarchicalSummary:
+    """Map-reduce for one patient, driven through a job scheduler.
+
+    submit(prompt, max_new_tokens, on_done, on_error) queues one generation;
+    on_done gets the generated text. When only one reduce prompt is left,
+    on_final(summary_prompt, max_new_tokens) is called and the caller runs it
+    like any other summary prompt.
+    """
+
+    def __init__(self, pipeline, backend, cache, subject_id, result_df, submit, on_final, on_error):
+        self.config = pipeline.hierarchical
+        self.pipeline = pipeline
+        self.backend = backend
+        self.cache = cache
+        self.subject_id = subject_id
+        self.result_df = result_df
+        self.submit = submit
+        self.on_final = on_final
+        self.on_error = on_error
+        self.final_max_new_tokens = pipeline.summary_max_new_tokens(result_df)
+
+    def start(self):
+        jobs = []
+        for label, chunk in chunk_events(self.config, self.result_df):
+            context, _ = self.pipeline.build_patient_context(
+                self.subject_id, chunk, self.config.chunk_max_new_tokens, self.backend
+            )
+            jobs.append((label, build_chunk_prompt(self.config, label, context)))
+        print(f"Patient {self.subject_id}: hierarchical summary over {len(jobs)} chunks")
+        self._run_level(jobs, self.config.chunk_max_new_tokens)
+
+    # Generate every prompt in the level (cache first), then build the next level.
+    def _run_level(self, jobs, max_new_tokens):
+        outputs = [None] * len(jobs)
+        remaining = [len(jobs)]
+
+        def finish(i, text):
+            outputs[i] = (jobs[i][0], text)
+            remaining[0] -= 1
+            if remaining[0] == 0:
+                self._reduce(outputs)
+
+        for i, (label, prompt) in enumerate(jobs):
+            cached = self.cache.get(prompt, max_new_tokens)
+            if cached is not None:
+                finish(i, cached)
+                continue
+
+            def on_done(text, i=i, prompt=prompt):
+                text = text.strip()
+                self.cache.put(prompt, max_new_tokens, text)
+                finish(i, text)
+
+            self.submit(prompt, max_new_tokens, on_done, self.on_error)
+
+    def _reduce(self, parts):
+        groups = group_parts(self.config, self.backend, self.subject_id, parts, self.final_max_new_tokens)
+        if len(groups) == 1:
+            prompt = build_reduce_prompt(self.config, self.subject_id, groups[0], True)
+            self.on_final(prompt, self.final_max_new_tokens)
+            return
+
+        jobs = []
+        for group in groups:
+            label = group[0][0] if len(group) == 1 else f"{group[0][0]} to {group[-1][0]}"
+            jobs.append((label, build_reduce_prompt(self.config, self.subject_id, group, False)))
+        self._run_level(jobs, self.config.chunk_max_new_tokens)
+
+
+def chunk_cache(pipeline, backend):
+    if pipeline.hierarchical is None:
+        return None
+    return ChunkCache(pipeline.hierarchical.cache_dir, backend.model_name)
+
+
+# Serial runs: batch one patient's chunk prompts through a local scheduler.
+# Returns (summary_prompt, summary).
+def summarize_hierarchical(pipeline, backend, cache, subject_id, result_df):
+    scheduler = ContinuousBatchScheduler(backend, max_batch_size=getattr(backend, "batch_size", 8))
+    final = {}
+    errors = []
+
+    def submit(prompt, max_new_tokens, on_done, on_error):
+        scheduler.submit(GenerationJob(prompt, max_new_tokens, lambda result: on_done(result.text), on_error))
+
+    def on_final(prompt, max_new_tokens):
+        final["prompt"] = prompt
+        submit(prompt, max_new_tokens, lambda text: final.update(summary=text.strip()), errors.append)
+
+    HierarchicalSummary(pipeline, backend, cache, subject_id, result_df, submit, on_final, errors.append).start()
+    scheduler.run()
+
+    if errors:
+        raise errors[0]
+    return final["prompt"], final["summary"]
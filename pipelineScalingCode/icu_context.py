@@ -0,0 +1,220 @@
+"""
+Per-label summaries of ICU event tables (ingredientevents, outputevents) for the whole cohort at once.
+
+The MG scripts used to loop over every patient's labels and pull ~10 `.dropna().iloc[0]`
+values per label. Here every (subject_id, label) aggregate is computed in one
+groupby/agg pass over the full table when the tables are loaded, and each patient's
+records are looked up afterwards.
+
+    COHORT = CohortLabelContext(COHORT_SQL)     # PIPELINE = TablePipeline(..., cohort=COHORT)
+    COHORT.records(subject_id, result_df)       # list of per-label dicts
+"""
+
+import pandas as pd
+
+
+# ======================
+# HELPERS
+# ======================
+
+def safe_str(value):
+    if value is None or pd.isna(value) or str(value).strip() == "":
+        return None
+    return str(value).strip()
+
+
+def fmt_num(value, digits=2):
+    if value is None or pd.isna(value):
+        return None
+    try:
+        return f"{float(value):.{digits}f}"
+    except Exception:
+        return str(value).strip()
+
+
+def clean_status(value):
+    if not isinstance(value, str):
+        return None
+
+    v = value.strip().lower()
+
+    if v == "changedose/rate":
+        return "infusion rate was changed"
+    if v == "finishedrunning":
+        return "finished running"
+    if v == "stopped":
+        return "was stopped"
+    if v == "paused":
+        return "was paused"
+
+    return v
+
+
+# ======================
+# AGGREGATION
+# ======================
+
+UNKNOWN_LABEL = "UNKNOWN_LABEL"
+
+# (record field, source column, groupby reduction, formatter); record keys keep this order.
+LABEL_FIELDS = [
+    ("hadm_id", "hadm_id", "first", safe_str),
+    ("stay_id", "stay_id", "first", safe_str),
+    ("first_starttime", "starttime", "first", safe_str),
+    ("last_endtime", "endtime", "last", safe_str),
+    ("example_amount", "amount", "first", fmt_num),
+    ("amountuom", "amountuom", "first", safe_str),
+    ("example_rate", "rate", "first", fmt_num),
+    ("rateuom", "rateuom", "first", safe_str),
+]
+
+# Columns that decide a patient's records; used to check a SQL result against the cohort.
+FINGERPRINT_COLUMNS = ["subject_id", "label", "statusdescription"] + [col for _, col, _, _ in LABEL_FIELDS]
+
+
+def _prepare(df, time_col):
+    df = df.assign(label=df["label"].fillna(UNKNOWN_LABEL) if "label" in df.columns else UNKNOWN_LABEL)
+    if time_col in df.columns:
+        df = df.sort_values(["subject_id", time_col], kind="mergesort")
+    return df
+
+
+# Distinct cleaned statuses per (subject_id, label), in first-seen or sorted order.
+# Returns {(subject_id, label): [status, ...]}.
+def _statuses(df, sorted_statuses):
+    if "statusdescription" not in df.columns:
+        return {}
+
+    raw = df["statusdescription"]
+    mapping = {value: clean_status(value) for value in raw.dropna().unique()}
+    status = raw.map(mapping)
+
+    seen = pd.DataFrame({"subject_id": df["subject_id"], "label": df["label"], "status": status})
+    seen = seen[seen["status"].notna() & (seen["status"] != "")]
+    seen = seen.drop_duplicates(["subject_id", "label", "status"])
+    if sorted_statuses:
+        seen = seen.sort_values(["subject_id", "label", "status"], kind="mergesort")
+
+    # At most a handful of rows per label after dedup, so a plain loop is cheap here
+    # (groupby().agg(list) would build one Series per group).
+    out = {}
+    for subject_id, label, status in zip(seen["subject_id"].tolist(), seen["label"].tolist(), seen["status"].tolist()):
+        out.setdefault((subject_id, label), []).append(status)
+    return out
+
+
+# One groupby/agg over any number of patients.
+# Returns one row per (subject_id, label): most frequent labels first within each patient.
+def summarize_by_label(df, time_col="starttime", sorted_statuses=False):
+    df = _prepare(df, time_col)
+
+    aggs = {"count_events": ("label", "size")}
+    for field, col, how, _ in LABEL_FIELDS:
+        if col in df.columns:
+            aggs[field] = (col, how)
+    summary = df.groupby(["subject_id", "label"], sort=True).agg(**aggs).reset_index()
+
+    statuses = _statuses(df, sorted_statuses)
+    summary["statuses_seen"] = [
+        statuses.get(key, []) for key in zip(summary["subject_id"].tolist(), summary["label"].tolist())
+    ]
+
+    summary["_neg_count"] = -summary["count_events"]
+    summary = summary.sort_values(["subject_id", "_neg_count"], kind="mergesort")
+    return summary.drop(columns="_neg_count")
+
+
+# Format column by column, then zip into one dict per row, grouped by subject_id.
+def _to_records(summary):
+    n = len(summary)
+    keys = ["label", "count_events"]
+    columns = [
+        [safe_str(v) for v in summary["label"].tolist()],
+        [int(v) for v in summary["count_events"].tolist()],
+    ]
+    for field, _, _, fmt in LABEL_FIELDS:
+        keys.append(field)
+        columns.append([fmt(v) for v in summary[field].tolist()] if field in summary.columns else [None] * n)
+    keys.append("statuses_seen")
+    columns.append(summary["statuses_seen"].tolist())
+
+    out = {}
+    for subject_id, values in zip(summary["subject_id"].tolist(), zip(*columns)):
+        out.setdefault(subject_id, []).append(dict(zip(keys, values)))
+    return out
+
+
+# Per-patient records for any frame of events (one or many patients).
+def label_records(df, time_col="starttime", sorted_statuses=False):
+    if df.empty:
+        return {}
+    return _to_records(summarize_by_label(df, time_col=time_col, sorted_statuses=sorted_statuses))
+
+
+# Order-independent hash of each patient's rows over the fingerprint columns.
+# Numeric columns are compared as float64: a patient with no NULL hadm_id gets an int
+# column from SQLite while the cohort frame has a float one.
+def _fingerprints(df, columns=FINGERPRINT_COLUMNS):
+    cols = [col for col in columns if col in df.columns]
+    frame = pd.DataFrame({
+        col: df[col].astype("float64") if pd.api.types.is_numeric_dtype(df[col]) else df[col]
+        for col in cols
+    })
+    hashed = pd.util.hash_pandas_object(frame, index=False)
+    return hashed.groupby(df["subject_id"].to_numpy()).sum(), tuple(cols)
+
+
+# ======================
+# COHORT CONTEXT
+# ======================
+
+class CohortLabelContext:
+    def __init__(self, cohort_sql, time_col="starttime", sorted_statuses=False,
+                 summarize=None, fingerprint_columns=FINGERPRINT_COLUMNS):
+        # cohort_sql selects the same columns as the table's per-patient SQL, for every patient.
+        # summarize(df) -> {subject_id: [record, ...]} replaces label_records for other record
+        # shapes (see output_series.py); fingerprint_columns are the columns it reads.
+        self.cohort_sql = cohort_sql
+        self.time_col = time_col
+        self.sorted_statuses = sorted_statuses
+        self.summarize = summarize
+        self.fingerprint_columns = fingerprint_columns
+        self.by_subject = {}
+        self.fingerprints = None
+        self.columns = ()
+
+    def _records(self, df):
+        if df.empty:
+            return {}
+        if self.summarize is not None:
+            return self.summarize(df)
+        return label_records(df, time_col=self.time_col, sorted_statuses=self.sorted_statuses)
+
+    # Called once by table_pipeline.load_tables after the CSVs are in SQLite.
+    def load(self, conn):
+        try:
+            df = pd.read_sql_query(self.cohort_sql, conn)
+        except Exception as e:
+            # Only an optimization: without it every patient is aggregated from its own SQL result.
+            print(f"Cohort context unavailable, building per patient: {e}")
+            return
+        self.by_subject = self._records(df)
+        self.fingerprints, self.columns = _fingerprints(df, self.fingerprint_columns) if not df.empty else (None, ())
+        print(f"Cohort context: {len(self.by_subject)} patients, {len(df)} rows")
+
+    # Precomputed records when group holds exactly the cohort's rows for this patient
+    # (the usual case); otherwise (a different generated SQL, a hierarchical chunk) build from group.
+    def records(self, subject_id, group):
+        if "subject_id" not in group.columns:
+            group = group.assign(subject_id=int(subject_id))
+
+        if self.fingerprints is not None and not group.empty:
+            key = int(subject_id)
+            columns = tuple(c for c in self.fingerprint_columns if c in group.columns)
+            if key in self.fingerprints.index and columns == self.columns:
+                prints, _ = _fingerprints(group, self.fingerprint_columns)
+                if len(prints) == 1 and prints.iloc[0] == self.fingerprints[key]:
+                    return self.by_subject.get(key, [])
+
+        records = self._records(group)
+        return [r for rs in records.values() for r in rs]
@@ -1,49 +1,41 @@
 import pandas as pd
 import os
+import sys
 
-def safe_lower(value):
-    """Return lowercase string if possible, else None."""
-    if isinstance(value, str) and value.strip():
-        return value.lower()
-    return None
-
-def safe_str(value):
-    """Return string if not NaN, else None."""
-    if pd.isna(value) or str(value).strip() == '':
-        return None
-    return str(value)
-
-#Converting a row from icustays to descriptive prose
-def row_to_prose(row):
-
-    sentences = []
-
-    subject_id = safe_str(row.get("subject_id"))
-    hadm_id = safe_str(row.get("hadm_id"))
-    stay_id = safe_str(row.get("stay_id"))
-    intime = safe_str(row.get("intime"))
-    outtime = safe_str(row.get("outtime"))
-    los = safe_str(row.get("los"))
-
-    first_careunit = safe_lower(row.get("first_careunit"))
-    last_careunit = safe_lower(row.get("last_careunit"))
-
-    if subject_id and intime and outtime:
-        sentences.append(f"Patient {subject_id} was admitted to ICU on {intime} and discharged on {outtime}.")
-    if hadm_id:
-        sentences.append(f"Their hospital admission ID was {hadm_id}.")
-    if stay_id:
-        sentences.append(f"The ICU stay ID was {stay_id}.")
-
-    if first_careunit != last_careunit and los:
-        sentences.append(
-            f"They were admitted to {first_careunit or 'unknown'} "
-            f"and moved to {last_careunit or 'unknown'} for total of {los} days."
-        )
-    elif first_careunit == last_careunit or los:
-        sentences.append(f"They were admitted to {first_careunit} for {los} days")
-    
-    return " ".join(sentences)
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from gt_prose import Prose, lower, text, write_prose
+
+#Converting icustays to descriptive prose, one line per row (rendered column-wise)
+def frame_to_prose(df):
+    prose = Prose(df)
+
+    subject_id = text(df, "subject_id")
+    hadm_id = text(df, "hadm_id")
+    stay_id = text(df, "stay_id")
+    intime = text(df, "intime")
+    outtime = text(df, "outtime")
+    los = text(df, "los")
+
+    first_careunit = lower(df, "first_careunit")
+    last_careunit = lower(df, "last_careunit")
+
+    prose.add(subject_id.present & intime.present & outtime.present,
+              "Patient ", subject_id, " was admitted to ICU on ", intime, " and discharged on ", outtime, ".")
+    prose.add(hadm_id.present, "Their hospital admission ID was ", hadm_id, ".")
+    prose.add(stay_id.present, "The ICU stay ID was ", stay_id, ".")
+
+    same_unit = (
+        (first_careunit.present & last_careunit.present & (first_careunit.values == last_careunit.values))
+        | (~first_careunit.present & ~last_careunit.present)
+    )
+    moved = ~same_unit & los.present
+    prose.add(moved, "They were admitted to ", first_careunit.or_("unknown"),
+              " and moved to ", last_careunit.or_("unknown"), " for total of ", los, " days.")
+    prose.add(~moved & (same_unit | los.present),
+              "They were admitted to ", first_careunit.or_("None"), " for ", los.or_("None"), " days")
+
+    return prose.lines()
 
 
 # CSV path
@@ -53,16 +45,11 @@ file_path = os.path.join("mimic-iv-demo", "mimic-iv-clinical-database-demo-2.2",
 df = pd.read_csv(file_path)
 print(f"Loaded icustays: {df.shape}")
 
-# Convert to prose
-prose_descriptions = df.apply(row_to_prose, axis=1).tolist()
-
-# Save to a single text file
+# Convert to prose and save to a single text file, double newline between patients
 output_file = r"pipelineScalingCode/icustays_prose.txt"
-with open(output_file, "w", encoding="utf-8") as f:
-    for line in prose_descriptions:
-        f.write(line + "\n\n")  # double newline between patients
+n_lines = write_prose(output_file, df, frame_to_prose)
 
-print(f"Saved {len(prose_descriptions)} patient descriptions to {output_file}")
+print(f"Saved {n_lines} patient descriptions to {output_file}")
 
 # Creating icustays_queries.sql file
 subject_ids = df["subject_id"].dropna().unique()
@@ -1,9 +1,12 @@
 import os
+import sys
 import pandas as pd
-import torch
-from transformers import AutoTokenizer, AutoModelForCausalLM, pipeline
-import sqlite3
 import re
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from context_budget import prompt_budget, fit_payload
+from generation_backends import backend_from_env
+from table_pipeline import TablePipeline, run_options, run_table
  
  
 # ======================
@@ -21,34 +24,13 @@ HF_TOKEN = os.getenv("HF_TOKEN") or os.getenv("HUGGINGFACE_HUB_TOKEN")
 # "mistralai/Mistral-7B-Instruct-v0.2"
 # "microsoft/Phi-3-mini-4k-instruct"
 # "meta-llama/Llama-3.3-70B-Instruct"
- 
-print(f"Loading model: {MODEL_NAME}")
-
-# Load the tokenizer so text can be converted into model tokens.
-tokenizer = AutoTokenizer.from_pretrained(MODEL_NAME, token=HF_TOKEN)
- 
-# Load the actual language model on CPU.
-model = AutoModelForCausalLM.from_pretrained(
-    MODEL_NAME,
-    token=HF_TOKEN,
-    dtype=torch.float16,   
-    device_map="auto"
-)
 
-# Some models do not define a pad token, so we reuse the EOS token.
-if tokenizer.pad_token is None:
-    tokenizer.pad_token = tokenizer.eos_token
+# Optional small draft model for speculative decoding (same outputs with do_sample=False, faster decode).
+# e.g. "meta-llama/Llama-3.2-1B-Instruct" for the Llama-3.1-8B target. Leave unset to disable.
+DRAFT_MODEL_NAME = os.getenv("DRAFT_MODEL_NAME")
 
-# Create a text-generation pipeline so we can call the model more easily.
-generator = pipeline(
-    "text-generation",
-    model=model,
-    tokenizer=tokenizer,
-    max_new_tokens=400,
-    do_sample=False,
-    pad_token_id=tokenizer.eos_token_id
-
-)
+# Serialization of the summary context: text ("Field: value" lines) | json | compact | table | delta.
+CONTEXT_ENCODING = os.getenv("CONTEXT_ENCODING", "text")
  
  # ======================
 # HELPERS
@@ -75,13 +57,9 @@ def extract_sql(text):
 
     return sql + ";"
 
-# Ask the LLM to generate SQL for one patient.
-# Return:
-# 1. the prompt sent to the model
-# 2. the raw model output
-# 3. the cleaned SQL that will be executed
-def generate_sql(subject_id):
-    prompt = f"""
+# Build the prompt that asks the LLM to generate SQL for one patient.
+def build_sql_prompt(subject_id):
+    return f"""
 You are a clinical SQL assistant.
 
 Write one SQLite query for the table icustays with these columns:
@@ -101,17 +79,18 @@ Requirements:
 - Do not use markdown unless it is a sql code block
 """
 
-    result = generator(prompt)
-    raw_sql_output = result[0]["generated_text"][len(prompt):].strip()
-    sql = extract_sql(result[0]["generated_text"][len(prompt):].strip())
+
+# Clean the raw model output into the SQL that will be executed.
+def parse_sql(raw_sql_output, subject_id):
+    sql = extract_sql(raw_sql_output)
     if not sql.lower().strip().startswith("select"):
         raise ValueError(f"Model did not return SQL: {raw_sql_output}")
 
-    return prompt, raw_sql_output, sql
+    return sql
 
 # Turn the SQL query results into readable patient context text.
 # This text is what gets sent into the second LLM step for summarization.
-def build_patient_context(subject_id, group):
+def build_patient_text(subject_id, group):
     lines = [f"Patient ID: {subject_id}"]
 
     for _, row in group.iterrows():
@@ -143,10 +122,46 @@ def build_patient_context(subject_id, group):
 
     return "\n".join(lines)
 
-# Ask the LLM to convert the structured ICU context into a short narrative summary.
-# Return both the prompt and the final generated summary.
-def generate_summary(context):
-    prompt = f"""
+
+# Per-record list in the payload for the json/compact/table/delta encodings.
+CONTEXT_LIST_KEY = "icu_stays"
+
+
+def build_patient_payload(subject_id, group):
+    stays = []
+    for _, row in group.iterrows():
+        stays.append(
+            {
+                "hadm_id": safe_str(row.get("hadm_id")),
+                "stay_id": safe_str(row.get("stay_id")),
+                "first_careunit": safe_str(row.get("first_careunit")),
+                "last_careunit": safe_str(row.get("last_careunit")),
+                "intime": safe_str(row.get("intime")),
+                "outtime": safe_str(row.get("outtime")),
+                "los": safe_str(row.get("los")),
+            }
+        )
+
+    return {"patient_id": int(subject_id), CONTEXT_LIST_KEY: stays}
+
+
+def build_patient_context(subject_id, group, max_new_tokens, backend):
+    if CONTEXT_ENCODING == "text":
+        # ICU stays are a handful of short rows per patient, so the text context is never trimmed.
+        return build_patient_text(subject_id, group), {"kept": len(group), "dropped": 0}
+
+    return fit_payload(
+        build_patient_payload(subject_id, group),
+        CONTEXT_LIST_KEY,
+        build_summary_prompt,
+        backend.tokenizer,
+        prompt_budget(backend.context_window, max_new_tokens),
+        encoding=CONTEXT_ENCODING,
+    )
+
+# Prompt that asks the LLM to convert the structured ICU context into a short narrative summary.
+def build_summary_prompt(context):
+    return f"""
 You are a clinical documentation assistant.
 
 Summarize this patient's ICU stays clearly and concisely.
@@ -156,9 +171,9 @@ Do not mention SQL.
 {context}
 """
 
-    result = generator(prompt)
-    summary = result[0]["generated_text"][len(prompt):].strip()
-    return prompt, summary
+
+def summary_max_new_tokens(result_df):
+    return 400
 
 # ======================
 # MAIN
@@ -172,61 +187,27 @@ file_path = "/storage/ice1/0/2/sfatima7/icustays.csv"
 output_file = "/storage/ice1/0/2/sfatima7/icustays_prose_MG.txt"
 sql_file = "/storage/ice1/0/2/sfatima7/icustays_queries_MG.sql"
 
-# Load the ICU CSV into pandas.
-df = pd.read_csv(file_path)
-
-print(f"Loaded {len(df)} rows")
-
-# Load the CSV data into an in-memory SQLite database so the LLM-generated SQL can be executed.
-conn = sqlite3.connect(":memory:")
-df.to_sql("icustays", conn, index=False, if_exists="replace")
-
-# Get the unique patient IDs we want to process.
-subject_ids = df["subject_id"].dropna().astype(int).unique()
-print(f"Processing {len(subject_ids)} patients")
-
-# Open output files:
-# 1. prose file for prompts + summaries
-# 2. sql file for the final executed SQL queries
-with open(output_file, "w") as prose_handle:
-    with open(sql_file, "w") as sql_handle:
-        for i, subject_id in enumerate(subject_ids):
-            try:
-                # Step 1: ask the LLM to generate SQL for this patient.
-                sql_prompt, raw_sql_output, sql = generate_sql(subject_id)
-
-                # Save the cleaned SQL query separately.
-                sql_handle.write(f"-- Patient {subject_id}\n")
-                sql_handle.write(sql)
-                sql_handle.write("\n\n")
-
-                # Step 2: execute the generated SQL against SQLite.
-                result_df = pd.read_sql_query(sql, conn)
-
-                # Step 3: convert SQL results into text context.
-                context = build_patient_context(subject_id, result_df)
-
-                # Step 4: ask the LLM to summarize the ICU stays.
-                summary_prompt, summary = generate_summary(context)
-
-                # Save everything that went into and came out of the LLM so the pipeline is easy to inspect later.
-                prose_handle.write(f"=== Patient {subject_id} ===\n")
-                prose_handle.write("SQL PROMPT:\n")
-                prose_handle.write(sql_prompt.strip() + "\n\n")
-                prose_handle.write("RAW SQL OUTPUT:\n")
-                prose_handle.write(raw_sql_output + "\n\n")
-                prose_handle.write("EXECUTED SQL:\n")
-                prose_handle.write(sql + "\n\n")
-                prose_handle.write("SUMMARY PROMPT:\n")
-                prose_handle.write(summary_prompt.strip() + "\n\n")
-                prose_handle.write("SUMMARY OUTPUT:\n")
-                prose_handle.write(summary + "\n\n")
-
-                print(f"Done {i+1}/{len(subject_ids)}")
-            except Exception as e:
-                print(f"Failed for patient {subject_id}: {e}")
-                
-# Close the SQLite connection once processing is done.
-conn.close()
-
-print("Finished everything.")
\ No newline at end of file
+PIPELINE = TablePipeline(
+    table="icustays",
+    input_files={"icustays": file_path},
+    output_file=output_file,
+    sql_file=sql_file,
+    build_sql_prompt=build_sql_prompt,
+    parse_sql=parse_sql,
+    build_patient_context=build_patient_context,
+    build_summary_prompt=build_summary_prompt,
+    summary_max_new_tokens=summary_max_new_tokens,
+    sql_max_new_tokens=400,
+    context_unit="ICU stays",
+)
+
+
+def main():
+    # Set GEN_BACKEND=ollama|openai|stub to run the same prompts on another backend.
+    backend = backend_from_env(MODEL_NAME, max_new_tokens=400, draft_model_name=DRAFT_MODEL_NAME, token=HF_TOKEN)
+    # --resume / --retry-failed continue an interrupted run from its ledger.
+    run_table(PIPELINE, backend, **run_options())
+
+
+if __name__ == "__main__":
+    main()
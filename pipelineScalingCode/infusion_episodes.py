@@ -0,0 +1,175 @@
+"""
+Merge ingredientevents rows into continuous administration episodes with rate segments.
+
+One infusion is charted as many rows (ChangeDose/Rate, Paused, FinishedRunning, ...).
+Rows of the same (subject_id, stay_id, label) whose starttime falls within
+MAX_GAP_MINUTES of the latest endtime so far belong to one episode; inside an
+episode, consecutive rows with the same rate form one rate segment. Each episode
+becomes
+
+    {"start", "end", "hours", "events", "amount", "amountuom",
+     "rate_segments": ["<starttime>: <rate>", ...], "rateuom", "last_status"}
+
+The merge is one sorted sweep over the whole table: rows are sorted by key and
+starttime, and the running max endtime per key is a single np.maximum.accumulate
+over endtimes offset by the key number, so no Python loop runs per row.
+
+    episode_records(df)      # {(subject_id, label): [episode, ...]} in time order
+    ingredient_records(df)   # label_records(...) with an "episodes" list per label
+"""
+
+import numpy as np
+import pandas as pd
+
+from icu_context import UNKNOWN_LABEL, clean_status, fmt_num, label_records, safe_str
+
+
+# Rows starting up to this long after the episode's latest endtime continue it
+# (short pauses, bag changes); a longer gap starts a new episode.
+MAX_GAP_MINUTES = 60
+
+# Per label, at most this many episodes (the first ones) and segments per episode are kept.
+# Episodes are keyed on the label as label_records formats it (safe_str).
+MAX_EPISODES = 10
+MAX_SEGMENTS = 8
+
+KEYS = ["subject_id", "stay_id", "label"]
+
+
+# ======================
+# SWEEP
+# ======================
+
+# fn applied once per distinct value (rates, units and statuses repeat a lot).
+def _format_unique(series, fn):
+    mapping = {value: fn(value) for value in pd.unique(series.dropna())}
+    return [mapping.get(value) if value == value else None for value in series.tolist()]
+
+
+def _prepare(df):
+    df = df.assign(
+        stay_id=df["stay_id"].fillna(-1) if "stay_id" in df.columns else -1,
+        label=df["label"].fillna(UNKNOWN_LABEL) if "label" in df.columns else UNKNOWN_LABEL,
+        _start=pd.to_datetime(df["starttime"], errors="coerce"),
+        _end=pd.to_datetime(df["endtime"], errors="coerce") if "endtime" in df.columns else pd.NaT,
+    )
+    for col in ["hadm_id", "amount", "amountuom", "rate", "rateuom", "statusdescription"]:
+        if col not in df.columns:
+            df[col] = None
+    df = df[df["_start"].notna()]
+    df = df.assign(_end=df["_end"].where(df["_end"] >= df["_start"], df["_start"]))
+    return df.sort_values(KEYS + ["_start"], kind="mergesort").reset_index(drop=True)
+
+
+# Episode number per row of a frame sorted by KEYS + starttime.
+def _episode_ids(df):
+    key = df.groupby(KEYS, sort=False).ngroup().to_numpy()
+    # Seconds keep key * span well inside int64 for any cohort size.
+    start = df["_start"].to_numpy().astype("datetime64[s]").astype(np.int64)
+    end = df["_end"].to_numpy().astype("datetime64[s]").astype(np.int64)
+
+    new_key = np.ones(len(df), dtype=bool)
+    new_key[1:] = key[1:] != key[:-1]
+
+    # Running max endtime within each key: offsetting every key past the previous
+    # one's range lets one accumulate run over the whole table.
+    base = start.min() if len(start) else 0
+    span = int(max(end.max() - base, 0)) + 1 if len(end) else 1
+    running = np.maximum.accumulate((end - base) + key.astype(np.int64) * span)
+    previous_end = np.empty_like(running)
+    previous_end[0] = 0
+    previous_end[1:] = running[:-1] - key[1:].astype(np.int64) * span + base
+
+    gap = np.int64(MAX_GAP_MINUTES) * 60
+    new_episode = new_key | (start > previous_end + gap)
+    return np.cumsum(new_episode) - 1, new_episode
+
+
+# Rate segment strings per episode: a new segment wherever the (2-decimal) rate changes.
+def _segments(df, episode, new_episode):
+    rate = np.array([v or "" for v in _format_unique(df["rate"], fmt_num)], dtype=object)
+    new_segment = new_episode.copy()
+    new_segment[1:] |= rate[1:] != rate[:-1]
+    new_segment &= rate != ""
+
+    starts = df["starttime"].astype(str).to_numpy(dtype=object)
+    out = {}
+    for ep, start, value in zip(episode[new_segment].tolist(), starts[new_segment].tolist(), rate[new_segment].tolist()):
+        out.setdefault(ep, []).append(f"{start}: {value}")
+    return out
+
+
+# ======================
+# EPISODES
+# ======================
+
+def episode_records(df):
+    if df.empty:
+        return {}
+    df = _prepare(df)
+    if df.empty:
+        return {}
+
+    episode, new_episode = _episode_ids(df)
+    df = df.assign(_episode=episode, _status=df["statusdescription"].map(clean_status))
+    amount = pd.to_numeric(df["amount"], errors="coerce")
+
+    episodes = df.assign(_amount=amount).groupby("_episode", sort=True).agg(
+        subject_id=("subject_id", "first"),
+        label=("label", "first"),
+        stay_id=("stay_id", "first"),
+        end_time=("_end", "max"),
+        start_time=("_start", "first"),
+        events=("label", "size"),
+        amount=("_amount", "sum"),
+        amountuom=("amountuom", "first"),
+        rateuom=("rateuom", "first"),
+        last_status=("_status", "last"),
+    )
+    episodes = episodes.sort_values(["subject_id", "label", "start_time"], kind="mergesort")
+    hours = (episodes["end_time"] - episodes["start_time"]).dt.total_seconds() / 3600
+    segments = _segments(df, episode, new_episode)
+
+    start = episodes["start_time"].dt.strftime("%Y-%m-%d %H:%M:%S").tolist()
+    end = episodes["end_time"].dt.strftime("%Y-%m-%d %H:%M:%S").tolist()
+    amount = episodes["amount"].where(episodes["amount"] != 0)
+    columns = zip(
+        episodes.index.tolist(), episodes["subject_id"].tolist(), _format_unique(episodes["label"], safe_str),
+        start, end, hours.round(1).tolist(), episodes["events"].tolist(),
+        _format_unique(amount, fmt_num), _format_unique(episodes["amountuom"], safe_str),
+        _format_unique(episodes["rateuom"], safe_str), _format_unique(episodes["last_status"], safe_str),
+    )
+
+    out = {}
+    for ep, subject_id, label, start, end, hours, events, total, amountuom, rateuom, status in columns:
+        rate_segments = segments.get(ep, [])
+        out.setdefault((subject_id, label), []).append({
+            "start": start,
+            "end": end,
+            "hours": hours,
+            "events": int(events),
+            "amount": total,
+            "amountuom": amountuom,
+            "rate_segments": rate_segments[:MAX_SEGMENTS],
+            "rateuom": rateuom if rate_segments else None,
+            "last_status": status,
+        })
+    return out
+
+
+# ======================
+# RECORDS
+# ======================
+
+# summarize(df) for CohortLabelContext: the per-label records of label_records, each
+# with its episodes in time order (episodes of all stays; MAX_EPISODES at most).
+def ingredient_records(df, time_col="starttime", sorted_statuses=True):
+    records = label_records(df, time_col=time_col, sorted_statuses=sorted_statuses)
+    episodes = episode_records(df)
+
+    for subject_id, label_list in records.items():
+        for record in label_list:
+            found = episodes.get((subject_id, record["label"]), [])
+            record["n_episodes"] = len(found)
+            record["episodes"] = found[:MAX_EPISODES]
+    return records
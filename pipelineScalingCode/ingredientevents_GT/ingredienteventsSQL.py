@@ -1,17 +1,10 @@
 import pandas as pd
 import os
+import sys
 
-def safe_lower(value):
-    """Return lowercase string if possible, else None."""
-    if isinstance(value, str) and value.strip():
-        return value.lower()
-    return None
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-def safe_str(value):
-    """Return string if not NaN, else None."""
-    if pd.isna(value) or str(value).strip() == '':
-        return None
-    return str(value)
+from gt_prose import Prose, mapped, number, text, write_prose
 
 def clean_status(value):
     if not isinstance(value, str):
@@ -30,64 +23,45 @@ def clean_status(value):
 
     return v
 
-def fmt_num(x, digits=2):
-    if x is None or pd.isna(x):
-        return None
-    try:
-        return f"{float(x):.{digits}f}"
-    except:
-        return str(x)
-
-#Converting a row from icustays to descriptive prose
-def row_to_prose(row):
-    sentences = []
-
-    subject_id = safe_str(row.get("subject_id"))
-    hadm_id = safe_str(row.get("hadm_id"))
-    stay_id = safe_str(row.get("stay_id"))
-
-    starttime = safe_str(row.get("starttime"))
-    endtime = safe_str(row.get("endtime"))
-    drug_label = safe_str(row.get("label"))   # ← from d_items
-    
+#Converting ingredientevents to descriptive prose, one line per row (rendered column-wise)
+def frame_to_prose(df):
+    prose = Prose(df)
+
+    subject_id = text(df, "subject_id")
+    hadm_id = text(df, "hadm_id")
+    stay_id = text(df, "stay_id")
+
+    starttime = text(df, "starttime")
+    endtime = text(df, "endtime")
+    drug_label = text(df, "label")   # ← from d_items
+
     # patient id and timing
-    if subject_id and starttime and endtime:
-        sentences.append(f"Patient {subject_id} received {drug_label or 'medication'} from {starttime} to {endtime}.")
+    prose.add(subject_id.present & starttime.present & endtime.present,
+              "Patient ", subject_id, " received ", drug_label.or_("medication"), " from ", starttime, " to ", endtime, ".")
     # IDs
-    if hadm_id:
-        sentences.append(f"The hospital admission ID was {hadm_id}.")
-    if stay_id:
-        sentences.append(f"The ICU stay ID was {stay_id}.")
-    
-    # Ingredient info
-    itemid = safe_str(row.get("itemid"))
-    
+    prose.add(hadm_id.present, "The hospital admission ID was ", hadm_id, ".")
+    prose.add(stay_id.present, "The ICU stay ID was ", stay_id, ".")
 
-    amount = fmt_num(row.get("amount"))
-    amountuom = safe_str(row.get("amountuom"))
+    # Ingredient info
+    amount = number(df, "amount")
+    amountuom = text(df, "amountuom")
 
-    rate = fmt_num(row.get("rate"))
-    rateuom = safe_str(row.get("rateuom"))
+    rate = number(df, "rate")
+    rateuom = text(df, "rateuom")
 
-    status = clean_status(row.get("statusdescription"))
+    status = mapped(df, "statusdescription", clean_status)
 
-    originalrate = fmt_num(row.get("originalrate"))
+    originalrate = number(df, "originalrate")
 
-    #if itemid:
-    #    sentences.append(f"The medication item ID was {itemid}.")
-    if amount and amountuom:
-        sentences.append(f"The recorded amount was {amount} {amountuom}.")
-    if rate and rateuom:
-        sentences.append(f"The infusion rate was {rate} {rateuom}.")
-    
+    prose.add(amount.present & amountuom.present, "The recorded amount was ", amount, " ", amountuom, ".")
+    prose.add(rate.present & rateuom.present, "The infusion rate was ", rate, " ", rateuom, ".")
 
     # ONLY include original rate if the status indicates a dose/rate change
-    if status and ("rate" in status) and originalrate:
-        sentences.append(f"The infusion rate was changed from {originalrate} {rateuom}.")
-    elif status:
-        sentences.append(f"The infusion {status}.")
-    
-    return " ".join(sentences)
+    rate_change = status.present & pd.Series(status.values).str.contains("rate", regex=False).to_numpy() & originalrate.present
+    prose.add(rate_change, "The infusion rate was changed from ", originalrate, " ", rateuom.or_("None"), ".")
+    prose.add(status.present & ~rate_change, "The infusion ", status, ".")
+
+    return prose.lines()
 
 #------MAIN--------    
 
@@ -102,16 +76,11 @@ print(f"Loaded ingredientevents: {df.shape}")
 df_items = pd.read_csv(items_path)
 df = df.merge(df_items[["itemid", "label"]], on="itemid", how="left")
 
-# Convert to prose
-prose_descriptions = df.apply(row_to_prose, axis=1).tolist()
-
-# Save to a single text file
+# Convert to prose and save to a single text file, double newline between patients
 output_file = r"pipelineScalingCode/ingredientevents_prose.txt"
-with open(output_file, "w", encoding="utf-8") as f:
-    for line in prose_descriptions:
-        f.write(line + "\n\n")  # double newline between patients
+n_lines = write_prose(output_file, df, frame_to_prose)
 
-print(f"Saved {len(prose_descriptions)} patient descriptions to {output_file}")
+print(f"Saved {n_lines} patient descriptions to {output_file}")
     
 # Creating ingredientevents_queries.sql file
 
@@ -1,11 +1,14 @@
 import os
 import re
-import sqlite3
+import sys
 
-import pandas as pd
-import torch
-from transformers import AutoTokenizer, AutoModelForCausalLM, pipeline
-import json
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from context_budget import EVENT_SUMMARY_MIN_NEW_TOKENS, prompt_budget, scale_max_new_tokens, fit_payload
+from generation_backends import backend_from_env
+from hierarchical_summary import HierarchicalConfig
+from icu_context import CohortLabelContext
+from infusion_episodes import ingredient_records
+from table_pipeline import TablePipeline, run_options, run_table
 
 
 # ======================
@@ -23,66 +26,18 @@ MODEL_NAME = "meta-llama/Llama-3.1-8B-Instruct"
 # "microsoft/Phi-3-mini-4k-instruct"
 # "meta-llama/Llama-3.3-70B-Instruct"
 
-print(f"Loading model: {MODEL_NAME}")
+# Optional small draft model for speculative decoding (same outputs with do_sample=False, faster decode).
+# e.g. "meta-llama/Llama-3.2-1B-Instruct" for the Llama-3.1-8B target. Leave unset to disable.
+DRAFT_MODEL_NAME = os.getenv("DRAFT_MODEL_NAME")
 
-tokenizer = AutoTokenizer.from_pretrained(MODEL_NAME)
-
-model = AutoModelForCausalLM.from_pretrained(
-    MODEL_NAME,
-    dtype=torch.float16,   
-    device_map="auto"
-)
-
-if tokenizer.pad_token is None:
-    tokenizer.pad_token = tokenizer.eos_token
-
-generator = pipeline(
-    "text-generation",
-    model=model,
-    tokenizer=tokenizer,
-    max_new_tokens=500,
-    do_sample=False,
-    pad_token_id=tokenizer.eos_token_id
-)
+# Serialization of the summary context: json | compact | table | delta (see context_encodings.py).
+CONTEXT_ENCODING = os.getenv("CONTEXT_ENCODING", "json")
 
 
 # ======================
 # HELPERS
 # ======================
 
-def safe_str(value):
-    if pd.isna(value) or str(value).strip() == "":
-        return None
-    return str(value).strip()
-
-
-def fmt_num(value, digits=2):
-    if value is None or pd.isna(value):
-        return None
-    try:
-        return f"{float(value):.{digits}f}"
-    except Exception:
-        return str(value).strip()
-
-
-def clean_status(value):
-    if not isinstance(value, str):
-        return None
-
-    v = value.strip().lower()
-
-    if v == "changedose/rate":
-        return "infusion rate was changed"
-    if v == "finishedrunning":
-        return "finished running"
-    if v == "stopped":
-        return "was stopped"
-    if v == "paused":
-        return "was paused"
-
-    return v
-
-
 def extract_sql(text):
     match = re.search(r"```sql\s*(.*?)```", text, re.IGNORECASE | re.DOTALL)
     if match:
@@ -98,8 +53,7 @@ def extract_sql(text):
     return sql + ";"
 
 
-def fallback_sql(subject_id):
-    return f"""
+EVENTS_SELECT = """
 SELECT
     ie.subject_id,
     ie.hadm_id,
@@ -117,17 +71,32 @@ SELECT
 FROM ingredientevents ie
 LEFT JOIN d_items di
     ON ie.itemid = di.itemid
+""".strip()
+
+
+def fallback_sql(subject_id):
+    return f"""
+{EVENTS_SELECT}
 WHERE ie.subject_id = {subject_id}
 ORDER BY ie.starttime ASC;
 """.strip()
 
 
+# Same columns as fallback_sql for every patient; label aggregates and infusion episodes
+# are computed from this once per run.
+COHORT = CohortLabelContext(
+    f"{EVENTS_SELECT}\nORDER BY ie.subject_id, ie.starttime ASC;",
+    sorted_statuses=True,
+    summarize=ingredient_records,
+)
+
+
 # ======================
 # STEP 1: SQL GENERATION
 # ======================
 
-def generate_sql(subject_id):
-    prompt = f"""
+def build_sql_prompt(subject_id):
+    return f"""
 You are a clinical SQL assistant.
 
 Write ONE SQLite query using:
@@ -151,14 +120,14 @@ Rules:
 - Do not return Python
 """.strip()
 
-    result = generator(prompt, max_new_tokens=500, do_sample=False)
-    raw_sql = result[0]["generated_text"][len(prompt):].strip()
+
+def parse_sql(raw_sql, subject_id):
     sql = extract_sql(raw_sql)
 
     if "select" not in sql.lower():
         sql = fallback_sql(subject_id)
 
-    return prompt, raw_sql, sql
+    return sql
 
 
 # ======================
@@ -209,46 +178,45 @@ def build_patient_context(subject_id, group):
     return "\n".join(lines)
 """
 
-def build_patient_context(subject_id, group):
-    g = group.copy()
-    if "starttime" in g.columns:
-        g = g.sort_values("starttime")
-
-    # Aggregate by medication label so we summarize ALL events without blowing context length.
-    summaries = []
-    for label, grp in g.groupby(g.get("label").fillna("UNKNOWN_LABEL")):
-        rec = {
-            "label": safe_str(label),
-            "count_events": int(len(grp)),
-            "hadm_id": safe_str(grp["hadm_id"].dropna().iloc[0]) if "hadm_id" in grp and grp["hadm_id"].notna().any() else None,
-            "stay_id": safe_str(grp["stay_id"].dropna().iloc[0]) if "stay_id" in grp and grp["stay_id"].notna().any() else None,
-            "first_starttime": safe_str(grp["starttime"].dropna().iloc[0]) if "starttime" in grp and grp["starttime"].notna().any() else None,
-            "last_endtime": safe_str(grp["endtime"].dropna().iloc[-1]) if "endtime" in grp and grp["endtime"].notna().any() else None,
-            "example_amount": fmt_num(grp["amount"].dropna().iloc[0]) if "amount" in grp and grp["amount"].notna().any() else None,
-            "amountuom": safe_str(grp["amountuom"].dropna().iloc[0]) if "amountuom" in grp and grp["amountuom"].notna().any() else None,
-            "example_rate": fmt_num(grp["rate"].dropna().iloc[0]) if "rate" in grp and grp["rate"].notna().any() else None,
-            "rateuom": safe_str(grp["rateuom"].dropna().iloc[0]) if "rateuom" in grp and grp["rateuom"].notna().any() else None,
-            "statuses_seen": sorted({clean_status(x) for x in grp.get("statusdescription", pd.Series([])).dropna().tolist() if clean_status(x)}),
-        }
-        summaries.append(rec)
+# Per-record list in the payload; fit_payload trims this list when the prompt is too long.
+CONTEXT_LIST_KEY = "ingredient_event_summary_by_label"
+
+
+def build_patient_payload(subject_id, group):
+    # One record per label, most frequent first, with its merged administration episodes
+    # (see infusion_episodes.py); fit_payload drops from the tail if the prompt is too long.
+    summaries = COHORT.records(subject_id, group)
 
     payload = {
         "patient_id": int(subject_id),
-        "ingredient_event_summary_by_label": summaries,
+        CONTEXT_LIST_KEY: summaries,
     }
-    return json.dumps(payload, ensure_ascii=True)
+    return payload
+
+
+def build_patient_context(subject_id, group, max_new_tokens, backend):
+    return fit_payload(
+        build_patient_payload(subject_id, group),
+        CONTEXT_LIST_KEY,
+        build_summary_prompt,
+        backend.tokenizer,
+        prompt_budget(backend.context_window, max_new_tokens),
+        encoding=CONTEXT_ENCODING,
+    )
 
 # ======================
 # STEP 3: SUMMARY GENERATION
 # ======================
 
-def generate_summary(context):
-    prompt = f"""
+def build_summary_prompt(context):
+    return f"""
 You are a clinical medication documentation assistant.
 
 Write natural language paragraph summarizing this patient's ICU ingredient events.
 No bullets, no numbering, no headings, no “Field: value” labels.
 Do not list every event. Synthesize patterns across the data.
+Each label lists its administration episodes: continuous infusions with start, end,
+total amount and rate_segments (the time each new rate started and the rate).
 Use ONLY facts in INGREDIENT_EVENTS_JSON. Do not invent times, labels, or IDs.
 Do not mention SQL.
 Do not hallucinate.
@@ -257,9 +225,11 @@ INGREDIENT_EVENTS_JSON:
 {context}
 """.strip()
 
-    result = generator(prompt, max_new_tokens=500, do_sample=False)
-    summary = result[0]["generated_text"][len(prompt):].strip()
-    return prompt, summary
+
+# The context has one record per label, so the decode budget follows the label count.
+def summary_max_new_tokens(result_df):
+    n_labels = result_df["label"].nunique() if "label" in result_df.columns else 1
+    return scale_max_new_tokens(n_labels, floor=EVENT_SUMMARY_MIN_NEW_TOKENS)
 
 
 
@@ -277,43 +247,29 @@ d_items_path = "/storage/ice1/0/2/sfatima7/d_items.csv"
 output_file = "/storage/ice1/0/2/sfatima7/ingredientevents_prose_MG.txt"
 sql_file = "/storage/ice1/0/2/sfatima7/ingredientevents_queries_MG.sql"
 
-ingredient_df = pd.read_csv(ingredientevents_path)
-d_items_df = pd.read_csv(d_items_path)
-
-print(f"Loaded ingredientevents: {ingredient_df.shape}")
-print(f"Loaded d_items: {d_items_df.shape}")
-
-conn = sqlite3.connect(":memory:")
-ingredient_df.to_sql("ingredientevents", conn, index=False, if_exists="replace")
-d_items_df.to_sql("d_items", conn, index=False, if_exists="replace")
-
-subject_ids = ingredient_df["subject_id"].dropna().astype(int).unique()
-print(f"Processing {len(subject_ids)} patients")
-
-with open(output_file, "w", encoding="utf-8") as prose_handle, \
-     open(sql_file, "w", encoding="utf-8") as sql_handle:
-
-    for i, subject_id in enumerate(subject_ids):
-        try:
-            sql_prompt, raw_sql, sql = generate_sql(subject_id)
-
-            sql_handle.write(f"-- Patient {subject_id}\n{sql}\n\n")
-
-            result_df = pd.read_sql_query(sql, conn)
-            context = build_patient_context(subject_id, result_df)
-            summary_prompt, summary = generate_summary(context)
+PIPELINE = TablePipeline(
+    table="ingredientevents",
+    input_files={"ingredientevents": ingredientevents_path, "d_items": d_items_path},
+    output_file=output_file,
+    sql_file=sql_file,
+    build_sql_prompt=build_sql_prompt,
+    parse_sql=parse_sql,
+    build_patient_context=build_patient_context,
+    build_summary_prompt=build_summary_prompt,
+    summary_max_new_tokens=summary_max_new_tokens,
+    sql_max_new_tokens=500,
+    cohort=COHORT,
+    context_unit="ingredient labels",
+    hierarchical=HierarchicalConfig("ICU ingredient events", time_col="starttime"),
+)
 
-            prose_handle.write(f"=== Patient {subject_id} ===\n")
-            prose_handle.write("SQL PROMPT:\n" + sql_prompt + "\n\n")
-            prose_handle.write("RAW SQL OUTPUT:\n" + raw_sql + "\n\n")
-            prose_handle.write("EXECUTED SQL:\n" + sql + "\n\n")
-            prose_handle.write("SUMMARY PROMPT:\n" + summary_prompt + "\n\n")
-            prose_handle.write("SUMMARY OUTPUT:\n" + summary + "\n\n")
 
-            print(f"Done {i+1}/{len(subject_ids)}")
+def main():
+    # Set GEN_BACKEND=ollama|openai|stub to run the same prompts on another backend.
+    backend = backend_from_env(MODEL_NAME, max_new_tokens=500, draft_model_name=DRAFT_MODEL_NAME)
+    # --resume / --retry-failed continue an interrupted run from its ledger.
+    run_table(PIPELINE, backend, **run_options())
 
-        except Exception as e:
-            print(f"Failed for patient {subject_id}: {e}")
 
-conn.close()
-print("Finished everything.")
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,174 @@
+"""
+Continuous batching of generation jobs across tables and patients.
+
+Jobs (SQL or summary prompts from any table) go into one queue. Whenever a
+worker is free, the scheduler takes the oldest waiting job and fills the rest of
+the batch with the queued jobs closest to it in prompt length, so padding stays
+small. Finished jobs run their callback, which can submit follow-up jobs (e.g.
+the summary job for a patient once its SQL has run), so new work is admitted
+as soon as earlier work finishes instead of at the end of a table.
+
+Waiting jobs are kept sorted by prompt length (bisect) with a heap of submission
+order for the oldest one, so forming a batch looks only at the anchor's
+neighbours instead of the whole queue. run(feed=...) admits patients lazily: it
+calls the next submit function from feed whenever fewer than admit_window jobs
+are waiting, so the queue stays small however many patients the run has.
+"""
+
+import bisect
+import heapq
+import itertools
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+
+# Sort key of a by_length entry: (prompt_tokens, seq).
+def _length_key(entry):
+    return entry[:2]
+
+
+class GenerationJob:
+    def __init__(self, prompt, max_new_tokens, on_done, on_error=None, tag=None):
+        self.prompt = prompt
+        self.max_new_tokens = max_new_tokens
+        self.on_done = on_done
+        self.on_error = on_error
+        self.tag = tag
+        self.prompt_tokens = 0
+        self.seq = 0
+
+
+class ContinuousBatchScheduler:
+    def __init__(self, backend, max_batch_size=8, max_batch_tokens=16384, workers=1, admit_window=None):
+        # max_batch_tokens bounds the padded batch: size * (longest prompt + largest decode budget).
+        self.backend = backend
+        self.max_batch_size = max_batch_size
+        self.max_batch_tokens = max_batch_tokens
+        self.workers = workers
+        # Jobs kept waiting before run() admits more from its feed.
+        self.admit_window = admit_window or 4 * max_batch_size * workers
+        self.by_length = []   # (prompt_tokens, seq, job), sorted
+        self.by_seq = []      # heap of (seq, job); entries of jobs already taken are skipped
+        self._counter = itertools.count()
+        self.batches = 0
+
+    def submit(self, job):
+        job.prompt_tokens = self.backend.count_tokens(job.prompt)
+        job.seq = next(self._counter)
+        bisect.insort(self.by_length, (job.prompt_tokens, job.seq, job), key=_length_key)
+        heapq.heappush(self.by_seq, (job.seq, job))
+
+    def waiting(self):
+        return len(self.by_length)
+
+    # ======================
+    # BATCH FORMING
+    # ======================
+
+    def _padded_tokens(self, jobs):
+        longest = max(job.prompt_tokens for job in jobs)
+        decode = max(job.max_new_tokens or self.backend.max_new_tokens for job in jobs)
+        return len(jobs) * (longest + decode)
+
+    def _position(self, job):
+        return bisect.bisect_left(self.by_length, (job.prompt_tokens, job.seq), key=_length_key)
+
+    # Entries below position, nearest length first and oldest first within a length.
+    def _below(self, position):
+        end = position
+        while end > 0:
+            start = bisect.bisect_left(self.by_length, (self.by_length[end - 1][0], -1), key=_length_key)
+            yield from self.by_length[start:end]
+            end = start
+
+    # Oldest job first (so nothing starves), then its nearest neighbours by prompt length,
+    # walking outwards from the anchor's place in the length order.
+    def _next_batch(self):
+        while True:
+            _, anchor = heapq.heappop(self.by_seq)
+            position = self._position(anchor)
+            if position < len(self.by_length) and self.by_length[position][2] is anchor:
+                break
+        batch = [anchor]
+
+        below = self._below(position)
+        above = (self.by_length[i] for i in range(position + 1, len(self.by_length)))
+        down, up = next(below, None), next(above, None)
+        while len(batch) < self.max_batch_size and (down or up):
+            # Any further job pads the batch to at least this.
+            if self._padded_tokens(batch) // len(batch) * (len(batch) + 1) > self.max_batch_tokens:
+                break
+            closer_below = down is not None and (
+                up is None or (anchor.prompt_tokens - down[0], down[1]) < (up[0] - anchor.prompt_tokens, up[1])
+            )
+            if closer_below:
+                job, down = down[2], next(below, None)
+            else:
+                job, up = up[2], next(above, None)
+                # Longer prompts only pad more: stop going up once the prompt alone does not fit.
+                if (len(batch) + 1) * job.prompt_tokens > self.max_batch_tokens:
+                    up = None
+                    continue
+            if self._padded_tokens(batch + [job]) <= self.max_batch_tokens:
+                batch.append(job)
+
+        for job in batch:
+            del self.by_length[self._position(job)]
+        return batch
+
+    def _run_batch(self, batch):
+        return self.backend.generate_batch(
+            [job.prompt for job in batch],
+            [job.max_new_tokens for job in batch],
+        )
+
+    # ======================
+    # RUN LOOP
+    # ======================
+
+    # Call submit functions from feed (each submits one patient's first jobs) until
+    # admit_window jobs are waiting. Returns None once feed is exhausted.
+    def _admit(self, feed):
+        while feed is not None and self.waiting() < self.admit_window:
+            submit = next(feed, None)
+            if submit is None:
+                return None
+            submit()
+        return feed
+
+    # Callbacks run on the calling thread, so writers and sqlite connections need no locking.
+    def run(self, feed=None):
+        start = time.perf_counter()
+        running = {}
+        feed = iter(feed) if feed is not None else None
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            while True:
+                feed = self._admit(feed)
+                if not (self.by_length or running):
+                    break
+                while self.by_length and len(running) < self.workers:
+                    batch = self._next_batch()
+                    running[pool.submit(self._run_batch, batch)] = batch
+                    self.batches += 1
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    batch = running.pop(future)
+                    try:
+                        results = future.result()
+                    except Exception as e:
+                        for job in batch:
+                            if job.on_error:
+                                job.on_error(e)
+                        continue
+
+                    for job, result in zip(batch, results):
+                        try:
+                            job.on_done(result)
+                        except Exception as e:
+                            if job.on_error:
+                                job.on_error(e)
+
+        elapsed = time.perf_counter() - start
+        print(f"Scheduler: {self.batches} batches in {elapsed:.1f}s")
@@ -0,0 +1,225 @@
+"""
+Compact time-series statistics for outputevents (charttime / value / valueuom), for the whole cohort at once.
+
+Listing every measurement would blow the context, and the generic label aggregates in
+icu_context.py look for starttime/amount/rate columns outputevents does not have. Here
+each (subject_id, stay_id, label) series becomes one record of fixed size:
+
+    count, first/last charttime, unit, total, min/max/mean of single values,
+    daily totals (days, min/max/mean), trend of the daily totals per day,
+    and up to MAX_CHANGE_POINTS notable day-to-day changes
+
+Daily totals run over every calendar day from a series' first to its last measured
+day; a day in between without output totals 0, so changes are against the day before
+and the trend sees the empty days.
+
+Every statistic is a groupby over the full table (daily totals by flooring charttime
+to the day, the trend as a least-squares slope from grouped sums), so the cost does
+not depend on how many patients or labels there are.
+
+    COHORT = CohortLabelContext(COHORT_SQL, summarize=series_records, fingerprint_columns=SERIES_COLUMNS)
+"""
+
+import numpy as np
+import pandas as pd
+
+from icu_context import UNKNOWN_LABEL, safe_str
+
+
+# Columns the records are built from; used to check a SQL result against the cohort.
+SERIES_COLUMNS = ["subject_id", "hadm_id", "stay_id", "charttime", "label", "value", "valueuom"]
+
+KEYS = ["subject_id", "stay_id", "label"]
+
+# A day-to-day change is notable when the daily total moves by at least this
+# fraction of the previous day; the largest MAX_CHANGE_POINTS per series are kept.
+CHANGE_RATIO = 0.5
+MAX_CHANGE_POINTS = 3
+
+
+# ======================
+# HELPERS
+# ======================
+
+# Column formatters: one pass per column, ints where the rounded value is whole.
+def _num_column(series, digits=1):
+    values = pd.to_numeric(series, errors="coerce").to_numpy(dtype=float).round(digits)
+    out = values.astype(object)
+    finite = np.isfinite(values)
+    whole = finite & (values == np.floor(values))
+    out[whole] = values[whole].astype(np.int64).astype(object)
+    out[~finite] = None
+    return out.tolist()
+
+
+def _id_column(series):
+    if pd.api.types.is_numeric_dtype(series):
+        return [None if v is None else str(v) for v in _num_column(series, 0)]
+    return _str_column(series)
+
+
+def _str_column(series):
+    return [safe_str(v) for v in series.tolist()]
+
+
+def _prepare(df):
+    df = df.assign(
+        stay_id=df["stay_id"].fillna(-1) if "stay_id" in df.columns else -1,
+        label=df["label"].fillna(UNKNOWN_LABEL) if "label" in df.columns else UNKNOWN_LABEL,
+        _time=pd.to_datetime(df["charttime"], errors="coerce") if "charttime" in df.columns else pd.NaT,
+        _value=pd.to_numeric(df["value"], errors="coerce") if "value" in df.columns else np.nan,
+    )
+    for col in ["hadm_id", "valueuom"]:
+        if col not in df.columns:
+            df[col] = None
+    return df.sort_values(["subject_id", "_time"], kind="mergesort")
+
+
+# ======================
+# STATISTICS
+# ======================
+
+# One row per series: counts, time range and value statistics.
+def _series_stats(df):
+    stats = df.groupby(KEYS, sort=True).agg(
+        count_events=("label", "size"),
+        hadm_id=("hadm_id", "first"),
+        valueuom=("valueuom", "first"),
+        first_charttime=("charttime", "first"),
+        last_charttime=("charttime", "last"),
+        total=("_value", "sum"),
+        min=("_value", "min"),
+        max=("_value", "max"),
+        mean=("_value", "mean"),
+        _values=("_value", "count"),
+    )
+    # No numeric value at all: no total either (sum() would give 0), like min/max/mean.
+    stats["total"] = stats["total"].where(stats.pop("_values") > 0)
+    return stats
+
+
+# One row per (series, calendar day) from the series' first to its last measured day,
+# with the day's total (0 on days without output), plus the change from the day before.
+def _daily_totals(df):
+    timed = df[df["_time"].notna()]
+    measured = (
+        timed.assign(day=timed["_time"].dt.floor("D"))
+        .groupby(KEYS + ["day"], sort=True)["_value"].sum(min_count=1)
+        .reset_index(name="daily_total")
+    )
+
+    span = measured.groupby(KEYS, sort=True)["day"].agg(["min", "max"])
+    lengths = (span["max"] - span["min"]).dt.days.to_numpy(dtype=np.int64) + 1
+    offsets = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    daily = span.index.repeat(lengths).to_frame(index=False)
+    daily["day"] = np.repeat(span["min"].to_numpy(), lengths) + pd.to_timedelta(offsets, unit="D")
+
+    daily = daily.merge(measured, on=KEYS + ["day"], how="left", indicator=True)
+    daily["measured"] = daily.pop("_merge") == "both"
+    daily.loc[~daily["measured"], "daily_total"] = 0.0
+
+    previous = daily.groupby(KEYS, sort=False)["daily_total"].shift()
+    daily["previous"] = previous
+    daily["change"] = daily["daily_total"] - previous
+    return daily
+
+
+# Measured days, min/max/mean of the daily totals and the least-squares slope of total vs
+# day number (days without output count as 0).
+def _daily_stats(daily):
+    first_day = daily.groupby(KEYS, sort=False)["day"].transform("min")
+    x = (daily["day"] - first_day).dt.days.astype(float)
+    y = daily["daily_total"]
+    valid = y.notna()
+    frame = pd.DataFrame({
+        "x": x.where(valid), "y": y,
+        "xx": (x * x).where(valid), "xy": x * y, "n": valid.astype(float),
+    })
+    for col in KEYS:
+        frame[col] = daily[col]
+
+    sums = frame.groupby(KEYS, sort=True)[["x", "y", "xx", "xy", "n"]].sum()
+    denominator = sums["n"] * sums["xx"] - sums["x"] ** 2
+    slope = (sums["n"] * sums["xy"] - sums["x"] * sums["y"]) / denominator.where(denominator > 0)
+
+    stats = daily.groupby(KEYS, sort=True)["daily_total"].agg(["min", "max", "mean"])
+    stats.columns = ["daily_total_min", "daily_total_max", "daily_total_mean"]
+    stats.insert(0, "days", daily.groupby(KEYS, sort=True)["measured"].sum())
+    stats["daily_trend"] = slope
+    return stats
+
+
+# The largest notable day-to-day changes per series, in time order, as short strings.
+def _change_points(daily):
+    ratio = daily["change"].abs() / daily["previous"].abs().where(daily["previous"] != 0)
+    notable = daily[(ratio >= CHANGE_RATIO) | ((daily["previous"] == 0) & (daily["change"] != 0))]
+    if notable.empty:
+        return {}
+
+    notable = notable.assign(_size=-notable["change"].abs())
+    notable = notable.sort_values(KEYS + ["_size"], kind="mergesort").groupby(KEYS, sort=False).head(MAX_CHANGE_POINTS)
+    notable = notable.sort_values(KEYS + ["day"], kind="mergesort")
+
+    days = notable["day"].dt.strftime("%Y-%m-%d").tolist()
+    before = _num_column(notable["previous"])
+    after = _num_column(notable["daily_total"])
+    out = {}
+    for key, day, a, b in zip(zip(*(notable[col].tolist() for col in KEYS)), days, before, after):
+        out.setdefault(key, []).append(f"{day}: {a} -> {b}")
+    return out
+
+
+# ======================
+# RECORDS
+# ======================
+
+RECORD_FIELDS = [
+    ("hadm_id", _id_column),
+    ("valueuom", _str_column),
+    ("first_charttime", _str_column),
+    ("last_charttime", _str_column),
+    ("total", _num_column),
+    ("min", _num_column),
+    ("max", _num_column),
+    ("mean", _num_column),
+    ("days", _num_column),
+    ("daily_total_min", _num_column),
+    ("daily_total_max", _num_column),
+    ("daily_total_mean", _num_column),
+    ("daily_trend", lambda series: _num_column(series, 2)),
+]
+
+
+# summarize(df) for CohortLabelContext: {subject_id: [record, ...]}, one record per
+# (stay, label), most measured series first within each patient.
+def series_records(df):
+    if df.empty:
+        return {}
+    df = _prepare(df)
+    summary = _series_stats(df)
+
+    daily = _daily_totals(df)
+    if not daily.empty:
+        summary = summary.join(_daily_stats(daily))
+    changes = _change_points(daily) if not daily.empty else {}
+
+    summary = summary.reset_index()
+    summary["_neg_count"] = -summary["count_events"]
+    summary = summary.sort_values(["subject_id", "_neg_count", "stay_id"], kind="mergesort")
+
+    keys = ["label", "stay_id", "count_events"]
+    columns = [
+        _str_column(summary["label"]),
+        _id_column(summary["stay_id"].where(summary["stay_id"] != -1)),
+        summary["count_events"].astype(int).tolist(),
+    ]
+    for field, fmt in RECORD_FIELDS:
+        keys.append(field)
+        columns.append(fmt(summary[field]) if field in summary.columns else [None] * len(summary))
+    keys.append("change_points")
+    columns.append([changes.get(key, []) for key in zip(*(summary[col].tolist() for col in KEYS))])
+
+    out = {}
+    for subject_id, values in zip(summary["subject_id"].tolist(), zip(*columns)):
+        out.setdefault(subject_id, []).append(dict(zip(keys, values)))
+    return out
@@ -0,0 +1,220 @@
+"""
+Background output sink: the generation loop queues its writes, one thread puts them on disk.
+
+    sink = OutputSink(compression="gzip", on_flush=ledger.sync)
+    prose = sink.stream("prose", "admissions_prose.txt")   # -> admissions_prose.txt.gz
+    prose.write("=== Patient 1 ===\\n...")         # returns immediately
+    sink.commit(lambda offsets: ledger.add(1, "done", offsets))
+    sink.close()                                    # drain, flush, fsync, join
+
+write() and commit() only put items on a queue. The sink thread collects them and
+flushes when OUTPUT_FLUSH_BYTES are pending or OUTPUT_FLUSH_SECONDS have passed since
+the oldest pending item (and on close): it writes everything up to the last commit,
+fsyncs the touched files, and only then runs the commit callbacks with the file sizes
+at each commit, followed by on_flush once per batch. A ledger entry therefore never
+points at data that is not durable, and one fsync covers many patients.
+
+Compressed streams (OUTPUT_COMPRESSION=gzip, or zstd with the zstandard package) write
+each flush as one gzip member / zstd frame. Concatenated members are a valid file, and
+cutting a file back to a commit offset (--resume) leaves whole members; the commits of
+one flush share the offset of its last commit; data after that commit is written as a
+separate member. Uncompressed streams report exact offsets per commit. open_text(path) reads any of the three back.
+"""
+
+import gzip
+import io
+import os
+import queue
+import threading
+import time
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+OUTPUT_COMPRESSION = os.getenv("OUTPUT_COMPRESSION", "none")
+OUTPUT_FLUSH_SECONDS = float(os.getenv("OUTPUT_FLUSH_SECONDS", "2.0"))
+OUTPUT_FLUSH_BYTES = int(os.getenv("OUTPUT_FLUSH_BYTES", str(1 << 20)))
+
+SUFFIXES = {"none": "", "gzip": ".gz", "zstd": ".zst"}
+
+
+# ======================
+# COMPRESSION
+# ======================
+
+def compressed_path(path, compression=None):
+    compression = compression or OUTPUT_COMPRESSION
+    if compression not in SUFFIXES:
+        raise ValueError(f"Unknown OUTPUT_COMPRESSION {compression!r}; use none, gzip or zstd")
+    return path + SUFFIXES[compression]
+
+
+# One self-contained member/frame per call.
+def _encoder(compression):
+    if compression == "gzip":
+        return lambda data: gzip.compress(data, compresslevel=6, mtime=0)
+    if compression == "zstd":
+        if zstandard is None:
+            raise ImportError("OUTPUT_COMPRESSION=zstd needs the zstandard package (pip install zstandard)")
+        compressor = zstandard.ZstdCompressor(level=3)
+        return compressor.compress
+    return lambda data: data
+
+
+# Text of an output file written with or without compression (by suffix).
+def open_text(path):
+    if not os.path.exists(path):
+        for suffix in (".gz", ".zst"):
+            if os.path.exists(path + suffix):
+                path = path + suffix
+                break
+    if path.endswith(".gz"):
+        return gzip.open(path, "rt", encoding="utf-8")
+    if path.endswith(".zst"):
+        if zstandard is None:
+            raise ImportError(f"Reading {path} needs the zstandard package (pip install zstandard)")
+        raw = zstandard.ZstdDecompressor().stream_reader(open(path, "rb"), read_across_frames=True)
+        return io.TextIOWrapper(raw, encoding="utf-8")
+    return open(path, encoding="utf-8")
+
+
+# ======================
+# SINK
+# ======================
+
+class SinkStream:
+    def __init__(self, sink, role, path, append, compression):
+        self.sink = sink
+        self.role = role
+        self.path = path
+        self.encode = _encoder(compression)
+        # Compressed data is cut into members only at flush boundaries.
+        self.exact = compression == "none"
+        self.handle = open(path, "ab" if append else "wb")
+        self.size = os.fstat(self.handle.fileno()).st_size
+        self.pending = []
+        self.dirty = False
+
+    def write(self, text):
+        self.sink._put(("data", self, text))
+
+    # Everything collected since the last emit goes out (as one member/frame).
+    def emit(self):
+        if not self.pending:
+            return
+        data = self.encode("".join(self.pending).encode("utf-8"))
+        self.pending = []
+        self.handle.write(data)
+        self.size += len(data)
+        self.dirty = True
+
+    def sync(self):
+        if self.dirty:
+            self.handle.flush()
+            os.fsync(self.handle.fileno())
+            self.dirty = False
+
+
+class OutputSink:
+    def __init__(self, flush_seconds=None, flush_bytes=None, compression=None, on_flush=None):
+        self.flush_seconds = OUTPUT_FLUSH_SECONDS if flush_seconds is None else flush_seconds
+        self.flush_bytes = OUTPUT_FLUSH_BYTES if flush_bytes is None else flush_bytes
+        self.compression = compression or OUTPUT_COMPRESSION
+        self.on_flush = on_flush
+        self.streams = []
+        self.queue = queue.Queue()
+        self.items = []          # queued items not yet flushed, in order
+        self.pending_bytes = 0
+        self.oldest = None
+        self.error = None
+        self.thread = threading.Thread(target=self._run, name="output-sink", daemon=True)
+        self.thread.start()
+
+    # path gets the compression suffix; returns a stream with write(text).
+    def stream(self, role, path, append=False):
+        stream = SinkStream(self, role, compressed_path(path, self.compression), append, self.compression)
+        self.streams.append(stream)
+        return stream
+
+    # callback({role: file size}) runs once everything written before it is on disk.
+    def commit(self, callback):
+        self._put(("commit", callback))
+
+    def _put(self, item):
+        if self.error is not None:
+            raise RuntimeError(f"Output sink failed: {self.error}") from self.error
+        self.queue.put(item)
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        for stream in self.streams:
+            stream.handle.close()
+        if self.error is not None:
+            raise RuntimeError(f"Output sink failed: {self.error}") from self.error
+
+    # ======================
+    # SINK THREAD
+    # ======================
+
+    def _run(self):
+        try:
+            while True:
+                timeout = None
+                if self.oldest is not None:
+                    timeout = max(self.oldest + self.flush_seconds - time.monotonic(), 0)
+                try:
+                    item = self.queue.get(timeout=timeout)
+                except queue.Empty:
+                    self._flush()
+                    continue
+                if item is None:
+                    self._flush(final=True)
+                    return
+                self.items.append(item)
+                if item[0] == "data":
+                    self.pending_bytes += len(item[2])
+                if self.oldest is None:
+                    self.oldest = time.monotonic()
+                if self.pending_bytes >= self.flush_bytes:
+                    self._flush()
+        except BaseException as e:
+            self.error = e
+
+    # Write up to the last commit (everything when final, or when the uncommitted tail
+    # alone exceeds flush_bytes), fsync, then run the commit callbacks.
+    def _flush(self, final=False):
+        last_commit = max((i for i, item in enumerate(self.items) if item[0] == "commit"), default=-1)
+        tail_bytes = sum(len(item[2]) for item in self.items[last_commit + 1:] if item[0] == "data")
+        upto = len(self.items) if final or tail_bytes >= self.flush_bytes else last_commit + 1
+
+        # Compressed streams are cut at the last commit, so uncommitted data written in
+        # the same flush (final, or an oversized tail) goes into a member of its own.
+        commits = []
+        committed = {}
+        for i, (kind, *rest) in enumerate(self.items[:upto]):
+            if kind == "data":
+                stream, text = rest
+                stream.pending.append(text)
+            else:
+                for stream in self.streams:
+                    if stream.exact or i == last_commit:
+                        stream.emit()
+                commits.append((rest[0], {stream.role: stream.size for stream in self.streams if stream.exact}))
+                if i == last_commit:
+                    committed = {stream.role: stream.size for stream in self.streams}
+        for stream in self.streams:
+            stream.emit()
+            stream.sync()
+
+        for callback, offsets in commits:
+            callback({role: offsets.get(role, size) for role, size in committed.items()})
+        if commits and self.on_flush is not None:
+            self.on_flush()
+
+        self.items = self.items[upto:]
+        self.pending_bytes = sum(len(item[2]) for item in self.items if item[0] == "data")
+        self.oldest = time.monotonic() if self.items else None
@@ -1,50 +1,39 @@
 import pandas as pd
 import os
+import sys
 
-def safe_lower(value):
-    """Return lowercase string if possible, else None."""
-    if isinstance(value, str) and value.strip():
-        return value.lower()
-    return None
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-def safe_str(value):
-    """Return string if not NaN, else None."""
-    if pd.isna(value) or str(value).strip() == '':
-        return None
-    return str(value)
+from gt_prose import Prose, text, write_prose
 
-def row_to_prose(row):
-    sentences = []
+#Converting outputevents to descriptive prose, one line per row (rendered column-wise)
+def frame_to_prose(df):
+    prose = Prose(df)
 
-    subject_id = safe_str(row.get("subject_id"))
-    hadm_id = safe_str(row.get("hadm_id"))
-    stay_id = safe_str(row.get("stay_id"))
+    subject_id = text(df, "subject_id")
+    hadm_id = text(df, "hadm_id")
+    stay_id = text(df, "stay_id")
 
-    charttime = safe_str(row.get("charttime"))
-    itemid = safe_str(row.get("itemid"))
-    output_label = safe_str(row.get("label"))   # ← from d_items
+    charttime = text(df, "charttime")
+    output_label = text(df, "label")   # ← from d_items
 
-    amount = safe_str(row.get("value"))
-    amountuom = safe_str(row.get("valueuom"))
+    amount = text(df, "value")
+    amountuom = text(df, "valueuom")
 
     # Patient id, event, and timing
-    if subject_id and charttime:
-        if output_label:
-            sentences.append(f"Patient {subject_id} had output from {output_label} at {charttime}.")
-        else:
-            sentences.append(f"Patient {subject_id} had an output at {charttime}.")
-    
+    timed = subject_id.present & charttime.present
+    prose.add(timed & output_label.present,
+              "Patient ", subject_id, " had output from ", output_label, " at ", charttime, ".")
+    prose.add(timed & ~output_label.present, "Patient ", subject_id, " had an output at ", charttime, ".")
+
     # IDs
-    if hadm_id:
-        sentences.append(f"The hospital admission ID was {hadm_id}.")
-    if stay_id:
-        sentences.append(f"The ICU stay ID was {stay_id}.")
-    
+    prose.add(hadm_id.present, "The hospital admission ID was ", hadm_id, ".")
+    prose.add(stay_id.present, "The ICU stay ID was ", stay_id, ".")
+
     # Amount
-    if amount and amountuom:
-        sentences.append(f"The recorded amount was {amount} {amountuom}.")
-    
-    return " ".join(sentences)
+    prose.add(amount.present & amountuom.present, "The recorded amount was ", amount, " ", amountuom, ".")
+
+    return prose.lines()
 
 #------MAIN--------
 
@@ -59,15 +48,10 @@ print(f"Loaded outputevents: {df.shape}")
 df_items = pd.read_csv(items_path)
 df = df.merge(df_items[["itemid", "label"]], on="itemid", how="left")
 
-# Convert to prose
-prose_descriptions = df.apply(row_to_prose, axis=1).tolist()
-
-# Save to a single text file
+# Convert to prose and save to a single text file, double newline between patients
 output_file = r"pipelineScalingCode/outputevents_prose.txt"
-with open(output_file, "w", encoding="utf-8") as f:
-    for line in prose_descriptions:
-        f.write(line + "\n\n")  # double newline between patients
+n_lines = write_prose(output_file, df, frame_to_prose)
 
-print(f"Saved {len(prose_descriptions)} patient descriptions to {output_file}")
+print(f"Saved {n_lines} patient descriptions to {output_file}")
 
 
@@ -1,11 +1,14 @@
 import os
 import re
-import sqlite3
+import sys
 
-import pandas as pd
-import torch
-from transformers import AutoTokenizer, AutoModelForCausalLM, pipeline
-import json
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from context_budget import EVENT_SUMMARY_MIN_NEW_TOKENS, prompt_budget, scale_max_new_tokens, fit_payload
+from generation_backends import backend_from_env
+from hierarchical_summary import HierarchicalConfig
+from icu_context import CohortLabelContext
+from output_series import SERIES_COLUMNS, series_records
+from table_pipeline import TablePipeline, run_options, run_table
 
 
 # ======================
@@ -14,7 +17,7 @@ import json
 
 # Pick the Hugging Face model to use for both SQL generation and clinical summary generation.
 MODEL_NAME = "meta-llama/Llama-3.1-8B-Instruct"
- 
+
 # Other good options:
 # "google/gemma-2b-it"
 # "google/gemma-7b-it"
@@ -23,33 +26,12 @@ MODEL_NAME = "meta-llama/Llama-3.1-8B-Instruct"
 # "microsoft/Phi-3-mini-4k-instruct"
 # "meta-llama/Llama-3.3-70B-Instruct"
 
-print(f"Loading model: {MODEL_NAME}")
-
-tokenizer = AutoTokenizer.from_pretrained(MODEL_NAME)
-
-model = AutoModelForCausalLM.from_pretrained(
-    MODEL_NAME,
-    dtype=torch.float16,   
-    device_map="auto"
-)
-
-if tokenizer.pad_token is None:
-    tokenizer.pad_token = tokenizer.eos_token
-
-generator = pipeline(
-    "text-generation",
-    model=model,
-    tokenizer=tokenizer,
-    max_new_tokens=500,
-    do_sample=False,
-    pad_token_id=tokenizer.eos_token_id
-)
-
-def safe_str(value):
-    if pd.isna(value) or str(value).strip() == "":
-        return None
-    return str(value).strip()
+# Optional small draft model for speculative decoding (same outputs with do_sample=False, faster decode).
+# e.g. "meta-llama/Llama-3.2-1B-Instruct" for the Llama-3.1-8B target. Leave unset to disable.
+DRAFT_MODEL_NAME = os.getenv("DRAFT_MODEL_NAME")
 
+# Serialization of the summary context: json | compact | table | delta (see context_encodings.py).
+CONTEXT_ENCODING = os.getenv("CONTEXT_ENCODING", "json")
 
 def extract_sql(text):
     match = re.search(r"```sql\s*(.*?)```", text, re.IGNORECASE | re.DOTALL)
@@ -65,8 +47,7 @@ def extract_sql(text):
 
     return sql + ";"
 
-def fallback_sql(subject_id):
-    return f"""
+EVENTS_SELECT = """
 SELECT
     oe.subject_id,
     oe.hadm_id,
@@ -79,16 +60,30 @@ SELECT
 FROM outputevents oe
 LEFT JOIN d_items di
     ON oe.itemid = di.itemid
+""".strip()
+
+
+def fallback_sql(subject_id):
+    return f"""
+{EVENTS_SELECT}
 WHERE oe.subject_id = {subject_id}
 ORDER BY oe.charttime ASC;
 """.strip()
 
+
+# Same columns as fallback_sql for every patient; per-label series statistics are computed from this once per run.
+COHORT = CohortLabelContext(
+    f"{EVENTS_SELECT}\nORDER BY oe.subject_id, oe.charttime ASC;",
+    summarize=series_records,
+    fingerprint_columns=SERIES_COLUMNS,
+)
+
 # ======================
 # STEP 1: SQL GENERATION
 # ======================
 
-def generate_sql(subject_id):
-    prompt = f"""
+def build_sql_prompt(subject_id):
+    return f"""
 You are a clinical SQL assistant.
 
 Write ONE SQLite query using:
@@ -110,89 +105,59 @@ Rules:
 - Do not explain anything
 - Do not return Python
 """.strip()
-    
-    result = generator(prompt, max_new_tokens=500, do_sample=False)
-    raw_sql = result[0]["generated_text"][len(prompt):].strip()
+
+
+def parse_sql(raw_sql, subject_id):
     sql = extract_sql(raw_sql)
 
     if not sql.lower().strip().startswith("select"):
         sql = fallback_sql(subject_id)
-    return prompt, raw_sql, sql
+    return sql
 
 # ======================
 # STEP 2: BUILD CONTEXT
 # ======================
 
-def build_patient_context(subject_id, group):
-    g = group.copy()
-
-    if "starttime" in g.columns:
-        g = g.sort_values("starttime")
-
-    summaries = []
-    label_col = g["label"] if "label" in g.columns else pd.Series([None] * len(g))
-    label_col = label_col.fillna("UNKNOWN_LABEL")
-
-    for label, grp in g.groupby(label_col, dropna=False):
-        hadm_id = safe_str(grp["hadm_id"].dropna().iloc[0]) if "hadm_id" in grp.columns and grp["hadm_id"].notna().any() else None
-        stay_id = safe_str(grp["stay_id"].dropna().iloc[0]) if "stay_id" in grp.columns and grp["stay_id"].notna().any() else None
-
-        first_start = safe_str(grp["starttime"].dropna().iloc[0]) if "starttime" in grp.columns and grp["starttime"].notna().any() else None
-        last_end = safe_str(grp["endtime"].dropna().iloc[-1]) if "endtime" in grp.columns and grp["endtime"].notna().any() else None
-
-        example_amount = fmt_num(grp["amount"].dropna().iloc[0]) if "amount" in grp.columns and grp["amount"].notna().any() else None
-        amountuom = safe_str(grp["amountuom"].dropna().iloc[0]) if "amountuom" in grp.columns and grp["amountuom"].notna().any() else None
-
-        example_rate = fmt_num(grp["rate"].dropna().iloc[0]) if "rate" in grp.columns and grp["rate"].notna().any() else None
-        rateuom = safe_str(grp["rateuom"].dropna().iloc[0]) if "rateuom" in grp.columns and grp["rateuom"].notna().any() else None
-
-        statuses = []
-        if "statusdescription" in grp.columns:
-            seen = set()
-            for x in grp["statusdescription"].dropna().tolist():
-                s = clean_status(x)
-                if s and s not in seen:
-                    seen.add(s)
-                    statuses.append(s)
-
-        summaries.append(
-            {
-                "label": safe_str(label),
-                "count_events": int(len(grp)),
-                "hadm_id": hadm_id,
-                "stay_id": stay_id,
-                "first_starttime": first_start,
-                "last_endtime": last_end,
-                "example_amount": example_amount,
-                "amountuom": amountuom,
-                "example_rate": example_rate,
-                "rateuom": rateuom,
-                "statuses_seen": statuses,
-            }
-        )
-
-    # Keep prompt size stable: most frequent labels first, cap list length
-    summaries.sort(key=lambda r: -(r["count_events"] or 0))
-    summaries = summaries[:30]
+# Per-record list in the payload; fit_payload trims this list when the prompt is too long.
+CONTEXT_LIST_KEY = "output_series_by_label"
+
+
+def build_patient_payload(subject_id, group):
+    # One record per (stay, label) with totals, daily totals, trend and change points (see output_series.py),
+    # most measured first; fit_payload drops from the tail if the prompt is too long.
+    summaries = COHORT.records(subject_id, group)
 
     payload = {
         "patient_id": int(subject_id),
-        "ingredient_event_summary_by_label": summaries,
+        CONTEXT_LIST_KEY: summaries,
     }
-    return json.dumps(payload, ensure_ascii=True)
+    return payload
+
+
+def build_patient_context(subject_id, group, max_new_tokens, backend):
+    return fit_payload(
+        build_patient_payload(subject_id, group),
+        CONTEXT_LIST_KEY,
+        build_summary_prompt,
+        backend.tokenizer,
+        prompt_budget(backend.context_window, max_new_tokens),
+        encoding=CONTEXT_ENCODING,
+    )
 
 
 # ======================
 # STEP 3: SUMMARY GENERATION
 # ======================
 
-def generate_summary(context):
-    prompt = f"""
+def build_summary_prompt(context):
+    return f"""
 You are a clinical ICU documentation assistant.
 
 Write natural language paragraphs summarizing this patient's ICU output events in natural prose.
 No bullets, no numbering, no headings, no “Field: value” labels.
 Do not list events one-by-one. Synthesize patterns and trends.
+Each record covers one output label during one ICU stay: totals, daily totals,
+daily_trend (change in the daily total per day) and notable day-to-day change_points.
 Use ONLY facts in OUTPUTEVENTS_JSON. Do not invent values or times.
 Do not mention SQL.
 Do not hallucinate.
@@ -201,9 +166,12 @@ OUTPUTEVENTS_JSON:
 {context}
 """.strip()
 
-    result = generator(prompt, max_new_tokens=500, do_sample=False)
-    summary = result[0]["generated_text"][len(prompt):].strip()
-    return prompt, summary
+
+# The context has one record per (stay, label) series, so the decode budget follows the series count.
+def summary_max_new_tokens(result_df):
+    keys = [col for col in ("stay_id", "label") if col in result_df.columns]
+    n_series = len(result_df[keys].drop_duplicates()) if keys else 1
+    return scale_max_new_tokens(n_series, floor=EVENT_SUMMARY_MIN_NEW_TOKENS)
 
 
 # ======================
@@ -220,44 +188,34 @@ d_items_path = "/storage/ice1/0/2/sfatima7/d_items.csv"
 output_file = "/storage/ice1/0/2/sfatima7/outputevents_prose_MG.txt"
 sql_file = "/storage/ice1/0/2/sfatima7/outputevents_queries_MG.sql"
 
-oe_df = pd.read_csv(outputevents_path)
-items_df = pd.read_csv(d_items_path)
-
-print(f"Loaded outputevents: {oe_df.shape}")
-print(f"Loaded d_items: {items_df.shape}")
-
-conn = sqlite3.connect(":memory:")
-oe_df.to_sql("outputevents", conn, index=False, if_exists="replace")
-items_df.to_sql("d_items", conn, index=False, if_exists="replace")
-
-subject_ids = oe_df["subject_id"].dropna().astype(int).unique()[:5]
-print(f"Processing {len(subject_ids)} patients")
-
-with open(output_file, "w", encoding="utf-8") as prose_handle, \
-     open(sql_file, "w", encoding="utf-8") as sql_handle:
-
-    for i, subject_id in enumerate(subject_ids):
-        try:
-            sql_prompt, raw_sql, sql = generate_sql(subject_id)
-
-            sql_handle.write(f"-- Patient {subject_id}\n{sql}\n\n")
-
-            result_df = pd.read_sql_query(sql, conn)
-            context = build_patient_context(subject_id, result_df)
-            summary_prompt, summary = generate_summary(context)
+# Only the first few patients while this table's prompt is being tuned.
+SUBJECT_LIMIT = 5
+
+PIPELINE = TablePipeline(
+    table="outputevents",
+    input_files={"outputevents": outputevents_path, "d_items": d_items_path},
+    output_file=output_file,
+    sql_file=sql_file,
+    build_sql_prompt=build_sql_prompt,
+    parse_sql=parse_sql,
+    build_patient_context=build_patient_context,
+    build_summary_prompt=build_summary_prompt,
+    summary_max_new_tokens=summary_max_new_tokens,
+    sql_max_new_tokens=500,
+    cohort=COHORT,
+    context_unit="output event labels",
+    hierarchical=HierarchicalConfig("ICU output events", time_col="charttime"),
+    log_errors=True,
+    subject_limit=SUBJECT_LIMIT,
+)
 
-            prose_handle.write(f"=== Patient {subject_id} ===\n")
-            prose_handle.write("SQL PROMPT:\n" + sql_prompt + "\n\n")
-            prose_handle.write("RAW SQL OUTPUT:\n" + raw_sql + "\n\n")
-            prose_handle.write("EXECUTED SQL:\n" + sql + "\n\n")
-            prose_handle.write("SUMMARY PROMPT:\n" + summary_prompt + "\n\n")
-            prose_handle.write("SUMMARY OUTPUT:\n" + summary + "\n\n")
 
-            print(f"Done {i+1}/{len(subject_ids)}")
+def main():
+    # Set GEN_BACKEND=ollama|openai|stub to run the same prompts on another backend.
+    backend = backend_from_env(MODEL_NAME, max_new_tokens=500, draft_model_name=DRAFT_MODEL_NAME)
+    # --resume / --retry-failed continue an interrupted run from its ledger.
+    run_table(PIPELINE, backend, **run_options())
 
-        except Exception as e:
-            print(f"Failed for patient {subject_id}: {e}")
-            prose_handle.write(f"=== Patient {subject_id} ===\nERROR: {e}\n\n")
 
-conn.close()
-print("Finished everything.")
\ No newline at end of file
+if __name__ == "__main__":
+    main()
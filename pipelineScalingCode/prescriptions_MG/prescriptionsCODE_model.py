@@ -1,10 +1,15 @@
 import os
+import sys
 import pandas as pd
-import torch
-from transformers import AutoTokenizer, AutoModelForCausalLM, pipeline
-import sqlite3
 import re
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from context_budget import EVENT_SUMMARY_MIN_NEW_TOKENS, prompt_budget, scale_max_new_tokens, fit_payload
+from drug_classes import class_rollup, default_matcher
+from generation_backends import backend_from_env
+from hierarchical_summary import HierarchicalConfig
+from table_pipeline import TablePipeline, run_options, run_table
+
 
 # ======================
 # MODEL CONFIG
@@ -12,7 +17,7 @@ import re
 
 # Pick the Hugging Face model to use for both SQL generation and clinical summary generation.
 MODEL_NAME = "meta-llama/Llama-3.1-8B-Instruct"
- 
+
 # Other good options:
 # "google/gemma-2b-it"
 # "google/gemma-7b-it"
@@ -21,27 +26,17 @@ MODEL_NAME = "meta-llama/Llama-3.1-8B-Instruct"
 # "microsoft/Phi-3-mini-4k-instruct"
 # "meta-llama/Llama-3.3-70B-Instruct"
 
-print(f"Loading model: {MODEL_NAME}")
+# Optional small draft model for speculative decoding (same outputs with do_sample=False, faster decode).
+# e.g. "meta-llama/Llama-3.2-1B-Instruct" for the Llama-3.1-8B target. Leave unset to disable.
+DRAFT_MODEL_NAME = os.getenv("DRAFT_MODEL_NAME")
 
-tokenizer = AutoTokenizer.from_pretrained(MODEL_NAME)
+# Serialization of the summary context: json | compact | table | delta (see context_encodings.py).
+CONTEXT_ENCODING = os.getenv("CONTEXT_ENCODING", "json")
 
-model = AutoModelForCausalLM.from_pretrained(
-    MODEL_NAME,
-    dtype=torch.float16,   
-    device_map="auto"
-)
-
-if tokenizer.pad_token is None:
-    tokenizer.pad_token = tokenizer.eos_token
-
-generator = pipeline(
-    "text-generation",
-    model=model,
-    tokenizer=tokenizer,
-    max_new_tokens=400,
-    do_sample=False,
-    pad_token_id=tokenizer.eos_token_id
-)
+# events: one record per prescription, tagged with its therapeutic class.
+# classes: one record per therapeutic class (drugs, routes, order count, time range) for long lists.
+# Classes come from drug_classes.py; DRUG_CLASS_FILE points it at a larger drug -> class CSV.
+MEDICATION_CONTEXT = os.getenv("MEDICATION_CONTEXT", "events")
 
 
 # ======================
@@ -73,8 +68,8 @@ def extract_sql(text):
 # STEP 1: SQL GENERATION
 # ======================
 
-def generate_sql(subject_id):
-    prompt = f"""
+def build_sql_prompt(subject_id):
+    return f"""
 You are a clinical SQL assistant.
 
 Write ONE SQLite query for table prescriptions with columns:
@@ -91,8 +86,8 @@ Rules:
 - return SQL only
 """
 
-    result = generator(prompt)
-    raw = result[0]["generated_text"][len(prompt):].strip()
+
+def parse_sql(raw, subject_id):
     sql = extract_sql(raw)
 
     if "select" not in sql.lower():
@@ -103,69 +98,102 @@ Rules:
         ORDER BY starttime ASC;
         """.strip()
 
-    return prompt, raw, sql
+    return sql
 
 
 # ======================
 # STEP 2: BUILD CONTEXT
 # ======================
 
-def build_patient_context(subject_id, group):
-    lines = [f"Patient ID: {subject_id}"]
+# Per-record list in the payload; fit_payload trims this list when the prompt is too long.
+# A result without a drug column cannot be classified and falls back to the events list.
+EVENTS_KEY = "medication_events"
+CLASSES_KEY = "medication_classes"
+CONTEXT_LIST_KEY = CLASSES_KEY if MEDICATION_CONTEXT == "classes" else EVENTS_KEY
 
-    for _, row in group.iterrows():
-        drug = safe_str(row.get("drug"))
-        hadm_id = safe_str(row.get("hadm_id"))
-        start = safe_str(row.get("starttime"))
-        stop = safe_str(row.get("stoptime"))
-        route = safe_str(row.get("route"))
-        dose = safe_str(row.get("dose_val_rx"))
-        unit = safe_str(row.get("dose_unit_rx"))
-        strength = safe_str(row.get("prod_strength"))
 
-        lines.append("\nMedication Event:")
+def build_patient_payload(subject_id, group):
+    matched = default_matcher().classify(group["drug"]) if "drug" in group.columns else None
 
-        if hadm_id:
-            lines.append(f"Hospital Admission ID: {hadm_id}")
-        if drug:
-            lines.append(f"Drug: {drug}")
-        if start:
-            lines.append(f"Start: {start}")
-        if stop:
-            lines.append(f"Stop: {stop}")
-        if route:
-            lines.append(f"Route: {route}")
-        if dose:
-            lines.append(f"Dose: {dose} {unit if unit else ''}")
-        if strength:
-            lines.append(f"Strength: {strength}")
+    if MEDICATION_CONTEXT == "classes" and matched is not None:
+        return {"patient_id": int(subject_id), CLASSES_KEY: class_rollup(group.join(matched))}
 
-    return "\n".join(lines)
+    events = []
+    classes = matched["drug_class"].tolist() if matched is not None else [None] * len(group)
+
+    for (_, row), drug_class in zip(group.iterrows(), classes):
+        dose = safe_str(row.get("dose_val_rx"))
+        unit = safe_str(row.get("dose_unit_rx"))
+
+        events.append(
+            {
+                "hadm_id": safe_str(row.get("hadm_id")),
+                "drug": safe_str(row.get("drug")),
+                "class": drug_class,
+                "start": safe_str(row.get("starttime")),
+                "stop": safe_str(row.get("stoptime")),
+                "route": safe_str(row.get("route")),
+                "dose": f"{dose} {unit if unit else ''}".strip() if dose else None,
+                "strength": safe_str(row.get("prod_strength")),
+            }
+        )
+
+    return {"patient_id": int(subject_id), EVENTS_KEY: events}
+
+
+# Most important events first: the first event of every distinct drug/route, then repeats.
+def medication_priority(events):
+    seen = set()
+    first, repeats = [], []
+    for i, event in enumerate(events):
+        key = (event["drug"], event["route"])
+        if key in seen:
+            repeats.append(i)
+        else:
+            seen.add(key)
+            first.append(i)
+    return first + repeats
+
+
+def build_patient_context(subject_id, group, max_new_tokens, backend):
+    payload = build_patient_payload(subject_id, group)
+    list_key = CLASSES_KEY if CLASSES_KEY in payload else EVENTS_KEY
+    return fit_payload(
+        payload,
+        list_key,
+        build_summary_prompt,
+        backend.tokenizer,
+        prompt_budget(backend.context_window, max_new_tokens),
+        order=medication_priority(payload[EVENTS_KEY]) if list_key == EVENTS_KEY else None,
+        encoding=CONTEXT_ENCODING,
+    )
 
 
 # ======================
 # STEP 3: SUMMARY GENERATION
 # ======================
 
-def generate_summary(context):
-    prompt = f"""
+def build_summary_prompt(context):
+    return f"""
 You are a clinical pharmacology assistant.
 
 Summarize this patient's medication history clearly.
 Focus on:
-- drugs used
+- drugs used, grouped by therapeutic class where it helps
 - timing patterns
 - routes of administration
 
 Do NOT hallucinate.
 
+MEDICATIONS_JSON:
 {context}
 """
 
-    result = generator(prompt)
-    summary = result[0]["generated_text"][len(prompt):].strip()
 
-    return prompt, summary
+# The context lists every drug (or its class), so the decode budget follows the drug count.
+def summary_max_new_tokens(result_df):
+    n_drugs = result_df["drug"].nunique() if "drug" in result_df.columns else 1
+    return scale_max_new_tokens(n_drugs, floor=EVENT_SUMMARY_MIN_NEW_TOKENS)
 
 
 # ======================
@@ -181,54 +209,28 @@ file_path = "/storage/ice1/0/2/sfatima7/prescriptions.csv"
 output_file = "/storage/ice1/0/2/sfatima7/prescriptions_prose_MG.txt"
 sql_file = "/storage/ice1/0/2/sfatima7/prescriptions_queries_MG.sql"
 
-df = pd.read_csv(file_path)
-
-print(f"Loaded {len(df)} rows")
-print(f"Columns: {list(df.columns)}")
-
-conn = sqlite3.connect(":memory:")
-df.to_sql("prescriptions", conn, index=False, if_exists="replace")
-
-subject_ids = df["subject_id"].dropna().astype(int).unique()
-print(f"Processing {len(subject_ids)} patients")
-
-os.makedirs(os.path.dirname(output_file), exist_ok=True)
-
-
-with open(output_file, "w", encoding="utf-8") as prose_handle, \
-     open(sql_file, "w", encoding="utf-8") as sql_handle:
-
-    for i, subject_id in enumerate(subject_ids):
-
-        try:
-            # STEP 1: SQL
-            sql_prompt, raw_sql, sql = generate_sql(subject_id)
-
-            sql_handle.write(f"-- Patient {subject_id}\n{sql}\n\n")
-
-            # STEP 2: EXECUTE SQL
-            result_df = pd.read_sql_query(sql, conn)
-
-            # STEP 3: CONTEXT
-            context = build_patient_context(subject_id, result_df)
-
-            # STEP 4: SUMMARY
-            summary_prompt, summary = generate_summary(context)
-
-            # STEP 5: LOG EVERYTHING
-            prose_handle.write(f"=== Patient {subject_id} ===\n")
-            prose_handle.write("SQL PROMPT:\n" + sql_prompt + "\n\n")
-            prose_handle.write("RAW SQL OUTPUT:\n" + raw_sql + "\n\n")
-            prose_handle.write("EXECUTED SQL:\n" + sql + "\n\n")
-            prose_handle.write("SUMMARY PROMPT:\n" + summary_prompt + "\n\n")
-            prose_handle.write("SUMMARY OUTPUT:\n" + summary + "\n\n")
-
-            print(f"Done {i+1}/{len(subject_ids)}")
+PIPELINE = TablePipeline(
+    table="prescriptions",
+    input_files={"prescriptions": file_path},
+    output_file=output_file,
+    sql_file=sql_file,
+    build_sql_prompt=build_sql_prompt,
+    parse_sql=parse_sql,
+    build_patient_context=build_patient_context,
+    build_summary_prompt=build_summary_prompt,
+    summary_max_new_tokens=summary_max_new_tokens,
+    sql_max_new_tokens=400,
+    context_unit="medication events",
+    hierarchical=HierarchicalConfig("medication history", time_col="starttime"),
+)
 
-        except Exception as e:
-            print(f"Failed for patient {subject_id}: {e}")
 
+def main():
+    # Set GEN_BACKEND=ollama|openai|stub to run the same prompts on another backend.
+    backend = backend_from_env(MODEL_NAME, max_new_tokens=400, draft_model_name=DRAFT_MODEL_NAME)
+    # --resume / --retry-failed continue an interrupted run from its ledger.
+    run_table(PIPELINE, backend, **run_options())
 
-conn.close()
 
-print("Finished everything.")
\ No newline at end of file
+if __name__ == "__main__":
+    main()
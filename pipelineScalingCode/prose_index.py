@@ -0,0 +1,181 @@
+"""
+Byte-offset index over prose and SQL result files, for reading single patients without parsing the whole file.
+
+    index = ProseIndex("admissions_prose_llama8b.txt")   # builds or loads admissions_prose_llama8b.txt.idx.npy
+    index["10004235"]                    # that patient's section (the text after its header)
+    index.summary("10004235")            # only the SUMMARY OUTPUT part of an MG block
+    evaluate_patients(index.summaries(), ProseIndex("admissions_prose.txt"))
+
+Sections start at a header at the beginning of a line and run to the next one:
+
+    prose  "=== Patient N ===" blocks written by the MG scripts
+    sql    "-- Patient N" blocks in the .sql files
+    gt     "Patient N ..." lines of the ground-truth prose
+
+The file is memory-mapped and scanned once with a bytes regex; the index (subject_id,
+start, end per section, sorted by subject_id) is saved next to the file as .idx.npy
+with the file's size and mtime, reused while those match, and memory-mapped on load,
+so a lookup is a binary search plus one slice of the mapped file. A patient that
+appears more than once (a --retry-failed rerun) resolves to its last section, as with
+evaluation.split_patients. Compressed (.gz / .zst) files are indexed in memory and not saved.
+"""
+
+import mmap
+import os
+import re
+from collections.abc import Mapping
+
+import numpy as np
+
+from output_sink import open_text
+
+
+HEADERS = {
+    "prose": re.compile(rb"^=== Patient (\d+) ===\r?\n", re.M),
+    "sql": re.compile(rb"^-- Patient (\d+)\r?\n", re.M),
+    "gt": re.compile(rb"^Patient (\d+)\b", re.M),
+}
+
+# First row of a saved index: [INDEX_VERSION, file size, file mtime_ns].
+INDEX_VERSION = 1
+
+SUMMARY_MARKER = "SUMMARY OUTPUT:\n"
+
+
+# ======================
+# INDEX
+# ======================
+
+def index_path(path):
+    return path + ".idx.npy"
+
+
+def detect_kind(data):
+    head = bytes(data[:1 << 20])
+    for kind in ("prose", "sql"):
+        if HEADERS[kind].search(head):
+            return kind
+    return "gt"
+
+
+# (subject_id, start, end) rows sorted by subject_id, then file position.
+def build_index(data, kind):
+    matches = list(HEADERS[kind].finditer(data))
+    rows = np.zeros((len(matches), 3), dtype=np.int64)
+    for i, match in enumerate(matches):
+        rows[i] = (int(match.group(1)), match.end(), 0)
+    if len(rows):
+        rows[:-1, 2] = [match.start() for match in matches[1:]]
+        rows[-1, 2] = len(data)
+    order = np.lexsort((rows[:, 1], rows[:, 0]))
+    return rows[order]
+
+
+def _stamp(path):
+    stat = os.stat(path)
+    return [INDEX_VERSION, stat.st_size, stat.st_mtime_ns]
+
+
+def _load_saved(path):
+    try:
+        saved = np.load(index_path(path), mmap_mode="r")
+    except (OSError, ValueError):
+        return None
+    if saved.ndim != 2 or len(saved) == 0 or saved[0].tolist() != _stamp(path):
+        return None
+    return saved[1:]
+
+
+def _save(path, rows):
+    stamped = np.vstack([np.array([_stamp(path)], dtype=np.int64), rows])
+    tmp = index_path(path) + ".tmp.npy"
+    np.save(tmp, stamped)
+    os.replace(tmp, index_path(path))
+
+
+# ======================
+# READER
+# ======================
+
+class ProseIndex(Mapping):
+    # {"<subject_id>": section text}, read lazily from the mapped file.
+    def __init__(self, path, kind=None, persist=True):
+        self.path = path
+        compressed = path.endswith((".gz", ".zst")) or not os.path.exists(path)
+        if compressed:
+            with open_text(path) as f:
+                self.data = f.read().encode("utf-8")
+        else:
+            self.handle = open(path, "rb")
+            size = os.fstat(self.handle.fileno()).st_size
+            self.data = mmap.mmap(self.handle.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+
+        self.kind = kind or detect_kind(self.data)
+        rows = None if compressed else _load_saved(path)
+        if rows is None:
+            rows = build_index(self.data, self.kind)
+            if persist and not compressed:
+                _save(path, rows)
+        self.rows = rows
+        self.ids = rows[:, 0]
+
+    def _spans(self, subject_id):
+        key = int(subject_id)
+        lo = int(np.searchsorted(self.ids, key, side="left"))
+        hi = int(np.searchsorted(self.ids, key, side="right"))
+        return [(int(start), int(end)) for _, start, end in self.rows[lo:hi]]
+
+    def _text(self, start, end):
+        return bytes(self.data[start:end]).decode("utf-8")
+
+    def __getitem__(self, subject_id):
+        spans = self._spans(subject_id)
+        if not spans:
+            raise KeyError(subject_id)
+        return self._text(*spans[-1]).strip()
+
+    def __contains__(self, subject_id):
+        try:
+            return bool(self._spans(subject_id))
+        except (TypeError, ValueError):
+            return False
+
+    def __iter__(self):
+        return (str(subject_id) for subject_id in np.unique(self.ids).tolist())
+
+    def __len__(self):
+        return len(np.unique(self.ids))
+
+    # The model's summary in an MG block (None for an ERROR block or another kind of file).
+    def summary(self, subject_id):
+        section = self[subject_id]
+        if SUMMARY_MARKER not in section:
+            return None
+        return section.split(SUMMARY_MARKER, 1)[1].strip()
+
+    def summaries(self):
+        return SummaryView(self)
+
+    def close(self):
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+        if getattr(self, "handle", None) is not None:
+            self.handle.close()
+
+
+class SummaryView(Mapping):
+    # {"<subject_id>": summary} over the patients of an MG prose file that have one.
+    def __init__(self, index):
+        self.index = index
+
+    def __getitem__(self, subject_id):
+        summary = self.index.summary(subject_id)
+        if summary is None:
+            raise KeyError(subject_id)
+        return summary
+
+    def __iter__(self):
+        return (key for key in self.index if self.index.summary(key) is not None)
+
+    def __len__(self):
+        return sum(1 for _ in self)
@@ -0,0 +1,202 @@
+"""
+Run several MG table pipelines through one model with continuous batching.
+
+    python run_all_tables.py --tables admissions prescriptions icustays --batch-size 8
+
+SQL and summary prompts from every table share one job queue (job_scheduler.py),
+so short and long prompts from different tables are batched together and the model
+never idles between scripts. Each table still writes its own prose and SQL files
+(or run records, with RUN_FORMAT) in the same format as running its *_MG script on its own.
+"""
+
+import argparse
+import functools
+import importlib
+import os
+import sqlite3
+import sys
+
+import pandas as pd
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from generation_backends import backend_from_env
+from hierarchical_summary import HierarchicalSummary, chunk_cache, use_hierarchical
+from job_scheduler import GenerationJob, ContinuousBatchScheduler
+from sharding import apply_shard
+from table_pipeline import (TableOutput, add_run_arguments, load_tables, note_generation, open_run,
+                            prepare_summary, shard_option)
+
+
+# ======================
+# CONFIG
+# ======================
+
+TABLE_MODULES = {
+    "admissions": "admissions_MG.admissionsCODE_model",
+    "icustays": "icustays_MG.icustaysCODE_model",
+    "ingredientevents": "ingredientevents_MG.ingredienteventsCODE_model",
+    "outputevents": "outputevents_MG.outputeventsCODE_model",
+    "prescriptions": "prescriptions_MG.prescriptionsCODE_model",
+}
+
+MODEL_NAME = "meta-llama/Llama-3.1-8B-Instruct"
+
+
+# ======================
+# WRITERS
+# ======================
+
+# Patients finish out of order; hold results back so each table's files come out
+# in subject order, identical to a serial run of that table.
+class OrderedTableWriter:
+    def __init__(self, pipeline, subject_ids, model=None, output=None):
+        self.pipeline = pipeline
+        self.subject_ids = list(subject_ids)
+        self.sql = {}
+        self.prose = {}
+        self.next_sql = 0
+        self.next_prose = 0
+
+        self.output = output or TableOutput(pipeline, model)
+
+    # sql is None when the patient failed before any SQL was produced.
+    def sql_ready(self, position, sql):
+        self.sql[position] = sql
+        while self.next_sql in self.sql:
+            sql = self.sql.pop(self.next_sql)
+            if sql is not None:
+                self.output.sql(self.subject_ids[self.next_sql], sql)
+            self.next_sql += 1
+
+    # item is ("ok", record) or ("error", exception).
+    def patient_ready(self, position, item):
+        self.prose[position] = item
+        while self.next_prose in self.prose:
+            kind, value = self.prose.pop(self.next_prose)
+            subject_id = self.subject_ids[self.next_prose]
+            if kind == "ok":
+                self.output.patient(value)
+            else:
+                self.output.error(subject_id, value)
+            self.next_prose += 1
+        print(f"[{self.pipeline.table}] Done {len(self.subject_ids) - self.pending()}/{len(self.subject_ids)}")
+
+    def pending(self):
+        return len(self.subject_ids) - self.next_prose - len(self.prose)
+
+    def close(self):
+        self.output.close()
+
+
+# ======================
+# JOBS
+# ======================
+
+# Each patient is two chained jobs: SQL -> (execute + build context) -> summary -> write.
+# Very large patients get their chunk and merge jobs in between, in the same queue.
+def submit_patient(scheduler, pipeline, backend, conn, cache, writer, position):
+    subject_id = writer.subject_ids[position]
+    record = {"subject_id": subject_id, "sql_prompt": pipeline.build_sql_prompt(subject_id)}
+
+    def fail(error):
+        # Several chunk jobs of one patient can fail; report the patient once.
+        if record.get("failed"):
+            return
+        record["failed"] = True
+        if "sql" not in record:
+            writer.sql_ready(position, None)
+        writer.patient_ready(position, ("error", error))
+
+    def on_summary(result):
+        note_generation(record, "summary", result)
+        record["summary"] = result.text.strip()
+        writer.patient_ready(position, ("ok", record))
+
+    def on_sql(result):
+        note_generation(record, "sql", result)
+        record["raw_sql"] = result.text.strip()
+        record["sql"] = pipeline.parse_sql(record["raw_sql"], subject_id)
+        writer.sql_ready(position, record["sql"])
+
+        result_df = pd.read_sql_query(record["sql"], conn)
+        if use_hierarchical(pipeline, result_df):
+            HierarchicalSummary(pipeline, backend, cache, subject_id, result_df,
+                                submit_text, submit_summary, fail).start()
+        else:
+            submit_summary(*prepare_summary(pipeline, backend, subject_id, result_df))
+
+    def submit_summary(summary_prompt, max_new_tokens):
+        record["summary_prompt"] = summary_prompt
+        scheduler.submit(GenerationJob(summary_prompt, max_new_tokens, on_summary, fail, tag=pipeline.table))
+
+    def submit_text(prompt, max_new_tokens, on_done, on_error):
+        scheduler.submit(GenerationJob(prompt, max_new_tokens, lambda result: on_done(result.text), on_error,
+                                       tag=pipeline.table))
+
+    scheduler.submit(GenerationJob(record["sql_prompt"], pipeline.sql_max_new_tokens, on_sql, fail, tag=pipeline.table))
+
+
+# ======================
+# MAIN
+# ======================
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tables", nargs="+", default=list(TABLE_MODULES), choices=list(TABLE_MODULES))
+    parser.add_argument("--model", default=MODEL_NAME)
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--max-batch-tokens", type=int, default=16384)
+    parser.add_argument("--workers", type=int, default=1,
+                        help="batches in flight at once (use >1 only for HTTP backends)")
+    add_run_arguments(parser)
+    args = parser.parse_args()
+    shard = shard_option(parser, args)
+
+    token = os.getenv("HF_TOKEN") or os.getenv("HUGGINGFACE_HUB_TOKEN")
+    backend = backend_from_env(args.model, max_new_tokens=500, token=token)
+    # Let the HF backend take the scheduler's whole batch in one generate() call
+    # (unless a draft model pinned it to 1).
+    if getattr(backend, "batch_size", 1) > 1:
+        backend.batch_size = max(backend.batch_size, args.batch_size)
+
+    scheduler = ContinuousBatchScheduler(
+        backend,
+        max_batch_size=args.batch_size,
+        max_batch_tokens=args.max_batch_tokens,
+        workers=args.workers,
+    )
+
+    # One connection for all tables; every pipeline loads under its own table names.
+    conn = sqlite3.connect(":memory:")
+    writers = []
+    patients = []   # submit functions, admitted by the scheduler as the queue drains
+
+    for table in args.tables:
+        pipeline = importlib.import_module(TABLE_MODULES[table]).PIPELINE
+        if shard is not None:
+            apply_shard(pipeline, *shard)
+        output, subject_ids = open_run(pipeline, load_tables(pipeline, conn, shard), backend.model_name,
+                                       args.resume, args.retry_failed)
+        print(f"[{table}] Processing {len(subject_ids)} patients")
+
+        writer = OrderedTableWriter(pipeline, subject_ids, output=output)
+        writers.append(writer)
+        cache = chunk_cache(pipeline, backend)
+        patients.extend(
+            functools.partial(submit_patient, scheduler, pipeline, backend, conn, cache, writer, position)
+            for position in range(len(subject_ids))
+        )
+
+    try:
+        scheduler.run(feed=patients)
+    finally:
+        for writer in writers:
+            writer.close()
+        conn.close()
+
+    print(f"Generation metrics: {backend.metrics.summary()}")
+    print("Finished everything.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+"""
+Run ledger: which patients of a table run are finished, so a killed run can pick up where it stopped.
+
+    python admissions_MG/admissionsCODE_model.py --resume          # skip patients already in the ledger
+    python admissions_MG/admissionsCODE_model.py --retry-failed    # only patients whose last attempt failed
+    python run_all_tables.py --tables icustays prescriptions --resume --retry-failed
+
+The ledger sits next to the prose file (<output>.ledger), one JSON line per patient:
+
+    {"subject_id": 123, "status": "done" | "failed", "error": ..., "offsets": {"prose": 8812, "sql": 911}}
+
+Lines are appended (one O_APPEND write, fsync) only after the patient's output is
+durable on disk (output_sink.py), and "offsets" records the size of every output file at that
+point. On resume the outputs are cut back to the last committed offsets, which drops
+anything half-written by the patient that was running when the job died, and are
+then appended to. A torn last ledger line is ignored, and cut off before the ledger
+is appended to again.
+"""
+
+import json
+import os
+import time
+
+
+def ledger_path(output_file):
+    return os.path.splitext(output_file)[0] + ".ledger"
+
+
+# Ledger entries in file order; an unreadable (torn) line is skipped.
+def read_ledger(path):
+    entries = []
+    if not os.path.exists(path):
+        return entries
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                continue
+    return entries
+
+
+# {subject_id: status of the latest attempt}.
+def latest_status(entries):
+    return {entry["subject_id"]: entry["status"] for entry in entries}
+
+
+# Output sizes after the last committed patient ({} when nothing was committed yet).
+def committed_offsets(entries):
+    return entries[-1].get("offsets", {}) if entries else {}
+
+
+# Subjects still to run, in their original order.
+# resume: everything without a ledger entry; retry_failed: patients whose last attempt
+# failed; both: everything not done.
+def pending_subjects(subject_ids, entries, resume=False, retry_failed=False):
+    if not (resume or retry_failed):
+        return list(subject_ids)
+
+    status = latest_status(entries)
+    pending = []
+    for subject_id in subject_ids:
+        seen = status.get(int(subject_id))
+        if seen is None and resume or seen == "failed" and retry_failed:
+            pending.append(subject_id)
+
+    done = sum(1 for s in status.values() if s == "done")
+    failed = sum(1 for s in status.values() if s == "failed")
+    print(f"Ledger: {done} done, {failed} failed; {len(pending)} of {len(subject_ids)} patients to run")
+    return pending
+
+
+# Cut a torn (unterminated) last line, so the next append starts on a line of its own.
+def drop_torn_line(path, block=4096):
+    if not os.path.exists(path):
+        return
+    with open(path, "r+b") as f:
+        end = f.seek(0, os.SEEK_END)
+        pos = end
+        while pos > 0:
+            start = max(0, pos - block)
+            f.seek(start)
+            newline = f.read(pos - start).rfind(b"\n")
+            if newline >= 0:
+                pos = start + newline + 1
+                break
+            pos = start
+        if pos < end:
+            f.truncate(pos)
+            print(f"Dropped a torn last line from {path}")
+
+
+class RunLedger:
+    # append=False starts a new ledger (a fresh run rewrites its outputs too).
+    def __init__(self, path, append=False):
+        self.path = path
+        if append:
+            drop_torn_line(path)
+        self.entries = read_ledger(path) if append else []
+        self.unsynced = []
+        flags = os.O_WRONLY | os.O_CREAT | os.O_APPEND | (0 if append else os.O_TRUNC)
+        self.fd = os.open(path, flags, 0o644)
+
+    # Entries are buffered by add() and written by sync() in one O_APPEND write + fsync,
+    # so a batch of patients flushed together costs one ledger fsync.
+    def add(self, subject_id, status, offsets, error=None):
+        entry = {"subject_id": int(subject_id), "status": status, "time": round(time.time(), 3), "offsets": offsets}
+        if error is not None:
+            entry["error"] = str(error)
+        self.unsynced.append(entry)
+
+    def sync(self):
+        if not self.unsynced:
+            return
+        os.write(self.fd, "".join(json.dumps(entry) + "\n" for entry in self.unsynced).encode("utf-8"))
+        os.fsync(self.fd)
+        self.entries.extend(self.unsynced)
+        self.unsynced = []
+
+    def record(self, subject_id, status, offsets, error=None):
+        self.add(subject_id, status, offsets, error)
+        self.sync()
+
+    def close(self):
+        self.sync()
+        os.close(self.fd)
+
+
+# Cut each output file back to its size at the last committed patient.
+def truncate_outputs(paths, offsets):
+    for role, path in paths.items():
+        if role in offsets and os.path.exists(path) and os.path.getsize(path) > offsets[role]:
+            with open(path, "r+b") as f:
+                f.truncate(offsets[role])
+            print(f"Truncated {path} to {offsets[role]} bytes (last committed patient)")
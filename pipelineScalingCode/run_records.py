@@ -0,0 +1,237 @@
+"""
+Structured run output: one JSONL file per table and model instead of the prose log.
+
+    RUN_FORMAT=jsonl python admissions_MG/admissionsCODE_model.py     # or "both" for .txt/.sql as well
+    python run_records.py export admissions_prose_llama8b.jsonl --prose admissions_prose_llama8b.txt
+
+Line types, in file order:
+
+    {"type": "run", "table", "model", "started", "log_errors"}
+    {"type": "template", "id", "slot", "parts"}    # a prompt is value.join(parts)
+    {"type": "patient", "subject_id", "table", "model", "status",
+     "sql_prompt", "raw_sql", "sql", "summary_prompt", "summary", "error",
+     "generation": {"sql": {...}, "summary": {...}}}
+
+The SQL and summary prompts repeat the same instructions for every patient, so each
+prompt template is written once (the table's build_*_prompt rendered around a
+placeholder) and a patient row keeps only {"template": id, "value": <subject id or
+context>}. Prompts that don't fit the template (hierarchical reduce prompts, stored
+contexts) are kept as {"text": ...}. "generation" holds prompt/completion tokens and
+latency per generation call where the backend reported them.
+
+export_text() writes the usual prose and SQL files, identical to a RUN_FORMAT=text run;
+load_run() / run_summaries() read a run back keyed by subject_id (a resumed run can list
+a patient twice; the later row wins).
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import time
+
+from output_sink import open_text
+
+SLOT = "\x00slot\x00"
+
+
+# ======================
+# TEMPLATES
+# ======================
+
+class PromptTemplate:
+    # render(value) -> prompt text; rendered once around SLOT.
+    def __init__(self, slot, render):
+        self.slot = slot
+        try:
+            self.parts = render(SLOT).split(SLOT)
+        except Exception:
+            self.parts = None
+        if self.parts is not None and len(self.parts) < 2:
+            self.parts = None
+        key = json.dumps([slot, self.parts])
+        self.id = hashlib.sha1(key.encode("utf-8")).hexdigest()[:12]
+
+    # The slot value that renders prompt, or None when prompt doesn't come from this template.
+    # With a known value (subject_id) any number of slots is checked; an unknown value
+    # (the context) is only read back from a template with a single slot.
+    def extract(self, prompt, value=None):
+        if self.parts is None:
+            return None
+        if value is not None:
+            return value if value.join(self.parts) == prompt else None
+        if len(self.parts) != 2:
+            return None
+        head, tail = self.parts
+        if len(prompt) >= len(head) + len(tail) and prompt.startswith(head) and prompt.endswith(tail):
+            return prompt[len(head):len(prompt) - len(tail)]
+        return None
+
+    def line(self):
+        return {"type": "template", "id": self.id, "slot": self.slot, "parts": self.parts}
+
+
+def render(prompt, templates):
+    if "text" in prompt:
+        return prompt["text"]
+    return prompt["value"].join(templates[prompt["template"]]["parts"])
+
+
+# ======================
+# WRITER
+# ======================
+
+class RunRecordWriter:
+    # handle: anything with write(text), usually an output_sink stream. A resumed run
+    # appends a new "run" line and writes its templates again as they are used.
+    def __init__(self, pipeline, handle, model=None):
+        self.pipeline = pipeline
+        self.table = pipeline.table
+        self.model = model
+        self.sql_template = PromptTemplate("subject_id", pipeline.build_sql_prompt)
+        self.summary_template = PromptTemplate("context", pipeline.build_summary_prompt)
+        self.written = set()
+        # SQL arrives before the patient finishes (and stays when it fails afterwards).
+        self.sql_by_subject = {}
+
+        self.handle = handle
+        self._write({
+            "type": "run",
+            "table": self.table,
+            "model": model,
+            "started": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "log_errors": bool(pipeline.log_errors),
+        })
+
+    def _write(self, line):
+        self.handle.write(json.dumps(line, ensure_ascii=False, default=str) + "\n")
+
+    def _prompt(self, template, prompt, value=None):
+        value = template.extract(prompt, value)
+        if value is None:
+            return {"text": prompt}
+        if template.id not in self.written:
+            self._write(template.line())
+            self.written.add(template.id)
+        return {"template": template.id, "value": value}
+
+    def _row(self, subject_id, status):
+        return {
+            "type": "patient",
+            "subject_id": int(subject_id),
+            "table": self.table,
+            "model": self.model,
+            "status": status,
+        }
+
+    def sql(self, subject_id, sql):
+        self.sql_by_subject[int(subject_id)] = sql
+
+    def patient(self, record):
+        subject_id = record["subject_id"]
+        self.sql_by_subject.pop(int(subject_id), None)
+        row = self._row(subject_id, "ok")
+        row.update({
+            "sql_prompt": self._prompt(self.sql_template, record["sql_prompt"], str(subject_id)),
+            "raw_sql": record["raw_sql"],
+            "sql": record["sql"],
+            "summary_prompt": self._prompt(self.summary_template, record["summary_prompt"]),
+            "summary": record["summary"],
+            "generation": record.get("generation", {}),
+        })
+        self._write(row)
+
+    def error(self, subject_id, error):
+        row = self._row(subject_id, "error")
+        row["sql"] = self.sql_by_subject.pop(int(subject_id), None)
+        row["error"] = str(error)
+        self._write(row)
+
+# ======================
+# READING
+# ======================
+
+# (run header, {template id: template line}, [patient rows in file order]).
+def read_run(path):
+    header, templates, rows = None, {}, []
+    with open_text(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            kind = item.get("type")
+            if kind == "run":
+                header = item
+            elif kind == "template":
+                templates[item["id"]] = item
+            elif kind == "patient":
+                rows.append(item)
+    return header, templates, rows
+
+
+# {subject_id: patient row} with sql_prompt / summary_prompt rendered back to text.
+def load_run(path):
+    _, templates, rows = read_run(path)
+    out = {}
+    for row in rows:
+        for key in ("sql_prompt", "summary_prompt"):
+            if isinstance(row.get(key), dict):
+                row[key] = render(row[key], templates)
+        out[row["subject_id"]] = row
+    return out
+
+
+# {"<subject_id>": summary}, the same shape as evaluation.split_patients on a prose file.
+def run_summaries(path):
+    _, _, rows = read_run(path)
+    return {str(row["subject_id"]): row["summary"] for row in rows if row["status"] == "ok"}
+
+
+# ======================
+# EXPORT
+# ======================
+
+# The prose (and SQL) files a RUN_FORMAT=text run would have written.
+def export_text(path, prose_file, sql_file=None):
+    from table_pipeline import write_patient, write_sql
+
+    header, templates, rows = read_run(path)
+    log_errors = bool(header and header.get("log_errors"))
+
+    with open(prose_file, "w", encoding="utf-8") as prose_handle:
+        for row in rows:
+            if row["status"] == "ok":
+                record = dict(row)
+                record["sql_prompt"] = render(row["sql_prompt"], templates)
+                record["summary_prompt"] = render(row["summary_prompt"], templates)
+                write_patient(prose_handle, record)
+            elif log_errors:
+                prose_handle.write(f"=== Patient {row['subject_id']} ===\nERROR: {row['error']}\n\n")
+
+    if sql_file:
+        with open(sql_file, "w", encoding="utf-8") as sql_handle:
+            for row in rows:
+                if row.get("sql") is not None:
+                    write_sql(sql_handle, row["subject_id"], row["sql"])
+
+    print(f"Exported {len(rows)} patients from {path} to {prose_file}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    export = sub.add_parser("export")
+    export.add_argument("run", help="JSONL file written with RUN_FORMAT=jsonl (.gz / .zst too)")
+    export.add_argument("--prose", default=None, help="default: the run file with .txt")
+    export.add_argument("--sql", default=None, help="also write the SQL file")
+    args = parser.parse_args()
+
+    if args.command == "export":
+        base = args.run[:-len(".gz")] if args.run.endswith(".gz") else args.run
+        base = base[:-len(".zst")] if base.endswith(".zst") else base
+        export_text(args.run, args.prose or os.path.splitext(base)[0] + ".txt", args.sql)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,235 @@
+"""
+Deterministic sharding of a table run across nodes, and merging the shard outputs back.
+
+    # one batch-array task per shard (SLURM_ARRAY_TASK_ID = 0..7)
+    python admissions_MG/admissionsCODE_model.py --shard-index $SLURM_ARRAY_TASK_ID --shard-count 8
+    python run_all_tables.py --tables icustays prescriptions --shard-index 3 --shard-count 8
+
+    # afterwards, once: canonical files in subject_id order
+    python sharding.py merge --table admissions --shard-count 8
+
+Every shard loads the same CSVs and computes the same partition: patients are ordered
+by estimated token cost (PATIENT_TOKENS plus the patient's rows times the table's
+average row size), ties broken by a stable hash of the subject_id, and dealt greedily
+to the least loaded shard. A shard processes its patients in subject_id order and
+writes <output>.shard003-of-008.txt (and .sql / .jsonl / .ledger next to it), so
+--resume and --retry-failed work per shard.
+
+merge streams the shard files (a k-way merge on subject_id; a shard that is out of
+order after --retry-failed is sorted in memory) and keeps the last block of a
+patient that appears more than once.
+"""
+
+import argparse
+import hashlib
+import heapq
+import importlib
+import json
+import os
+import re
+import sys
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from output_sink import OutputSink, open_text
+
+
+# Fixed cost of a patient (SQL prompt, summary instructions and output) next to its rows.
+PATIENT_TOKENS = 600
+
+# Rows sampled to estimate the table's tokens per row (~4 characters per token).
+SAMPLE_ROWS = 10000
+
+PROSE_HEADER = re.compile(r"=== Patient (\d+) ===\n")
+SQL_HEADER = re.compile(r"-- Patient (\d+)\n")
+
+
+# ======================
+# PARTITION
+# ======================
+
+def stable_hash(subject_id):
+    return int(hashlib.sha1(str(int(subject_id)).encode("utf-8")).hexdigest()[:12], 16)
+
+
+# {subject_id: estimated tokens} from the main table's rows.
+def estimate_costs(df):
+    sample = df.head(SAMPLE_ROWS)
+    row_chars = sample.astype(str).apply(lambda col: col.str.len()).sum(axis=1).mean() if len(sample) else 0
+    rows = df.groupby(df["subject_id"].dropna().astype(int)).size()
+    return (PATIENT_TOKENS + rows * (row_chars / 4)).to_dict()
+
+
+# The subject_ids of shard `index` of `count`, in subject_id order.
+def shard_subjects(subject_ids, index, count, costs=None):
+    if count < 1 or not 0 <= index < count:
+        raise ValueError(f"Shard index {index} is out of range for {count} shards")
+    costs = costs or {}
+
+    order = sorted((int(s) for s in subject_ids), key=lambda s: (-costs.get(s, PATIENT_TOKENS), stable_hash(s)))
+    loads = [(0, shard) for shard in range(count)]
+    mine = []
+    for subject_id in order:
+        load, shard = heapq.heappop(loads)
+        if shard == index:
+            mine.append(subject_id)
+        heapq.heappush(loads, (load + costs.get(subject_id, PATIENT_TOKENS), shard))
+
+    mine.sort()
+    total = sum(costs.get(s, PATIENT_TOKENS) for s in mine)
+    print(f"Shard {index + 1}/{count}: {len(mine)} of {len(order)} patients, ~{int(total)} tokens")
+    return mine
+
+
+def shard_path(path, index, count):
+    base, ext = os.path.splitext(path)
+    return f"{base}.shard{index:03d}-of-{count:03d}{ext}"
+
+
+# Point the pipeline's outputs at its shard files (ledger and run records follow output_file).
+def apply_shard(pipeline, index, count):
+    pipeline.output_file = shard_path(pipeline.output_file, index, count)
+    pipeline.sql_file = shard_path(pipeline.sql_file, index, count)
+
+
+# ======================
+# MERGE
+# ======================
+
+def _existing(path):
+    for candidate in (path, path + ".gz", path + ".zst"):
+        if os.path.exists(candidate):
+            return candidate
+    return None
+
+
+# (subject_id, block text) per patient block of a prose or SQL file, in file order.
+def _text_blocks(path, header):
+    subject_id, lines = None, []
+    with open_text(path) as f:
+        for line in f:
+            match = header.fullmatch(line)
+            if match:
+                if lines and subject_id is not None:
+                    yield subject_id, "".join(lines)
+                subject_id, lines = int(match.group(1)), []
+            lines.append(line)
+    if lines and subject_id is not None:
+        yield subject_id, "".join(lines)
+
+
+def _record_blocks(path):
+    with open_text(path) as f:
+        for line in f:
+            if line.strip():
+                item = json.loads(line)
+                if item.get("type") == "patient":
+                    yield item["subject_id"], line if line.endswith("\n") else line + "\n"
+
+
+def _in_order(blocks):
+    previous = None
+    for subject_id, _ in blocks:
+        if previous is not None and subject_id < previous:
+            return False
+        previous = subject_id
+    return True
+
+
+# A sorted iterator over one shard's blocks: streamed when the file is already in order.
+def _sorted_blocks(read, path):
+    if _in_order(read(path)):
+        return read(path)
+    print(f"{path} is out of subject order (resumed run?), sorting it in memory")
+    return iter(sorted(read(path), key=lambda block: block[0]))
+
+
+# Merge of all shards; the last block of a repeated subject wins.
+def _merge(read, paths):
+    merged = heapq.merge(*(_sorted_blocks(read, path) for path in paths), key=lambda block: block[0])
+    current = None
+    for block in merged:
+        if current is not None and block[0] != current[0]:
+            yield current
+        current = block
+    if current is not None:
+        yield current
+
+
+def _shard_files(path, count):
+    paths = [_existing(shard_path(path, index, count)) for index in range(count)]
+    missing = [index for index, found in enumerate(paths) if found is None]
+    if len(missing) == count:
+        return None
+    if missing:
+        raise ValueError(f"Missing shards {missing} of {count} for {path}")
+    return paths
+
+
+def _run_header_and_templates(paths, count):
+    header, templates = None, {}
+    for path in paths:
+        with open_text(path) as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                item = json.loads(line)
+                if item.get("type") == "run" and header is None:
+                    header = dict(item, shards=count)
+                elif item.get("type") == "template":
+                    templates.setdefault(item["id"], item)
+    return header, templates
+
+
+# Canonical prose / SQL / run-record files from the shard files that exist.
+def merge_shards(output_file, sql_file, count):
+    jobs = [
+        ("prose", output_file, lambda path: _text_blocks(path, PROSE_HEADER)),
+        ("sql", sql_file, lambda path: _text_blocks(path, SQL_HEADER)),
+        ("records", os.path.splitext(output_file)[0] + ".jsonl", _record_blocks),
+    ]
+    sink = OutputSink()
+    try:
+        for role, path, read in jobs:
+            paths = _shard_files(path, count)
+            if paths is None:
+                continue
+            stream = sink.stream(role, path)
+            if role == "records":
+                header, templates = _run_header_and_templates(paths, count)
+                for item in ([header] if header else []) + list(templates.values()):
+                    stream.write(json.dumps(item, ensure_ascii=False) + "\n")
+            n = 0
+            for _, block in _merge(read, paths):
+                stream.write(block)
+                n += 1
+            print(f"Merged {count} shards into {path}: {n} patients")
+    finally:
+        sink.close()
+
+
+def main():
+    from run_all_tables import TABLE_MODULES
+
+    parser = argparse.ArgumentParser()
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    merge = sub.add_parser("merge")
+    merge.add_argument("--table", choices=list(TABLE_MODULES), help="use the table's MG output paths")
+    merge.add_argument("--output", default=None, help="canonical prose file (default: from --table)")
+    merge.add_argument("--sql", default=None, help="canonical SQL file (default: from --table)")
+    merge.add_argument("--shard-count", type=int, required=True)
+    args = parser.parse_args()
+
+    output_file, sql_file = args.output, args.sql
+    if args.table:
+        pipeline = importlib.import_module(TABLE_MODULES[args.table]).PIPELINE
+        output_file = output_file or pipeline.output_file
+        sql_file = sql_file or pipeline.sql_file
+    if not output_file or not sql_file:
+        parser.error("give --table, or both --output and --sql")
+
+    merge_shards(output_file, sql_file, args.shard_count)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+import time
+
+import torch
+from transformers import AutoTokenizer, AutoModelForCausalLM
+
+
+# ======================
+# DRAFT MODEL
+# ======================
+
+# Good draft/target pairs (same tokenizer, so no re-tokenization between the two):
+# "meta-llama/Llama-3.2-1B-Instruct"  -> "meta-llama/Llama-3.1-8B-Instruct"
+# "google/gemma-2-2b-it"              -> "google/gemma-2-9b-it"
+# A draft with a different tokenizer (e.g. gemma for a llama target) also works,
+# but tokens are re-encoded every step and the speedup is smaller.
+
+
+def load_draft_model(draft_name, token=None):
+    print(f"Loading draft model: {draft_name}")
+
+    draft_tokenizer = AutoTokenizer.from_pretrained(draft_name, token=token)
+    draft_model = AutoModelForCausalLM.from_pretrained(
+        draft_name,
+        token=token,
+        dtype=torch.float16,
+        device_map="auto"
+    )
+    return draft_model, draft_tokenizer
+
+
+def same_vocab(tokenizer_a, tokenizer_b):
+    return tokenizer_a.get_vocab() == tokenizer_b.get_vocab()
+
+
+# Extra kwargs for model.generate(...) that turn on assisted generation.
+# The draft proposes tokens and the target verifies them in one forward pass,
+# so with do_sample=False the output is the target model's own greedy output.
+# Assisted generation only supports batch size 1.
+def assisted_generate_kwargs(draft_name, target_tokenizer, token=None):
+    if not draft_name:
+        return {}
+
+    draft_model, draft_tokenizer = load_draft_model(draft_name, token=token)
+
+    kwargs = {"assistant_model": draft_model}
+    if not same_vocab(draft_tokenizer, target_tokenizer):
+        # Universal assisted decoding: transformers translates between the two vocabularies.
+        kwargs["tokenizer"] = target_tokenizer
+        kwargs["assistant_tokenizer"] = draft_tokenizer
+    return kwargs
+
+
+# ======================
+# VERIFICATION
+# ======================
+
+# Run each prompt with and without the draft model and compare token ids.
+# Use this once per draft/target pair before a large run; it also reports the speedup.
+def verify_greedy_equivalence(model, tokenizer, assistant_kwargs, prompts, max_new_tokens=200):
+    mismatches = []
+    plain_seconds = 0.0
+    assisted_seconds = 0.0
+
+    for prompt in prompts:
+        inputs = tokenizer(prompt, return_tensors="pt").to(model.device)
+        gen_kwargs = dict(max_new_tokens=max_new_tokens, do_sample=False, pad_token_id=tokenizer.eos_token_id)
+
+        start = time.perf_counter()
+        plain = model.generate(**inputs, **gen_kwargs)
+        plain_seconds += time.perf_counter() - start
+
+        start = time.perf_counter()
+        assisted = model.generate(**inputs, **gen_kwargs, **assistant_kwargs)
+        assisted_seconds += time.perf_counter() - start
+
+        if not torch.equal(plain.cpu(), assisted.cpu()):
+            mismatches.append(prompt)
+
+    speedup = plain_seconds / assisted_seconds if assisted_seconds else float("nan")
+    print(f"Greedy equivalence: {len(prompts) - len(mismatches)}/{len(prompts)} identical, speedup {speedup:.2f}x")
+    return mismatches, speedup
@@ -0,0 +1,304 @@
+"""
+Shared driver for the per-table MG scripts.
+
+Each *_MG script only defines its table-specific steps (SQL prompt, SQL cleanup,
+patient context, summary prompt) and wraps them in a TablePipeline. The steps
+are split at the two generation calls so the same pipeline can run serially
+(run_table) or with generation jobs from many tables interleaved (run_all_tables.py).
+"""
+
+import argparse
+import os
+import sqlite3
+
+import pandas as pd
+
+from hierarchical_summary import chunk_cache, use_hierarchical, summarize_hierarchical
+from output_sink import OutputSink, compressed_path
+from run_ledger import RunLedger, committed_offsets, ledger_path, pending_subjects, truncate_outputs
+from run_records import RunRecordWriter
+from sharding import apply_shard, estimate_costs, shard_subjects
+
+
+# "text": prose .txt + .sql files; "jsonl": one structured file per run (run_records.py);
+# "both": all three.
+RUN_FORMAT = os.getenv("RUN_FORMAT", "text")
+
+
+class TablePipeline:
+    def __init__(
+        self,
+        table,
+        input_files,
+        output_file,
+        sql_file,
+        build_sql_prompt,
+        parse_sql,
+        build_patient_context,
+        build_summary_prompt,
+        summary_max_new_tokens,
+        sql_max_new_tokens=500,
+        context_unit="records",
+        log_errors=False,
+        subject_limit=None,
+        hierarchical=None,
+        cohort=None,
+    ):
+        # input_files maps sqlite table name -> csv path; the first entry is the main table.
+        self.table = table
+        self.input_files = input_files
+        self.output_file = output_file
+        self.sql_file = sql_file
+        self.build_sql_prompt = build_sql_prompt
+        self.parse_sql = parse_sql
+        self.build_patient_context = build_patient_context
+        self.build_summary_prompt = build_summary_prompt
+        self.summary_max_new_tokens = summary_max_new_tokens
+        self.sql_max_new_tokens = sql_max_new_tokens
+        self.context_unit = context_unit
+        self.log_errors = log_errors
+        self.subject_limit = subject_limit
+        # HierarchicalConfig: map-reduce summaries for patients with very many rows.
+        self.hierarchical = hierarchical
+        # Optional object with load(conn): precomputes per-patient context for the whole table.
+        self.cohort = cohort
+
+
+# ======================
+# DATA
+# ======================
+
+# Load every input CSV into the SQLite connection and return the subject_ids to process.
+# shard=(index, count) keeps only that shard's patients (see sharding.py).
+def load_tables(pipeline, conn, shard=None):
+    main_df = None
+    for name, path in pipeline.input_files.items():
+        df = pd.read_csv(path)
+        print(f"Loaded {name}: {df.shape}")
+        df.to_sql(name, conn, index=False, if_exists="replace")
+        if main_df is None:
+            main_df = df
+
+    if pipeline.cohort is not None:
+        pipeline.cohort.load(conn)
+
+    subject_ids = main_df["subject_id"].dropna().astype(int).unique()
+    if pipeline.subject_limit:
+        subject_ids = subject_ids[:pipeline.subject_limit]
+    if shard is not None:
+        subject_ids = shard_subjects(subject_ids, *shard, costs=estimate_costs(main_df))
+    return subject_ids
+
+
+# Deterministic SQL for a patient (the table's fallback query), used where every run
+# must see the same rows regardless of what a model would generate.
+def reference_sql(pipeline, subject_id):
+    try:
+        return pipeline.parse_sql("", subject_id)
+    except ValueError:
+        return f"SELECT * FROM {pipeline.table} WHERE subject_id = {int(subject_id)};"
+
+
+# ======================
+# PATIENT STEPS
+# ======================
+
+# Turn the rows returned by the generated SQL into the summary prompt.
+# Returns (summary_prompt, max_new_tokens).
+def prepare_summary(pipeline, backend, subject_id, result_df):
+    max_new_tokens = pipeline.summary_max_new_tokens(result_df)
+    context, budget_info = pipeline.build_patient_context(subject_id, result_df, max_new_tokens, backend)
+
+    if budget_info["dropped"]:
+        print(f"Patient {subject_id}: kept {budget_info['kept']} of "
+              f"{budget_info['kept'] + budget_info['dropped']} {pipeline.context_unit} to fit the context window")
+
+    return pipeline.build_summary_prompt(context), max_new_tokens
+
+
+def write_sql(sql_handle, subject_id, sql):
+    sql_handle.write(f"-- Patient {subject_id}\n{sql}\n\n")
+
+
+# Save everything that went into and came out of the LLM so the run is easy to inspect later.
+def write_patient(prose_handle, record):
+    prose_handle.write(f"=== Patient {record['subject_id']} ===\n")
+    prose_handle.write("SQL PROMPT:\n" + record["sql_prompt"].strip() + "\n\n")
+    prose_handle.write("RAW SQL OUTPUT:\n" + record["raw_sql"] + "\n\n")
+    prose_handle.write("EXECUTED SQL:\n" + record["sql"] + "\n\n")
+    prose_handle.write("SUMMARY PROMPT:\n" + record["summary_prompt"].strip() + "\n\n")
+    prose_handle.write("SUMMARY OUTPUT:\n" + record["summary"] + "\n\n")
+
+
+def write_error(pipeline, prose_handle, subject_id, error):
+    print(f"Failed for patient {subject_id}: {error}")
+    if pipeline.log_errors:
+        prose_handle.write(f"=== Patient {subject_id} ===\nERROR: {error}\n\n")
+
+
+# Token counts and latency of one generation call, kept on the patient record.
+def note_generation(record, step, result):
+    record.setdefault("generation", {})[step] = {
+        "prompt_tokens": result.prompt_tokens,
+        "completion_tokens": result.completion_tokens,
+        "latency_s": round(result.latency_s, 3),
+    }
+
+
+def run_records_path(pipeline):
+    return os.path.splitext(pipeline.output_file)[0] + ".jsonl"
+
+
+# Every writer of one table run behind one interface, in the formats RUN_FORMAT asks for.
+# Writes go through a background OutputSink; each finished patient is committed to the
+# run ledger once its output is on disk. append=True (--resume / --retry-failed)
+# continues the outputs of an earlier run.
+class TableOutput:
+    def __init__(self, pipeline, model=None, run_format=None, append=False):
+        run_format = run_format or RUN_FORMAT
+        if run_format not in ("text", "jsonl", "both"):
+            raise ValueError(f"Unknown RUN_FORMAT {run_format!r}; use text, jsonl or both")
+
+        self.pipeline = pipeline
+        self.prose_handle = self.sql_handle = self.records = None
+
+        paths = {}
+        if run_format in ("text", "both"):
+            paths["prose"] = pipeline.output_file
+            paths["sql"] = pipeline.sql_file
+        if run_format in ("jsonl", "both"):
+            paths["records"] = run_records_path(pipeline)
+
+        os.makedirs(os.path.dirname(pipeline.output_file) or ".", exist_ok=True)
+        self.ledger = RunLedger(ledger_path(pipeline.output_file), append=append)
+        self.sink = OutputSink(on_flush=self.ledger.sync)
+        if append:
+            # Nothing committed yet: whatever is there is from an interrupted first patient.
+            offsets = committed_offsets(self.ledger.entries) if self.ledger.entries else dict.fromkeys(paths, 0)
+            truncate_outputs({role: compressed_path(path, self.sink.compression) for role, path in paths.items()},
+                             offsets)
+
+        streams = {role: self.sink.stream(role, path, append) for role, path in paths.items()}
+        self.prose_handle = streams.get("prose")
+        self.sql_handle = streams.get("sql")
+        if "records" in streams:
+            self.records = RunRecordWriter(pipeline, streams["records"], model)
+
+    def _commit(self, subject_id, status, error=None):
+        self.sink.commit(lambda offsets: self.ledger.add(subject_id, status, offsets, error))
+
+    def sql(self, subject_id, sql):
+        if self.sql_handle:
+            write_sql(self.sql_handle, subject_id, sql)
+        if self.records:
+            self.records.sql(subject_id, sql)
+
+    def patient(self, record):
+        if self.prose_handle:
+            write_patient(self.prose_handle, record)
+        if self.records:
+            self.records.patient(record)
+        self._commit(record["subject_id"], "done")
+
+    def error(self, subject_id, error):
+        if self.prose_handle:
+            write_error(self.pipeline, self.prose_handle, subject_id, error)
+        else:
+            print(f"Failed for patient {subject_id}: {error}")
+        if self.records:
+            self.records.error(subject_id, error)
+        self._commit(subject_id, "failed", error)
+
+    def close(self):
+        try:
+            self.sink.close()
+        finally:
+            self.ledger.close()
+
+
+# Outputs for a run plus the subject_ids it still has to process (see run_ledger.py).
+def open_run(pipeline, subject_ids, model=None, resume=False, retry_failed=False):
+    output = TableOutput(pipeline, model, append=resume or retry_failed)
+    return output, pending_subjects(subject_ids, output.ledger.entries, resume, retry_failed)
+
+
+def add_run_arguments(parser):
+    parser.add_argument("--resume", action="store_true",
+                        help="skip patients already in the run ledger and append to the outputs")
+    parser.add_argument("--retry-failed", action="store_true",
+                        help="rerun only patients whose last attempt failed (with --resume: and new ones)")
+    parser.add_argument("--shard-index", type=int, default=None,
+                        help="run only this shard of the patients (0-based; with --shard-count)")
+    parser.add_argument("--shard-count", type=int, default=None)
+
+
+# (index, count) from --shard-index / --shard-count, or None for the whole table.
+def shard_option(parser, args):
+    if (args.shard_index is None) != (args.shard_count is None):
+        parser.error("--shard-index and --shard-count go together")
+    if args.shard_count is None:
+        return None
+    if args.shard_count < 1 or not 0 <= args.shard_index < args.shard_count:
+        parser.error(f"--shard-index must be in 0..{args.shard_count - 1}")
+    return args.shard_index, args.shard_count
+
+
+# Command-line options of an MG script, as keyword arguments for run_table.
+def run_options(argv=None):
+    parser = argparse.ArgumentParser()
+    add_run_arguments(parser)
+    args = parser.parse_args(argv)
+    return {"resume": args.resume, "retry_failed": args.retry_failed, "shard": shard_option(parser, args)}
+
+
+# ======================
+# SERIAL RUN
+# ======================
+
+# One patient at a time: SQL -> execute -> context -> summary (map-reduce for very large patients).
+def run_table(pipeline, backend, resume=False, retry_failed=False, shard=None):
+    conn = sqlite3.connect(":memory:")
+    if shard is not None:
+        apply_shard(pipeline, *shard)
+    subject_ids = load_tables(pipeline, conn, shard)
+    output, subject_ids = open_run(pipeline, subject_ids, backend.model_name, resume, retry_failed)
+    print(f"Processing {len(subject_ids)} patients")
+
+    cache = chunk_cache(pipeline, backend)
+
+    try:
+        for i, subject_id in enumerate(subject_ids):
+            record = {"subject_id": subject_id}
+            try:
+                record["sql_prompt"] = pipeline.build_sql_prompt(subject_id)
+                result = backend.generate(record["sql_prompt"], pipeline.sql_max_new_tokens)
+                note_generation(record, "sql", result)
+                record["raw_sql"] = result.text.strip()
+                record["sql"] = pipeline.parse_sql(record["raw_sql"], subject_id)
+
+                output.sql(subject_id, record["sql"])
+
+                result_df = pd.read_sql_query(record["sql"], conn)
+
+                if use_hierarchical(pipeline, result_df):
+                    record["summary_prompt"], record["summary"] = summarize_hierarchical(
+                        pipeline, backend, cache, subject_id, result_df)
+                else:
+                    record["summary_prompt"], max_new_tokens = prepare_summary(pipeline, backend, subject_id, result_df)
+                    result = backend.generate(record["summary_prompt"], max_new_tokens)
+                    note_generation(record, "summary", result)
+                    record["summary"] = result.text.strip()
+
+                output.patient(record)
+
+                print(f"Done {i+1}/{len(subject_ids)}")
+
+            except Exception as e:
+                output.error(subject_id, e)
+    finally:
+        output.close()
+
+    conn.close()
+
+    print(f"Generation metrics: {backend.metrics.summary()}")
+    print("Finished everything.")
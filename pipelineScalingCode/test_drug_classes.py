@@ -0,0 +1,33 @@
+import pandas as pd
+
+from drug_classes import DEFAULT_DRUG_CLASSES, DrugClassMatcher, class_rollup, normalize_drug_name
+
+
+# MIMIC prescription strings where the ion is the active ingredient.
+ION_DRUGS = {
+    "Potassium Chloride (Powder)": ("potassium chloride powder", "electrolyte"),
+    "Sodium Chloride 0.9%  Flush": ("sodium chloride flush", "electrolyte"),
+    "Calcium Gluconate": ("calcium gluconate", "electrolyte"),
+    "Magnesium Sulfate": ("magnesium sulfate", "electrolyte"),
+}
+
+
+def test_ion_drugs_keep_their_active_ingredient():
+    matcher = DrugClassMatcher(DEFAULT_DRUG_CLASSES)
+    for drug, (norm, drug_class) in ION_DRUGS.items():
+        name, classes, _ = matcher.match(drug)
+        assert name == norm, drug
+        assert classes == [drug_class], drug
+
+
+def test_counter_ions_are_still_dropped():
+    assert normalize_drug_name("Metoprolol Tartrate 25mg Tab") == "metoprolol"
+    assert normalize_drug_name("Docusate Sodium") == "docusate"
+    assert normalize_drug_name("Heparin Sodium") == "heparin"
+
+
+def test_rollup_lists_real_drug_names():
+    df = pd.DataFrame({"drug": list(ION_DRUGS)})
+    records = class_rollup(df.join(DrugClassMatcher(DEFAULT_DRUG_CLASSES).classify(df["drug"])))
+    assert records[0]["drug_class"] == "electrolyte"
+    assert records[0]["drugs"] == ["potassium chloride", "sodium chloride", "calcium gluconate", "magnesium sulfate"]